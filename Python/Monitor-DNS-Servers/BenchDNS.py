@@ -0,0 +1,432 @@
+#!/bin/python3
+
+# Import statements
+import os
+import sys
+import json
+import math
+import heapq
+import random
+import socket
+import ssl
+import struct
+import asyncio
+import itertools
+import argparse
+import threading
+import time
+import DnsWire
+import TestDNS
+
+# Address every stub resolver answers A queries with (TEST-NET-1)
+ANSWER_ADDRESS = socket.inet_aton("192.0.2.1")
+
+# A function to parse a latency distribution spec into a sampler of milliseconds
+# constant:MS, uniform:LOW:HIGH, lognormal:MEDIAN:SIGMA, exponential:MEAN
+def ParseDistribution(spec, rng):
+    name, *params = spec.split(":")
+    params = [float(param) for param in params]
+
+    if name == "constant":
+        return lambda: params[0]
+    if name == "uniform":
+        return lambda: rng.uniform(params[0], params[1])
+    if name == "lognormal":
+        return lambda: rng.lognormvariate(math.log(params[0]), params[1])
+    if name == "exponential":
+        return lambda: rng.expovariate(1 / params[0])
+
+    raise ValueError(f"Unknown latency distribution {spec}")
+
+# A class for one local stub resolver answering over UDP and TCP on the same port, and over
+# DoT and DoH on ports of their own when given a TLS server context
+# Each query is answered after a latency drawn from the distribution, dropped with
+# probability `loss` or answered SERVFAIL with probability `servfail`. What was injected
+# is recorded per question name, in arrival order, for comparison with what was measured.
+class StubResolver:
+    def __init__(self, latency, loss=0.0, servfail=0.0, seed=0, tls=None):
+        self.rng = random.Random(seed)
+        self.latency = ParseDistribution(latency, self.rng)
+        self.spec = latency
+        self.loss = loss
+        self.servfail = servfail
+        self.injected = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+        # Bind TCP first on an ephemeral port, then UDP on the same one
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind(("127.0.0.1", 0))
+        self.tcp.listen(128)
+        self.port = self.tcp.getsockname()[1]
+
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(("127.0.0.1", self.port))
+
+        # Delayed UDP answers wait in a heap for one sender thread, so thousands of
+        # outstanding queries do not need a thread each
+        self.due = []
+        self.due_ready = threading.Condition()
+        self.sequence = itertools.count()
+
+        self.threads = [
+            threading.Thread(target=self.ServeUDP, daemon=True),
+            threading.Thread(target=self.SendDue, daemon=True),
+            threading.Thread(target=self.ServeTCP, daemon=True)
+        ]
+
+        self.loop = None
+        self.dot_port = None
+        self.doh_port = None
+        if tls is not None:
+            self.ServeTls(tls)
+
+    def Start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def Stop(self):
+        self.stopping.set()
+        with self.due_ready:
+            self.due_ready.notify()
+        self.udp.close()
+        self.tcp.close()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    # A function to decide the fate of a query and record it
+    # Return the response (None when dropped) and the delay in seconds
+    def Answer(self, query):
+        _, _, name, qtype, _ = DnsWire.ParseQuery(query)
+
+        with self.lock:
+            roll = self.rng.random()
+            if roll < self.loss:
+                outcome, delay = "loss", None
+            elif roll < self.loss + self.servfail:
+                outcome, delay = "servfail", self.latency()
+            else:
+                outcome, delay = "ok", self.latency()
+            self.injected.setdefault(name.lower(), []).append((outcome, delay))
+
+        if outcome == "loss":
+            return None, 0
+        if outcome == "servfail":
+            return DnsWire.BuildResponse(query, DnsWire.RCODE_SERVFAIL), delay / 1000
+
+        answers = [(DnsWire.QTYPE_A, 60, ANSWER_ADDRESS)] if qtype == DnsWire.QTYPE_A else []
+        return DnsWire.BuildResponse(query, DnsWire.RCODE_NOERROR, answers), delay / 1000
+
+    def ServeUDP(self):
+        while not self.stopping.is_set():
+            try:
+                query, address = self.udp.recvfrom(DnsWire.MAX_UDP_SIZE)
+                response, delay = self.Answer(query)
+            except (OSError, DnsWire.DnsError):
+                continue
+
+            if response is not None:
+                with self.due_ready:
+                    heapq.heappush(self.due, (time.monotonic() + delay, next(self.sequence), response, address))
+                    self.due_ready.notify()
+
+    def SendDue(self):
+        while not self.stopping.is_set():
+            with self.due_ready:
+                while not self.due and not self.stopping.is_set():
+                    self.due_ready.wait()
+                if self.stopping.is_set():
+                    return
+
+                wait = self.due[0][0] - time.monotonic()
+                if wait > 0:
+                    self.due_ready.wait(wait)
+                    continue
+
+                _, _, response, address = heapq.heappop(self.due)
+
+            try:
+                self.udp.sendto(response, address)
+            except OSError:
+                pass
+
+    def ServeTCP(self):
+        while not self.stopping.is_set():
+            try:
+                conn, _ = self.tcp.accept()
+            except OSError:
+                continue
+            threading.Thread(target=self.HandleTCP, args=(conn,), daemon=True).start()
+
+    def HandleTCP(self, conn):
+        with conn:
+            try:
+                while True:
+                    length = struct.unpack("!H", DnsWire.ReadExactly(conn, 2))[0]
+                    response, delay = self.Answer(DnsWire.ReadExactly(conn, length))
+
+                    # A dropped TCP query is never answered, the client times out
+                    if response is None:
+                        continue
+
+                    time.sleep(delay)
+                    conn.sendall(struct.pack("!H", len(response)) + response)
+            except (OSError, DnsWire.DnsError):
+                return
+
+    # A function to serve DoT and DoH from one event loop thread, so a TLS connection is only
+    # ever used by one thread. Pipelined DoT queries are answered as their delays elapse, in
+    # any order; DoH answers go out in request order as HTTP/1.1 requires.
+    def ServeTls(self, context):
+        self.loop = asyncio.new_event_loop()
+
+        async def Start():
+            dot = await asyncio.start_server(self.HandleDot, "127.0.0.1", 0, ssl=context)
+            doh = await asyncio.start_server(self.HandleDoh, "127.0.0.1", 0, ssl=context)
+            return dot.sockets[0].getsockname()[1], doh.sockets[0].getsockname()[1]
+
+        self.dot_port, self.doh_port = self.loop.run_until_complete(Start())
+        self.threads.append(threading.Thread(target=self.loop.run_forever, daemon=True))
+
+    async def HandleDot(self, reader, writer):
+        replies = set()
+
+        async def Reply(response, delay):
+            await asyncio.sleep(delay)
+            if not writer.is_closing():
+                writer.write(struct.pack("!H", len(response)) + response)
+
+        try:
+            while True:
+                length = struct.unpack("!H", await reader.readexactly(2))[0]
+                response, delay = self.Answer(await reader.readexactly(length))
+
+                # A dropped query is never answered, the client times out
+                if response is not None:
+                    task = asyncio.ensure_future(Reply(response, delay))
+                    replies.add(task)
+                    task.add_done_callback(replies.discard)
+        except (OSError, EOFError, ssl.SSLError, DnsWire.DnsError):
+            pass
+        finally:
+            writer.close()
+
+    async def HandleDoh(self, reader, writer):
+        replies = asyncio.Queue()
+
+        async def Reply(response, delay):
+            await asyncio.sleep(delay)
+            return response
+
+        async def Send():
+            while True:
+                reply = await replies.get()
+                if reply is None:
+                    return
+                response = await reply
+
+                # A lost query cannot stay unanswered without stalling every later response
+                # on the connection, so it fails with 504 like an upstream timeout would
+                status = "200 OK" if response is not None else "504 Gateway Timeout"
+                body = response or b""
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: application/dns-message\r\nContent-Length: {len(body)}\r\n\r\n".encode("ascii") + body
+                )
+
+        sender = asyncio.ensure_future(Send())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                headers = {}
+                while True:
+                    header = (await reader.readline()).decode("latin-1").strip()
+                    if not header:
+                        break
+                    name, _, value = header.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                response, delay = self.Answer(await reader.readexactly(int(headers.get("content-length", 0))))
+                replies.put_nowait(asyncio.ensure_future(Reply(response, delay)))
+        except (OSError, EOFError, ssl.SSLError, DnsWire.DnsError):
+            pass
+        finally:
+            replies.put_nowait(None)
+            await sender
+            writer.close()
+
+# A function to summarize a list of millisecond values
+def Summarize(values):
+    ordered = sorted(values)
+    if not ordered:
+        return {"count": 0}
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered), 3),
+        "p50": round(TestDNS.Percentile(ordered, 50), 3),
+        "p95": round(TestDNS.Percentile(ordered, 95), 3),
+        "p99": round(TestDNS.Percentile(ordered, 99), 3),
+        "max": round(ordered[-1], 3)
+    }
+
+# A function to run one probe round against the farm and score it
+# Return the round report and the measured minus injected latency of every answered sample
+def RunRound(stubs, fqdns, args):
+    if args.transport == "dot":
+        nameservers = [f"tls://127.0.0.1:{stub.dot_port}" for stub in stubs]
+    elif args.transport == "doh":
+        nameservers = [f"https://127.0.0.1:{stub.doh_port}/dns-query" for stub in stubs]
+    else:
+        nameservers = [f"127.0.0.1:{stub.port}" for stub in stubs]
+    by_nameserver = dict(zip(nameservers, stubs))
+
+    for stub in stubs:
+        with stub.lock:
+            stub.injected = {}
+
+    probe_args = (args.concurrency, args.nameserver_concurrency, args.samples, args.spacing_ms, args.transport, args.timeout_ms / 1000)
+    tls = {"ca_file": args.tls_cert}
+
+    start = time.perf_counter()
+    if args.workers > 1:
+        durations = TestDNS.RunShardedProbes(nameservers, fqdns, args.workers, *probe_args, tls=tls)
+    else:
+        durations = TestDNS.RunProbes(nameservers, fqdns, *probe_args, tls=tls)
+    wall = time.perf_counter() - start
+
+    # Connections are kept across rounds, so only the first round should pay for handshakes
+    handshakes = [ms for nameserver in nameservers for ms in TestDNS.TLS_HANDSHAKES.pop(nameserver, [])]
+
+    errors = []
+    outcomes = {"ok": 0, "loss": 0, "servfail": 0}
+    unexpected = 0
+    busy = 0.0
+
+    for (fqdn, nameserver), measured in durations.items():
+        injected = by_nameserver[nameserver].injected.get(fqdn.lower(), [])
+
+        # Samples of a pair run in order, so the n-th query seen is the n-th sample
+        for index, duration in enumerate(measured):
+            outcome, delay = injected[index] if index < len(injected) else ("missing", None)
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            busy += duration if duration > 0 else args.timeout_ms if outcome == "loss" else delay or 0
+
+            if outcome == "ok" and duration > 0:
+                errors.append(duration - delay)
+            elif (outcome == "ok") != (duration > 0):
+                unexpected += 1
+
+    probes = sum(len(measured) for measured in durations.values())
+    slots = max(1, args.concurrency // args.workers) * args.workers if args.workers > 1 else args.concurrency
+    workers = max(1, min(slots, len(durations)))
+
+    return {
+        "probes": probes,
+        "wall_seconds": round(wall, 4),
+        "probes_per_second": round(probes / wall, 1),
+        # Wall time the workers spent outside a probe, per probe
+        "scheduler_overhead_ms": round(max(0.0, wall * 1000 * workers - busy) / probes, 3),
+        "injected": outcomes,
+        "unexpected_results": unexpected,
+        "latency_error_ms": Summarize(errors),
+        "tls_handshake_ms": Summarize(handshakes)
+    }, errors
+
+# A function to start the farm, run the rounds and print the JSON report
+# Return True when any probe disagreed with what the stub injected
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark TestDNS probing against local stub resolvers")
+    parser.add_argument("--servers", type=int, default=4, help="Stub resolvers to start")
+    parser.add_argument("--domains", type=int, default=50, help="Synthetic FQDNs probed on every resolver")
+    parser.add_argument("--latency", type=str, nargs="+", default=["lognormal:5:0.5"], help="Latency distribution per resolver, cycled (constant:MS, uniform:LOW:HIGH, lognormal:MEDIAN:SIGMA, exponential:MEAN)")
+    parser.add_argument("--loss", type=float, default=0.0, help="Probability a query is dropped")
+    parser.add_argument("--servfail", type=float, default=0.0, help="Probability a query is answered SERVFAIL")
+    parser.add_argument("--rounds", type=int, default=3, help="Probe rounds to run")
+    parser.add_argument("--concurrency", type=int, default=32, help="Probes in flight, as general.concurrency")
+    parser.add_argument("--workers", type=int, default=1, help="Probe worker processes, as general.workers")
+    parser.add_argument("--nameserver-concurrency", type=int, default=0, help="Probes in flight per resolver")
+    parser.add_argument("--samples", type=int, default=1, help="Samples per pair, as general.samples")
+    parser.add_argument("--spacing-ms", type=float, default=0, help="Delay between samples of a pair")
+    parser.add_argument("--transport", type=str, default="udp", choices=["udp", "tcp", "dot", "doh"], help="Probe transport")
+    parser.add_argument("--tls-cert", type=str, default="", help="PEM certificate the stubs serve DoT/DoH with, also trusted by the probes")
+    parser.add_argument("--tls-key", type=str, default="", help="PEM private key of --tls-cert")
+    parser.add_argument("--timeout-ms", type=float, default=1000, help="Probe timeout")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    parser.add_argument("--output", type=str, default="", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--log-path", type=str, default="/dev/null", help="Where TestDNS logs probes")
+    args = parser.parse_args()
+
+    TestDNS.LOG_PATH = args.log_path
+
+    context = None
+    if args.transport in ("dot", "doh"):
+        if not args.tls_cert or not args.tls_key:
+            parser.error("--transport dot/doh needs --tls-cert and --tls-key")
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(args.tls_cert, args.tls_key)
+
+    stubs = [
+        StubResolver(args.latency[index % len(args.latency)], args.loss, args.servfail, args.seed + index, context).Start()
+        for index in range(args.servers)
+    ]
+    fqdns = [f"bench{index}.example.test" for index in range(args.domains)]
+
+    rounds = []
+    errors = []
+    # TestDNS and its worker processes log every probe to stdout, keep stdout for the report
+    sys.stdout.flush()
+    saved_stdout = os.dup(1)
+    os.dup2(2, 1)
+
+    try:
+        for _ in range(args.rounds):
+            result, round_errors = RunRound(stubs, fqdns, args)
+            rounds.append(result)
+            errors += round_errors
+    finally:
+        TestDNS.ShutdownProbePool()
+        TestDNS.CloseEncryptedClient()
+        for stub in stubs:
+            stub.Stop()
+        sys.stdout.flush()
+        os.dup2(saved_stdout, 1)
+        os.close(saved_stdout)
+
+    wall = sum(result["wall_seconds"] for result in rounds)
+    probes = sum(result["probes"] for result in rounds)
+
+    report = {
+        "config": {
+            key: getattr(args, key)
+            for key in ("servers", "domains", "latency", "loss", "servfail", "rounds", "workers", "concurrency",
+                        "nameserver_concurrency", "samples", "spacing_ms", "transport", "timeout_ms", "seed")
+        },
+        "summary": {
+            "probes": probes,
+            "wall_seconds": round(wall, 4),
+            "probes_per_second": round(probes / wall, 1) if wall else 0.0,
+            "scheduler_overhead_ms": round(sum(result["scheduler_overhead_ms"] * result["probes"] for result in rounds) / probes, 3),
+            "unexpected_results": sum(result["unexpected_results"] for result in rounds),
+            "latency_error_ms": Summarize(errors)
+        },
+        "rounds": rounds
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    return report["summary"]["unexpected_results"] > 0
+
+if __name__ == "__main__":
+    if main():
+        sys.exit(1)
+    sys.exit(0)
@@ -0,0 +1,588 @@
+#!/bin/python3
+
+# Import statements
+import random
+import threading
+import collections
+import asyncio
+import socket
+import struct
+import time
+
+# Record types and response codes used by the prober
+QTYPE_A = 1
+QTYPE_NS = 2
+QTYPE_CNAME = 5
+QTYPE_SOA = 6
+QTYPE_MX = 15
+QTYPE_TXT = 16
+QTYPE_AAAA = 28
+RCODE_NOERROR = 0
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+
+# Record types a probe spec can name
+QTYPES = {
+    "A": QTYPE_A,
+    "NS": QTYPE_NS,
+    "CNAME": QTYPE_CNAME,
+    "SOA": QTYPE_SOA,
+    "MX": QTYPE_MX,
+    "TXT": QTYPE_TXT,
+    "AAAA": QTYPE_AAAA
+}
+
+# Header flag bits
+FLAG_QR = 0x8000
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+FLAG_RA = 0x0080
+
+# Receive buffer for UDP responses, above the 512 byte limit of plain DNS
+MAX_UDP_SIZE = 4096
+
+# A class for a response that could not be decoded or does not match the query
+class DnsError(Exception):
+    pass
+
+# A function to split a configured nameserver into host and port
+# Accepts "1.1.1.1", "1.1.1.1:5353", "2606:4700::1111" and "[2606:4700::1111]:5353"
+def ParseNameserver(value, default_port=53):
+    value = value.strip()
+
+    if value.startswith("["):
+        host, _, rest = value[1:].partition("]")
+        return host, int(rest[1:]) if rest.startswith(":") else default_port
+
+    if value.count(":") == 1:
+        host, port = value.split(":")
+        return host, int(port)
+
+    return value, default_port
+
+# A function to encode a domain name as DNS labels
+def EncodeName(name):
+    out = bytearray()
+    for label in name.rstrip(".").split("."):
+        if not label:
+            continue
+        encoded = label.encode("idna")
+        if len(encoded) > 63:
+            raise DnsError(f"Label too long in {name}")
+        out.append(len(encoded))
+        out += encoded
+    out.append(0)
+    return bytes(out)
+
+# A function to read a possibly compressed name
+# Return the dotted name and the offset just past it in the original position
+def ReadName(data, offset):
+    labels = []
+    end = None
+    jumps = 0
+
+    while True:
+        if offset >= len(data):
+            raise DnsError("Name runs past the end of the message")
+
+        length = data[offset]
+
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > 64:
+                raise DnsError("Compression loop")
+            offset = struct.unpack_from("!H", data, offset)[0] & 0x3FFF
+            continue
+
+        offset += 1
+        if length == 0:
+            break
+
+        labels.append(data[offset:offset + length].decode("ascii", "replace"))
+        offset += length
+
+    return ".".join(labels), end if end is not None else offset
+
+# A function to render the rdata of a record in presentation format
+# Names are lowercased without the trailing dot so equal answers always render the same;
+# types without a known layout are rendered as hex
+def FormatRdata(data, rtype, offset, length):
+    rdata = data[offset:offset + length]
+
+    if rtype == QTYPE_A and length == 4:
+        return socket.inet_ntop(socket.AF_INET, rdata)
+    if rtype == QTYPE_AAAA and length == 16:
+        return socket.inet_ntop(socket.AF_INET6, rdata)
+    if rtype in (QTYPE_NS, QTYPE_CNAME):
+        return ReadName(data, offset)[0].lower()
+    if rtype == QTYPE_MX:
+        preference = struct.unpack_from("!H", data, offset)[0]
+        return f"{preference} {ReadName(data, offset + 2)[0].lower()}"
+    if rtype == QTYPE_SOA:
+        mname, position = ReadName(data, offset)
+        rname, position = ReadName(data, position)
+        fields = struct.unpack_from("!IIIII", data, position)
+        return " ".join([mname.lower(), rname.lower(), *(str(field) for field in fields)])
+    if rtype == QTYPE_TXT:
+        strings = []
+        position = 0
+        while position < length:
+            size = rdata[position]
+            strings.append(rdata[position + 1:position + 1 + size].decode("utf-8", "replace"))
+            position += 1 + size
+        return " ".join('"' + string.replace("\\", "\\\\").replace('"', '\\"') + '"' for string in strings)
+
+    return rdata.hex()
+
+# A function to bring a record written by hand into the form FormatRdata renders
+def NormalizeRdata(rtype, text):
+    text = text.strip()
+
+    if rtype == QTYPE_A:
+        return socket.inet_ntop(socket.AF_INET, socket.inet_pton(socket.AF_INET, text))
+    if rtype == QTYPE_AAAA:
+        return socket.inet_ntop(socket.AF_INET6, socket.inet_pton(socket.AF_INET6, text))
+    if rtype in (QTYPE_NS, QTYPE_CNAME):
+        return text.lower().rstrip(".")
+    if rtype == QTYPE_MX:
+        preference, name = text.split()
+        return f"{int(preference)} {name.lower().rstrip('.')}"
+    if rtype == QTYPE_SOA:
+        mname, rname, *fields = text.split()
+        return " ".join([mname.lower().rstrip("."), rname.lower().rstrip("."), *(str(int(field)) for field in fields)])
+    if rtype == QTYPE_TXT and not text.startswith('"'):
+        return '"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+    return text
+
+# A function to build a standard recursive query
+# Return the query id and the message
+def BuildQuery(fqdn, qtype=QTYPE_A, query_id=None):
+    query_id = random.getrandbits(16) if query_id is None else query_id
+    header = struct.pack("!HHHHHH", query_id, FLAG_RD, 1, 0, 0, 0)
+    return query_id, header + EncodeName(fqdn) + struct.pack("!HH", qtype, 1)
+
+# A function to decode a query as a server sees it
+# Return the id, flags, question name, type and the offset past the question
+def ParseQuery(data):
+    if len(data) < 12:
+        raise DnsError("Short message")
+
+    query_id, flags, qdcount = struct.unpack_from("!HHH", data)
+    if qdcount != 1:
+        raise DnsError(f"Expected one question, got {qdcount}")
+
+    name, offset = ReadName(data, 12)
+    qtype, _ = struct.unpack_from("!HH", data, offset)
+    return query_id, flags, name, qtype, offset + 4
+
+# A function to build a response to a query
+# answers are (type, ttl, rdata) tuples owned by the question name
+def BuildResponse(query, rcode=RCODE_NOERROR, answers=()):
+    query_id, flags, _, _, end = ParseQuery(query)
+    flags = FLAG_QR | FLAG_RA | (flags & FLAG_RD) | rcode
+
+    out = bytearray(struct.pack("!HHHHHH", query_id, flags, 1, len(answers), 0, 0))
+    out += query[12:end]
+    for rtype, ttl, rdata in answers:
+        # 0xC00C points back at the question name
+        out += struct.pack("!HHHIH", 0xC00C, rtype, 1, ttl, len(rdata)) + rdata
+
+    return bytes(out)
+
+# A function to decode a response
+# Return a dict with id, rcode, tc and answers as dicts of name, type, ttl, rdata, offset and
+# text (offset locates rdata in the message for types whose rdata holds compressed names,
+# text is the rdata in presentation format)
+def ParseResponse(data):
+    if len(data) < 12:
+        raise DnsError("Short message")
+
+    query_id, flags, qdcount, ancount = struct.unpack_from("!HHHH", data)
+    offset = 12
+
+    question = None
+    for _ in range(qdcount):
+        name, offset = ReadName(data, offset)
+        qtype, _ = struct.unpack_from("!HH", data, offset)
+        question = (name.lower(), qtype)
+        offset += 4
+
+    answers = []
+    for _ in range(ancount):
+        name, offset = ReadName(data, offset)
+        rtype, _, ttl, length = struct.unpack_from("!HHIH", data, offset)
+        offset += 10
+        answers.append({
+            "name": name,
+            "type": rtype,
+            "ttl": ttl,
+            "rdata": data[offset:offset + length],
+            "offset": offset,
+            "text": FormatRdata(data, rtype, offset, length)
+        })
+        offset += length
+
+    return {
+        "id": query_id,
+        "rcode": flags & 0x000F,
+        "tc": bool(flags & FLAG_TC),
+        "question": question,
+        "answers": answers
+    }
+
+# A function to read exactly `size` bytes from a stream socket
+def ReadExactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise DnsError("Connection closed mid-message")
+        data += chunk
+    return bytes(data)
+
+# A function to send one query over UDP and wait for the matching response
+# Responses with another id or question are ignored, as a late answer to an earlier
+# query or a spoofed packet must not be counted
+def QueryUDP(host, port, message, query_id, question, timeout):
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    deadline = time.monotonic() + timeout
+
+    with socket.socket(family, socket.SOCK_DGRAM) as s:
+        s.connect((host, port))
+        s.send(message)
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("timed out")
+            s.settimeout(remaining)
+
+            try:
+                response = ParseResponse(s.recv(MAX_UDP_SIZE))
+            except DnsError:
+                continue
+
+            if response["id"] == query_id and response["question"] == question:
+                return response
+
+# A function to send one query over TCP with the two byte length prefix
+def QueryTCP(host, port, message, timeout):
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+
+    with socket.socket(family, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect((host, port))
+        s.sendall(struct.pack("!H", len(message)) + message)
+        length = struct.unpack("!H", ReadExactly(s, 2))[0]
+        return ParseResponse(ReadExactly(s, length))
+
+# A function to resolve fqdn directly against one nameserver
+# transport is "udp" (falling back to TCP on a truncated answer) or "tcp"
+# Return the parsed response; raises socket errors, timeouts and DnsError
+def Query(host, port, fqdn, qtype=QTYPE_A, transport="udp", timeout=2.0):
+    query_id, message = BuildQuery(fqdn, qtype)
+    question = (fqdn.rstrip(".").lower(), qtype)
+
+    if transport == "tcp":
+        return QueryTCP(host, port, message, timeout)
+
+    response = QueryUDP(host, port, message, query_id, question, timeout)
+    if response["tc"]:
+        return QueryTCP(host, port, message, timeout)
+
+    return response
+
+# A class to collect the matching UDP response for QueryAsync
+class ResponseProtocol(asyncio.DatagramProtocol):
+    def __init__(self, future, query_id, question):
+        self.future = future
+        self.query_id = query_id
+        self.question = question
+
+    def datagram_received(self, data, addr):
+        try:
+            response = ParseResponse(data)
+        except DnsError:
+            return
+
+        if response["id"] == self.query_id and response["question"] == self.question and not self.future.done():
+            self.future.set_result(response)
+
+    def error_received(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+# A function to send one query over TCP from an event loop
+async def QueryTCPAsync(host, port, message):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(struct.pack("!H", len(message)) + message)
+        await writer.drain()
+        length = struct.unpack("!H", await reader.readexactly(2))[0]
+        return ParseResponse(await reader.readexactly(length))
+    finally:
+        writer.close()
+
+# A function to resolve fqdn against one nameserver without blocking the event loop
+# Same transports, return value and errors as Query
+async def QueryAsync(host, port, fqdn, qtype=QTYPE_A, transport="udp", timeout=2.0):
+    query_id, message = BuildQuery(fqdn, qtype)
+    question = (fqdn.rstrip(".").lower(), qtype)
+
+    if transport == "tcp":
+        return await asyncio.wait_for(QueryTCPAsync(host, port, message), timeout)
+
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    endpoint, _ = await loop.create_datagram_endpoint(
+        lambda: ResponseProtocol(future, query_id, question), remote_addr=(host, port)
+    )
+
+    try:
+        endpoint.sendto(message)
+        response = await asyncio.wait_for(future, timeout)
+    finally:
+        endpoint.close()
+
+    if response["tc"]:
+        return await asyncio.wait_for(QueryTCPAsync(host, port, message), timeout)
+
+    return response
+
+# A function to split an encrypted nameserver into host, port, TLS server name and HTTP path
+# Accepts "tls://1.1.1.1", "tls://[2606:4700::1111]:853#cloudflare-dns.com" (DoT) and
+# "https://cloudflare-dns.com/dns-query" (DoH); a bare address gets the transport's default
+def ParseEncryptedNameserver(value, transport):
+    value = value.strip()
+    path = "/dns-query"
+
+    if value.startswith("https://"):
+        transport = "doh"
+        value, slash, rest = value[len("https://"):].partition("/")
+        if slash:
+            path = "/" + rest
+    elif value.startswith("tls://"):
+        transport = "dot"
+        value = value[len("tls://"):]
+
+    value, _, server_name = value.partition("#")
+    host, port = ParseNameserver(value, 443 if transport == "doh" else 853)
+    return transport, host, port, server_name or host, path
+
+# A class for one DNS-over-TLS connection (RFC 7858)
+# Queries are pipelined: each is written as soon as it is made and a single reader matches
+# the responses, which may come back in any order, to the waiting queries by id.
+class DotConnection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.waiting = {}
+        self.closed = False
+        self.task = asyncio.get_running_loop().create_task(self.Read())
+
+    async def Query(self, fqdn, qtype):
+        query_id, message = BuildQuery(fqdn, qtype)
+        while query_id in self.waiting:
+            query_id, message = BuildQuery(fqdn, qtype)
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[query_id] = (future, (fqdn.rstrip(".").lower(), qtype))
+        try:
+            self.writer.write(struct.pack("!H", len(message)) + message)
+            await self.writer.drain()
+            return await future
+        finally:
+            self.waiting.pop(query_id, None)
+
+    async def Read(self):
+        try:
+            while True:
+                length = struct.unpack("!H", await self.reader.readexactly(2))[0]
+                try:
+                    response = ParseResponse(await self.reader.readexactly(length))
+                except DnsError:
+                    continue
+
+                future, question = self.waiting.get(response["id"], (None, None))
+                if future is not None and response["question"] == question and not future.done():
+                    future.set_result(response)
+        except Exception as ex:
+            self.Fail(ex)
+
+    # A function to fail every waiting query and mark the connection unusable
+    def Fail(self, ex):
+        self.closed = True
+        for future, _ in list(self.waiting.values()):
+            if not future.done():
+                future.set_exception(DnsError(f"Connection lost - {ex!r}"))
+
+    def Close(self):
+        self.closed = True
+        self.task.cancel()
+        self.writer.close()
+
+# A class for one DNS-over-HTTPS connection (RFC 8484) over HTTP/1.1 keep-alive
+# Queries are POSTed as application/dns-message and pipelined; HTTP/1.1 answers in request
+# order, so the reader hands responses to the waiting queries first in, first out.
+class DohConnection:
+    def __init__(self, reader, writer, authority, path):
+        self.reader = reader
+        self.writer = writer
+        self.authority = authority
+        self.path = path
+        self.waiting = collections.deque()
+        self.closed = False
+        self.task = asyncio.get_running_loop().create_task(self.Read())
+
+    async def Query(self, fqdn, qtype):
+        # RFC 8484 recommends id 0 so identical queries are cacheable
+        _, message = BuildQuery(fqdn, qtype, query_id=0)
+        question = (fqdn.rstrip(".").lower(), qtype)
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.append(future)
+        self.writer.write(
+            f"POST {self.path} HTTP/1.1\r\n"
+            f"Host: {self.authority}\r\n"
+            "Content-Type: application/dns-message\r\n"
+            "Accept: application/dns-message\r\n"
+            f"Content-Length: {len(message)}\r\n"
+            "\r\n".encode("ascii") + message
+        )
+        await self.writer.drain()
+
+        response = await future
+        if response["question"] != question:
+            raise DnsError("Response is for another question")
+        return response
+
+    async def Read(self):
+        try:
+            while True:
+                status, headers = await self.ReadHead()
+                body = await self.ReadBody(headers)
+
+                # A query that timed out still owns its place in the response order
+                future = self.waiting.popleft()
+                if not future.done():
+                    if status == 200:
+                        try:
+                            future.set_result(ParseResponse(body))
+                        except DnsError as ex:
+                            future.set_exception(ex)
+                    else:
+                        future.set_exception(DnsError(f"HTTP status {status}"))
+
+                if headers.get("connection", "").lower() == "close":
+                    raise DnsError("Server closed the connection")
+        except Exception as ex:
+            self.Fail(ex)
+
+    async def ReadHead(self):
+        line = (await self.reader.readline()).decode("latin-1")
+        if not line:
+            raise DnsError("Connection closed")
+        status = int(line.split()[1])
+
+        headers = {}
+        while True:
+            line = (await self.reader.readline()).decode("latin-1").strip()
+            if not line:
+                return status, headers
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+    async def ReadBody(self, headers):
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await self.reader.readline()
+                    return bytes(body)
+                body += await self.reader.readexactly(size)
+                await self.reader.readline()
+
+        return await self.reader.readexactly(int(headers.get("content-length", 0)))
+
+    def Fail(self, ex):
+        self.closed = True
+        while self.waiting:
+            future = self.waiting.popleft()
+            if not future.done():
+                future.set_exception(DnsError(f"Connection lost - {ex!r}"))
+
+    def Close(self):
+        self.closed = True
+        self.task.cancel()
+        self.writer.close()
+
+# A class to query DoT/DoH resolvers over connections kept open between queries
+# Connections live on one background event loop, so they outlive a probe run and can be
+# shared by the probe thread pool (Query) and asyncio probe loops (QueryAsync) alike. A
+# connection is opened on first use and reopened after it fails; the TCP connect and TLS
+# handshake are timed apart from the queries.
+class EncryptedClient:
+    def __init__(self, context):
+        self.context = context
+        self.connections = {}
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="dns-tls", daemon=True)
+        self.thread.start()
+
+    # A function to resolve fqdn from any thread
+    # Return the parsed response, the query time in seconds and the handshake time in seconds
+    # when this query had to open the connection (otherwise None)
+    def Query(self, server, fqdn, qtype=QTYPE_A, transport="dot", timeout=2.0):
+        future = asyncio.run_coroutine_threadsafe(self.Resolve(server, fqdn, qtype, transport, timeout), self.loop)
+        return future.result()
+
+    # A function to resolve fqdn from another event loop, as Query
+    async def QueryAsync(self, server, fqdn, qtype=QTYPE_A, transport="dot", timeout=2.0):
+        future = asyncio.run_coroutine_threadsafe(self.Resolve(server, fqdn, qtype, transport, timeout), self.loop)
+        return await asyncio.wrap_future(future)
+
+    async def Resolve(self, server, fqdn, qtype, transport, timeout):
+        key = (server, transport)
+        handshake = None
+
+        # Concurrent first queries wait for the same connection attempt
+        pending = self.connections.get(key)
+        if pending is None or (pending.done() and (pending.exception() is not None or pending.result()[0].closed)):
+            pending = self.loop.create_task(self.Connect(server, transport, timeout))
+            self.connections[key] = pending
+            connection, handshake = await pending
+        else:
+            connection, _ = await pending
+
+        start = time.perf_counter()
+        response = await asyncio.wait_for(connection.Query(fqdn, qtype), timeout)
+        return response, time.perf_counter() - start, handshake
+
+    async def Connect(self, server, transport, timeout):
+        transport, host, port, server_name, path = ParseEncryptedNameserver(server, transport)
+
+        start = time.perf_counter()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=self.context, server_hostname=server_name), timeout
+        )
+        handshake = time.perf_counter() - start
+
+        if transport == "doh":
+            authority = server_name if port == 443 else f"{server_name}:{port}"
+            return DohConnection(reader, writer, authority, path), handshake
+        return DotConnection(reader, writer), handshake
+
+    # A function to close every connection and stop the event loop
+    def Close(self):
+        async def CloseAll():
+            for pending in self.connections.values():
+                if pending.done() and pending.exception() is None:
+                    pending.result()[0].Close()
+
+        asyncio.run_coroutine_threadsafe(CloseAll(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
@@ -0,0 +1,185 @@
+#!/bin/python3
+
+# Import statements
+import sys
+import math
+import random
+import struct
+import argparse
+
+# Relative accuracy used when none is given, 1% of the true value
+DEFAULT_ALPHA = 0.01
+
+# Version byte at the start of a serialized sketch
+SKETCH_VERSION = 1
+
+# A class implementing a mergeable, log-bucketed latency sketch (DDSketch style)
+# Every positive value is counted in bucket ceil(log_gamma(value)) with
+# gamma = (1 + alpha) / (1 - alpha). Quantiles are answered with the bucket's
+# midpoint, so the estimate is within `alpha` relative error of the exact
+# nearest-rank percentile. Two sketches with the same alpha merge by adding
+# bucket counts, so hourly sketches can be combined into any window.
+class LatencySketch:
+    def __init__(self, alpha=DEFAULT_ALPHA):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.count = 0
+
+    # A function to record a value (values <= 0 are failures and are ignored)
+    def Add(self, value, count=1):
+        if value <= 0:
+            return
+
+        index = math.ceil(math.log(value) / self.log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += count
+
+    # A function to fold another sketch with the same accuracy into this one
+    def Merge(self, other):
+        if other.alpha != self.alpha:
+            raise ValueError(f"Cannot merge sketches with alpha {self.alpha} and {other.alpha}")
+
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+
+        return self
+
+    # A function to estimate the nearest-rank percentile, pct in 0-100
+    # Return 0.0 for an empty sketch, matching Percentile() on an empty list
+    def Quantile(self, pct):
+        if self.count == 0:
+            return 0.0
+
+        rank = max(1, math.ceil(self.count * pct / 100))
+        seen = 0
+
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    # A function to serialize the sketch to a compact blob
+    # Layout: version, alpha (float64), bucket count, then per bucket a zigzag
+    # varint delta of the index and a varint count
+    def ToBytes(self):
+        out = bytearray(struct.pack("<Bd", SKETCH_VERSION, self.alpha))
+        WriteVarint(out, len(self.buckets))
+
+        previous = 0
+        for index in sorted(self.buckets):
+            delta = index - previous
+            WriteVarint(out, (delta << 1) ^ (delta >> 63))
+            WriteVarint(out, self.buckets[index])
+            previous = index
+
+        return bytes(out)
+
+    # A function to rebuild a sketch from ToBytes() output
+    @classmethod
+    def FromBytes(cls, data):
+        version, alpha = struct.unpack_from("<Bd", data)
+        if version != SKETCH_VERSION:
+            raise ValueError(f"Unsupported sketch version {version}")
+
+        sketch = cls(alpha)
+        offset = struct.calcsize("<Bd")
+        length, offset = ReadVarint(data, offset)
+
+        index = 0
+        for _ in range(length):
+            zigzag, offset = ReadVarint(data, offset)
+            count, offset = ReadVarint(data, offset)
+            index += (zigzag >> 1) ^ -(zigzag & 1)
+            sketch.buckets[index] = count
+            sketch.count += count
+
+        return sketch
+
+# A function to append an unsigned LEB128 varint
+def WriteVarint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+# A function to read an unsigned LEB128 varint
+# Return the value and the offset just past it
+def ReadVarint(data, offset):
+    value = 0
+    shift = 0
+
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+# A function to return the exact nearest-rank percentile of a sorted list
+def ExactPercentile(values, pct):
+    rank = max(1, math.ceil(len(values) * pct / 100))
+    return values[rank - 1]
+
+# A function to return samplers of synthetic latencies in microseconds, by distribution name
+def SyntheticDistributions(rng):
+    return {
+        "lognormal": lambda: rng.lognormvariate(math.log(20000), 0.8),
+        "uniform": lambda: rng.uniform(500, 50000),
+        "bimodal": lambda: rng.gauss(2000, 300) if rng.random() < 0.9 else rng.gauss(250000, 40000),
+        "exponential": lambda: 1 + rng.expovariate(1 / 15000)
+    }
+
+# A function to build a sketch from `shards` sketches of the values, each serialized and merged
+# back in, so the result exercises merging and serialization
+def ShardedSketch(values, alpha=DEFAULT_ALPHA, shards=10):
+    merged = LatencySketch(alpha)
+    shard_size = len(values) // shards + 1
+    for start in range(0, len(values), shard_size):
+        shard = LatencySketch(alpha)
+        for value in values[start:start + shard_size]:
+            shard.Add(value)
+        merged.Merge(LatencySketch.FromBytes(shard.ToBytes()))
+    return merged
+
+# A function to check sketch percentiles against exact ones on synthetic latencies
+# Return False when every check passes
+def main():
+    parser = argparse.ArgumentParser(description="Check LatencySketch error bounds against exact percentiles")
+    parser.add_argument("--samples", type=int, default=100000, help="Synthetic latencies per distribution")
+    parser.add_argument("--alpha", type=float, default=DEFAULT_ALPHA, help="Relative accuracy to check")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+
+    failed = False
+
+    for name, draw in SyntheticDistributions(rng).items():
+        values = [max(1, draw()) for _ in range(args.samples)]
+        merged = ShardedSketch(values, args.alpha)
+
+        ordered = sorted(values)
+        size = len(merged.ToBytes())
+
+        for pct in (50, 90, 95, 99, 99.9):
+            exact = ExactPercentile(ordered, pct)
+            estimate = merged.Quantile(pct)
+            error = abs(estimate - exact) / exact
+            status = "ok" if error <= args.alpha + 1e-9 else "FAIL"
+            failed = failed or status == "FAIL"
+            print(f"{name:12} p{pct:<5} exact {exact:12.1f} sketch {estimate:12.1f} error {error:.4%} {status}")
+
+        print(f"{name:12} {merged.count} values in {len(merged.buckets)} buckets, {size} bytes")
+
+    return failed
+
+if __name__ == "__main__":
+    if main():
+        sys.exit(1)
+    sys.exit(0)
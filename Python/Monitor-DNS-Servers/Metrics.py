@@ -0,0 +1,214 @@
+#!/bin/python3
+
+# Import statements
+import os
+import re
+import math
+import threading
+import tempfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram bucket upper bounds for probe latency, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Metric families: name -> (type, help)
+FAMILIES = {
+    "dns_probe_duration_seconds": ("histogram", "Latency of successful DNS probe samples"),
+    "dns_probes_total": ("counter", "DNS probe samples by result"),
+    "dns_latency_anomalies_total": ("counter", "Probe medians flagged as anomalous against the pair baseline"),
+    "dns_latency_baseline_seconds": ("gauge", "EWMA baseline of the median probe latency per pair"),
+    "dns_tls_handshakes_total": ("counter", "DoT/DoH connections opened"),
+    "dns_tls_handshake_seconds": ("gauge", "TCP connect and TLS handshake time of the last DoT/DoH connection"),
+    "dns_runs_total": ("counter", "Probe runs by final status"),
+    "dns_run_duration_seconds": ("gauge", "Wall time of the last probe run"),
+    "dns_run_pairs": ("gauge", "FQDN x nameserver pairs probed in the last run"),
+    "dns_last_run_timestamp_seconds": ("gauge", "Epoch time the last run finished")
+}
+
+# One exposition line: name, optional {labels}, value
+SAMPLE_LINE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)$')
+LABEL_PAIR = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+# A function to escape a label value for the text exposition format
+def EscapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+# A function to undo EscapeLabel
+def UnescapeLabel(value):
+    return re.sub(r'\\(.)', lambda match: "\n" if match.group(1) == "n" else match.group(1), value)
+
+# A function to format a sample value the way Prometheus does
+def FormatValue(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+# A function to return the family a sample belongs to
+def FamilyOf(name):
+    if name in FAMILIES:
+        return name
+    return re.sub(r'_(bucket|sum|count)$', "", name)
+
+# A function to order samples the way histograms are exposed: per label set, the buckets by
+# bound, then _sum and _count
+def SampleOrder(item):
+    (name, labels), _ = item
+    le = dict(labels).get("le")
+    bound = math.inf if le == "+Inf" else float(le) if le else 0
+    suffix = ("_bucket", "_sum", "_count").index(name[len(FamilyOf(name)):]) if name not in FAMILIES else 0
+    return FamilyOf(name), tuple(pair for pair in labels if pair[0] != "le"), suffix, bound
+
+# A class to hold probe metrics in memory and render the Prometheus text format
+# Every sample is kept in one dict keyed by (sample name, label tuple), so a scrape only
+# formats what is already there and a previous textfile can be read straight back in.
+class ProbeMetrics:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    # A function to add to a sample
+    def Inc(self, name, labels, value=1):
+        key = (name, labels)
+        self.samples[key] = self.samples.get(key, 0) + value
+
+    # A function to record one probe pair; durations are the samples in milliseconds,
+    # where 0 marks a failed sample as returned by TestDNS
+    def ObservePair(self, resolver, target, durations):
+        pair = (("resolver", resolver), ("target", target))
+
+        with self.lock:
+            for duration in durations:
+                if duration <= 0:
+                    self.Inc("dns_probes_total", pair + (("result", "failure"),))
+                    continue
+
+                seconds = duration / 1000
+                self.Inc("dns_probes_total", pair + (("result", "success"),))
+                # Every bucket is touched so a series always exposes the full layout
+                for bound in self.buckets:
+                    self.Inc("dns_probe_duration_seconds_bucket", pair + (("le", FormatValue(bound)),), 1 if seconds <= bound else 0)
+                self.Inc("dns_probe_duration_seconds_bucket", pair + (("le", "+Inf"),))
+                self.Inc("dns_probe_duration_seconds_sum", pair, seconds)
+                self.Inc("dns_probe_duration_seconds_count", pair)
+
+    # A function to record a pair's latency baseline after it was scored
+    def ObserveBaseline(self, resolver, target, seconds, anomaly):
+        pair = (("resolver", resolver), ("target", target))
+
+        with self.lock:
+            # Touched at 0 too, so rate() sees the series before its first anomaly
+            self.Inc("dns_latency_anomalies_total", pair, 1 if anomaly else 0)
+            self.samples[("dns_latency_baseline_seconds", pair)] = seconds
+
+    # A function to record the DoT/DoH connections opened to a resolver; times are in ms
+    def ObserveHandshakes(self, resolver, times):
+        labels = (("resolver", resolver),)
+
+        with self.lock:
+            self.Inc("dns_tls_handshakes_total", labels, len(times))
+            self.samples[("dns_tls_handshake_seconds", labels)] = times[-1] / 1000
+
+    # A function to record a finished run
+    def ObserveRun(self, status, seconds, pairs, ts):
+        with self.lock:
+            self.Inc("dns_runs_total", (("status", status),))
+            self.samples[("dns_run_duration_seconds", ())] = seconds
+            self.samples[("dns_run_pairs", ())] = pairs
+            self.samples[("dns_last_run_timestamp_seconds", ())] = ts
+
+    # A function to render every sample in the text exposition format
+    def Render(self):
+        with self.lock:
+            samples = sorted(self.samples.items(), key=SampleOrder)
+
+        lines = []
+        family = None
+        for (name, labels), value in samples:
+            base = FamilyOf(name)
+
+            if base != family and base in FAMILIES:
+                family = base
+                kind, description = FAMILIES[base]
+                lines.append(f"# HELP {base} {description}")
+                lines.append(f"# TYPE {base} {kind}")
+
+            if labels:
+                rendered = ",".join(f'{key}="{EscapeLabel(label)}"' for key, label in labels)
+                lines.append(f"{name}{{{rendered}}} {FormatValue(value)}")
+            else:
+                lines.append(f"{name} {FormatValue(value)}")
+
+        return "\n".join(lines) + "\n"
+
+    # A function to atomically replace a node_exporter textfile collector file
+    # The file is written next to its destination and renamed over it, so a scrape never
+    # reads a partial file
+    def WriteTextfile(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".dns-metrics-", suffix=".tmp")
+
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.Render())
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+        except Exception:
+            os.unlink(temp_path)
+            raise
+
+    # A function to carry counters over from a textfile written by an earlier run
+    # Histogram layouts from other bucket settings are dropped so le labels stay consistent
+    def LoadTextfile(self, path):
+        if not os.path.exists(path):
+            return
+
+        bounds = {FormatValue(bound) for bound in self.buckets} | {"+Inf"}
+
+        with open(path, "r") as f:
+            for line in f:
+                match = SAMPLE_LINE.match(line.strip())
+                if line.startswith("#") or match is None:
+                    continue
+
+                name, labels, value = match.groups()
+                labels = tuple((key, UnescapeLabel(label)) for key, label in LABEL_PAIR.findall(labels or ""))
+
+                if name.endswith("_bucket") and dict(labels).get("le") not in bounds:
+                    continue
+
+                with self.lock:
+                    self.samples[(name, labels)] = float(value)
+
+# A class to serve ProbeMetrics on /metrics from a background thread
+class MetricsServer:
+    def __init__(self, metrics, address="127.0.0.1", port=9153):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = metrics.Render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # Scrapes are not worth a log line each
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True)
+
+    def Start(self):
+        self.thread.start()
+
+    def Stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,235 @@
+#!/bin/python3
+
+# Import statements
+import io
+import sys
+import csv
+import gzip
+import html
+import time
+import random
+import argparse
+from LatencySketch import ExactPercentile
+
+# Matrix cells (domains x nameservers) above which passing rows are collapsed into a summary
+DEFAULT_COLLAPSE_CELLS = 2000
+
+# Cell colors
+PASS_COLOR = "#ccffcc"
+FAIL_COLOR = "#ffcccc"
+SKIP_COLOR = "#eeeeee"
+ANOMALY_COLOR = "#ffeeaa"
+
+# A class to build an HTML report by appending to a single buffer
+# Every Write goes straight into an io.StringIO, so rendering is linear in the output size
+# instead of copying the whole document on each `html += ...`
+class ReportWriter:
+    def __init__(self):
+        self.out = io.StringIO()
+
+    # A function to append raw HTML
+    def Write(self, text):
+        self.out.write(text)
+
+    # A function to append escaped text wrapped in a tag
+    def Element(self, tag, text):
+        self.out.write(f"<{tag}>{html.escape(str(text))}</{tag}>")
+
+    # A function to open a table with a header row
+    def Table(self, headers):
+        self.out.write("<table border='1' cellpadding='5' cellspacing='0' style='border-collapse:collapse;'><tr>")
+        for header in headers:
+            self.Element("th", header)
+        self.out.write("</tr>")
+
+    # A function to append a row; cells are values or (value, background color) pairs
+    def Row(self, cells):
+        write = self.out.write
+        write("<tr>")
+        for cell in cells:
+            if isinstance(cell, tuple):
+                write(f"<td style='background-color:{cell[1]}'>{html.escape(str(cell[0]))}</td>")
+            else:
+                write(f"<td>{html.escape(str(cell))}</td>")
+        write("</tr>")
+
+    # A function to close the open table
+    def EndTable(self):
+        self.out.write("</table>")
+
+    def getvalue(self):
+        return self.out.getvalue()
+
+# A function to write rows as CSV straight into a gzip stream
+# Return the compressed bytes
+def CompressCsv(headers, rows):
+    buffer = io.BytesIO()
+
+    # mtime 0 keeps the output identical for identical input
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=6, mtime=0) as raw:
+        with io.TextIOWrapper(raw, encoding="utf-8", newline="") as text:
+            writer = csv.writer(text)
+            writer.writerow(headers)
+            writer.writerows(rows)
+
+    return buffer.getvalue()
+
+# A function to format one matrix cell of a run result
+# A None value is a pair that was not due this run (adaptive scheduling)
+# Return the text and its color
+def MatrixCell(result, nameserver):
+    status = result.get(nameserver, 0)
+    if status is None:
+        return "skipped", SKIP_COLOR
+
+    # A typed probe that resolved to the wrong answer set carries the reason
+    verdict = result.get(f"{nameserver}_answers")
+    if verdict is not None:
+        return verdict, FAIL_COLOR
+
+    p95 = result.get(f"{nameserver}_p95")
+    tail = f" (p95 {p95} ms)" if p95 is not None else ""
+    if result.get(f"{nameserver}_cold"):
+        tail += " (cold)"
+
+    baseline = result.get(f"{nameserver}_anomaly")
+    if baseline is not None:
+        return f"{status} ms{tail} (anomaly, baseline {baseline} ms)", ANOMALY_COLOR
+    return f"{status} ms{tail}", PASS_COLOR if status > 0 else FAIL_COLOR
+
+# A function to tell whether any cell of a run result was flagged as a latency anomaly
+def HasAnomaly(result, nameservers):
+    return any(f"{nameserver}_anomaly" in result for nameserver in nameservers)
+
+# A function to render the per-run FQDN x nameserver matrix
+# results are the RunCheck dicts (name, overall, per nameserver median ms and optional _p95,
+# _cold, _anomaly and _answers). Above collapse_cells cells only failing and anomalous rows
+# are listed and the other passing rows are folded into one summary row of per-nameserver
+# median and worst latency; collapse_cells 0 never collapses.
+# handshakes are the DoT/DoH connection setup times in ms per nameserver, listed below the table
+# Return the HTML and whether rows were collapsed
+def RenderRunReport(nameservers, results, collapse_cells=DEFAULT_COLLAPSE_CELLS, handshakes=None):
+    collapsed = 0 < collapse_cells < len(results) * len(nameservers)
+
+    report = ReportWriter()
+    report.Write("<html><body>")
+    report.Table(["FQDN", "Overall", *nameservers])
+
+    passing = []
+    for result in results:
+        if collapsed and result["overall"] == "PASS" and not HasAnomaly(result, nameservers):
+            passing.append(result)
+            continue
+
+        color = PASS_COLOR if result["overall"] == "PASS" else FAIL_COLOR
+        report.Row([result["name"], (result["overall"], color), *(MatrixCell(result, nameserver) for nameserver in nameservers)])
+
+    if passing:
+        cells = []
+        for nameserver in nameservers:
+            values = sorted(result[nameserver] for result in passing if result[nameserver] is not None)
+            if values:
+                cells.append((f"p50 {ExactPercentile(values, 50)} ms, max {values[-1]} ms", PASS_COLOR))
+            else:
+                cells.append(("skipped", SKIP_COLOR))
+        report.Row([f"{len(passing)} passing domains", ("PASS", PASS_COLOR), *cells])
+
+    report.EndTable()
+
+    if handshakes:
+        report.Write("<ul>")
+        for nameserver, times in handshakes.items():
+            report.Element("li", f"{nameserver}: {len(times)} TLS connection(s) opened, avg handshake {round(sum(times) / len(times), 2)} ms (not included in the query times)")
+        report.Write("</ul>")
+
+    anomalies = sum(f"{nameserver}_anomaly" in result for result in results for nameserver in nameservers)
+    if anomalies:
+        report.Element("p", f"{anomalies} latency anomalies against the per-pair baselines.")
+
+    if collapsed:
+        report.Element("p", f"{len(results)} domains x {len(nameservers)} nameservers; passing rows are summarized, the full matrix is attached as CSV.")
+
+    report.Write("</body></html>")
+
+    return report.getvalue(), collapsed
+
+# A function to compress the full run matrix, one row per FQDN
+def RunMatrixCsv(nameservers, results):
+    headers = ["fqdn", "overall"]
+    for nameserver in nameservers:
+        headers += [f"{nameserver} ms", f"{nameserver} p95 ms", f"{nameserver} anomaly baseline ms"]
+
+    def Rows():
+        for result in results:
+            row = [result["name"], result["overall"]]
+            for nameserver in nameservers:
+                status = result.get(nameserver, 0)
+                row += ["" if status is None else status, result.get(f"{nameserver}_p95", ""), result.get(f"{nameserver}_anomaly", "")]
+            yield row
+
+    return CompressCsv(headers, Rows())
+
+# A function to build synthetic run results for the benchmark
+def SyntheticResults(rng, domains, nameservers, fail_rate):
+    results = []
+    for index in range(domains):
+        result = {"name": f"host{index}.example.com", "overall": "PASS"}
+        for nameserver in nameservers:
+            if rng.random() < fail_rate:
+                result[nameserver] = 0.0
+                result["overall"] = "FAIL"
+            else:
+                result[nameserver] = round(rng.lognormvariate(3, 0.6), 2)
+                result[f"{nameserver}_p95"] = round(result[nameserver] * 1.5, 2)
+        results.append(result)
+    return results
+
+# A function to render a run email the way RunCheck does and time it
+# Return the HTML, the CSV attachment (empty when not collapsed), and the render and
+# compression times in seconds
+def BenchmarkReport(nameservers, results, collapse_cells=DEFAULT_COLLAPSE_CELLS):
+    start = time.perf_counter()
+    body, collapsed = RenderRunReport(nameservers, results, collapse_cells)
+    render = time.perf_counter() - start
+
+    start = time.perf_counter()
+    attachment = RunMatrixCsv(nameservers, results) if collapsed else b""
+    compress = time.perf_counter() - start
+
+    return body, attachment, render, compress
+
+# A function to benchmark rendering across matrix sizes
+# Return False when time per cell stays within --max-ratio of the smallest size
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark run report rendering on synthetic matrices")
+    parser.add_argument("--nameservers", type=int, default=8, help="Nameservers per matrix")
+    parser.add_argument("--domains", type=int, nargs="+", default=[250, 2500, 25000], help="Domain counts to render")
+    parser.add_argument("--fail-rate", type=float, default=0.001, help="Probability of a failed cell")
+    parser.add_argument("--collapse-cells", type=int, default=DEFAULT_COLLAPSE_CELLS, help="Collapse threshold, 0 = never")
+    parser.add_argument("--max-ratio", type=float, default=3.0, help="Allowed growth of time per cell")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    nameservers = [f"10.0.0.{index + 1}" for index in range(args.nameservers)]
+    per_cell = []
+
+    for domains in args.domains:
+        results = SyntheticResults(rng, domains, nameservers, args.fail_rate)
+        cells = domains * len(nameservers)
+
+        body, attachment, render, compress = BenchmarkReport(nameservers, results, args.collapse_cells)
+
+        per_cell.append((render + compress) / cells)
+        print(f"{domains:7} domains {cells:8} cells  html {len(body):9} bytes  csv.gz {len(attachment):8} bytes  "
+              f"render {render * 1000:8.1f} ms  csv {compress * 1000:8.1f} ms  {per_cell[-1] * 1e6:.2f} us/cell")
+
+    ratio = max(per_cell) / per_cell[0]
+    print(f"time per cell grew {ratio:.2f}x from the smallest matrix")
+
+    return ratio > args.max_ratio
+
+if __name__ == "__main__":
+    if main():
+        sys.exit(1)
+    sys.exit(0)
@@ -5,105 +5,987 @@ import os
 import sys
 import json
 import socket
+import ssl
 import smtplib
 from email.message import EmailMessage
-from email.utils import formataddr
+from email.utils import formataddr, getaddresses
+from email import message_from_bytes
 import argparse
 from datetime import datetime
 import sqlite3
-from datetime import timedelta
+import time
+import random
+import signal
+import threading
+import asyncio
+import zlib
+import hashlib
+import contextlib
+import multiprocessing
+import io
+import cProfile
+import pstats
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from LatencySketch import LatencySketch
+import DnsWire
+from Report import ReportWriter, RenderRunReport, RunMatrixCsv, CompressCsv, DEFAULT_COLLAPSE_CELLS
+from Metrics import ProbeMetrics, MetricsServer, DEFAULT_BUCKETS
+
+# Serialize log writes coming from probe worker threads
+LOG_LOCK = threading.Lock()
+
+# Phases of a run timed by PhaseTimer, each stored in runs.<phase>_us
+PHASES = ("config", "init", "probe", "persist", "digest", "render", "send", "compact")
+
+# Status codes stored in results.status
+STATUS_FAIL = 0
+STATUS_PASS = 1
+
+# Hourly rollup tables, keyed by the results dimension column they group on
+ROLLUP_TABLES = {
+    "target_id": "rollup_target_hourly",
+    "resolver_id": "rollup_resolver_hourly"
+}
+
+# Daily rollup tables, kept indefinitely once hourly rows are compacted away
+DAILY_ROLLUP_TABLES = {
+    "target_id": "rollup_target_daily",
+    "resolver_id": "rollup_resolver_daily"
+}
+
+# Latency sketch tables per bucket size
+SKETCH_TABLES = {
+    "hour": "sketch_hourly",
+    "day": "sketch_daily"
+}
+
+# Sketch target ids holding the per-resolver merge of all cached and all cold targets
+SKETCH_CACHED = 0
+SKETCH_COLD = -1
+
+# Cold (uncached) latency is stored under targets named with this prefix
+COLD_PREFIX = "cold:"
+
+# A configured name with this prefix is probed with a random label under the wildcard zone
+WILDCARD_PREFIX = "*."
+
+# A probe target named "fqdn/TYPE" (from general.records) queries that record type
+TYPE_SEPARATOR = "/"
+
+# Minimum answer TTL per (fqdn, nameserver) seen by the udp/tcp transports in this process
+ANSWER_TTLS = {}
+
+# Answer set fingerprint and records per (target, nameserver) of typed probes in this process
+ANSWER_SETS = {}
+
+# Client keeping DoT/DoH connections open across probes and runs, and the general.tls it uses
+ENCRYPTED = None
+ENCRYPTED_TLS = None
+
+# TLS connection setup times in ms per nameserver since they were last collected
+TLS_HANDSHAKES = {}
+
+# Outbox states; PENDING rows are retried until sent or out of attempts, SENDING rows are
+# claimed by one sender until their lease runs out
+OUTBOX_PENDING = "PENDING"
+OUTBOX_SENDING = "SENDING"
+OUTBOX_SENT = "SENT"
+OUTBOX_FAILED = "FAILED"
+
+# Background sender draining the outbox, started by main()
+OUTBOX = None
+
+# In-memory probe metrics, created by main() when general.metrics is set
+METRICS = None
+
+# Worker processes for sharded probing, kept across daemon rounds
+PROBE_POOL = None
+PROBE_POOL_WORKERS = 0
+
+# Aggregates of a set of results rows aliased `r`, in rollup table column order
+ROLLUP_AGGREGATES = f"""
+    COUNT(*),
+    SUM(CASE WHEN r.status = {STATUS_PASS} THEN 1 ELSE 0 END),
+    SUM(CASE WHEN r.status = {STATUS_FAIL} THEN 1 ELSE 0 END),
+    SUM(CASE WHEN r.latency_us > 0 THEN 1 ELSE 0 END),
+    COALESCE(SUM(CASE WHEN r.latency_us > 0 THEN r.latency_us END), 0),
+    MIN(CASE WHEN r.latency_us > 0 THEN r.latency_us END),
+    MAX(CASE WHEN r.latency_us > 0 THEN r.latency_us END)
+"""
+
+# Raw results of every pair, walked along the (resolver, target, ts) clustered key
+RESULTS_BY_PAIR = """
+    resolvers v CROSS JOIN targets t
+    CROSS JOIN results r ON r.resolver_id = v.id AND r.target_id = t.id
+"""
 
 # A function to write a log file
 def Log(message):
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     line = f"[{timestamp}] {message}"
 
-    # Print Log to Console
-    print(line)
+    with LOG_LOCK:
+        # Print Log to Console
+        print(line)
 
-    # Try to write log to file
-    try:
-        with open(LOG_PATH, "a") as f:
-            f.write(line + "\n")
-    except Exception as ex:
-        print(f"[{timestamp}] Failed to write log to {LOG_PATH}: {ex}")
+        # Try to write log to file
+        try:
+            with open(LOG_PATH, "a") as f:
+                f.write(line + "\n")
+        except Exception as ex:
+            print(f"[{timestamp}] Failed to write log to {LOG_PATH}: {ex}")
+
+# A function to create the tables and indexes
+def CreateSchema(c):
+    # Run timestamps are integer epoch seconds, phase timings integer microseconds
+    phase_columns = "".join(f",\n            {phase}_us INTEGER" for phase in PHASES)
+    c.execute(f"""
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts INTEGER NOT NULL,
+            status TEXT NOT NULL{phase_columns}
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_runs_ts ON runs(ts)")
 
-# A function to initialize database
-def InitDB():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    # Dimension tables so results only carry small integer ids
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS targets (
+            id INTEGER PRIMARY KEY,
+            fqdn TEXT NOT NULL UNIQUE
+        )
+    """)
 
     c.execute("""
-        CREATE TABLE IF NOT EXISTS runs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp TEXT NOT NULL,
-            status TEXT NOT NULL
+        CREATE TABLE IF NOT EXISTS resolvers (
+            id INTEGER PRIMARY KEY,
+            address TEXT NOT NULL UNIQUE
         )
     """)
-    
+
+    # One row per pair per run, clustered on (resolver, target, ts) for range scans
+    # Latencies are integer microseconds; latency_us is the median sample, 0 when failed,
+    # and the remaining latency columns describe the successful samples
     c.execute("""
         CREATE TABLE IF NOT EXISTS results (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            resolver_id INTEGER NOT NULL,
+            target_id INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
             run_id INTEGER NOT NULL,
-            fqdn TEXT NOT NULL,
-            nameserver TEXT NOT NULL,
-            result TEXT NOT NULL,
-            perf REAL NOT NULL,
-            FOREIGN KEY(run_id) REFERENCES runs(id)
+            status INTEGER NOT NULL,
+            latency_us INTEGER NOT NULL,
+            samples INTEGER NOT NULL,
+            failures INTEGER NOT NULL,
+            min_us INTEGER NOT NULL,
+            p95_us INTEGER NOT NULL,
+            p99_us INTEGER NOT NULL,
+            max_us INTEGER NOT NULL,
+            jitter_us INTEGER NOT NULL,
+            PRIMARY KEY(resolver_id, target_id, ts, run_id)
+        ) WITHOUT ROWID
+    """)
+
+    # Rollups keyed on epoch hour/day buckets (UTC)
+    for tables, bucket in ((ROLLUP_TABLES, "hour"), (DAILY_ROLLUP_TABLES, "day")):
+        for key, table in tables.items():
+            c.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    {bucket} INTEGER NOT NULL,
+                    {key} INTEGER NOT NULL,
+                    queries INTEGER NOT NULL,
+                    passes INTEGER NOT NULL,
+                    failures INTEGER NOT NULL,
+                    latency_count INTEGER NOT NULL,
+                    latency_sum_us INTEGER NOT NULL,
+                    latency_min_us INTEGER,
+                    latency_max_us INTEGER,
+                    PRIMARY KEY({bucket}, {key})
+                ) WITHOUT ROWID
+            """)
+
+    # Mergeable latency sketches of the successful samples per resolver/target/bucket,
+    # keyed target first so the per-resolver rows (target 0) read by digests are contiguous
+    for bucket, table in SKETCH_TABLES.items():
+        c.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                target_id INTEGER NOT NULL,
+                {bucket} INTEGER NOT NULL,
+                resolver_id INTEGER NOT NULL,
+                sketch BLOB NOT NULL,
+                PRIMARY KEY(target_id, {bucket}, resolver_id)
+            ) WITHOUT ROWID
+        """)
+
+    # Adaptive probe scheduling state per pair (daemon mode), see UpdateSchedule
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS schedule (
+            resolver_id INTEGER NOT NULL,
+            target_id INTEGER NOT NULL,
+            interval_s REAL NOT NULL,
+            next_due REAL NOT NULL,
+            expires REAL,
+            PRIMARY KEY(resolver_id, target_id)
+        ) WITHOUT ROWID
+    """)
+
+    # Streaming latency baseline per pair (EWMA mean and variance of the median), see ScoreBaseline.
+    # Adaptive scheduling and anomaly detection both read it
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS baselines (
+            resolver_id INTEGER NOT NULL,
+            target_id INTEGER NOT NULL,
+            mean_us REAL NOT NULL,
+            var_us REAL NOT NULL,
+            observations INTEGER NOT NULL,
+            PRIMARY KEY(resolver_id, target_id)
+        ) WITHOUT ROWID
+    """)
+
+    # One row per flagged latency anomaly, keyed on time for digest windows and retention
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS anomalies (
+            ts INTEGER NOT NULL,
+            resolver_id INTEGER NOT NULL,
+            target_id INTEGER NOT NULL,
+            latency_us INTEGER NOT NULL,
+            baseline_us INTEGER NOT NULL,
+            stddev_us INTEGER NOT NULL,
+            PRIMARY KEY(ts, resolver_id, target_id)
+        ) WITHOUT ROWID
+    """)
+
+    # Current answer set fingerprint per typed probe pair, and the one pinned on first sight
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS answers (
+            resolver_id INTEGER NOT NULL,
+            target_id INTEGER NOT NULL,
+            hash INTEGER NOT NULL,
+            pinned INTEGER,
+            since INTEGER NOT NULL,
+            PRIMARY KEY(resolver_id, target_id)
+        ) WITHOUT ROWID
+    """)
+
+    # Audit trail: every distinct answer set seen once, and every change of a pair's answers
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS answer_sets (
+            hash INTEGER PRIMARY KEY,
+            records TEXT NOT NULL
         )
     """)
 
-    conn.commit()
-    conn.close()
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS answer_changes (
+            resolver_id INTEGER NOT NULL,
+            target_id INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            old_hash INTEGER,
+            new_hash INTEGER NOT NULL,
+            PRIMARY KEY(resolver_id, target_id, ts)
+        ) WITHOUT ROWID
+    """)
 
-# A function to log a new run
-def StartRun():
-    conn = sqlite3.connect(DB_PATH)
+    # Notifications waiting for delivery; message is the serialized RFC 5322 email
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt INTEGER NOT NULL,
+            sent INTEGER,
+            last_error TEXT,
+            lease_until INTEGER,
+            message BLOB NOT NULL
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt)")
+
+# A function to convert a database from the original text schema in one transaction
+# runs.timestamp (local ISO) becomes epoch seconds, fqdn/nameserver strings move to
+# dimension tables, PASS/FAIL become status codes and ms become integer microseconds
+def MigrateLegacyDB(conn):
+    Log("Migrating database to the normalized schema")
     c = conn.cursor()
+    c.execute("BEGIN")
 
-    # Update any existing runs with status 'START' or unfinished status to 'INCOMPLETE'
-    c.execute("UPDATE runs SET status = 'INCOMPLETE' WHERE status = 'START'")
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    tables = {row[0] for row in c.fetchall()}
 
-    timestamp = datetime.now().isoformat()
-    c.execute("INSERT INTO runs (timestamp, status) VALUES (?, ?)", (timestamp, "START"))
-    run_id = c.lastrowid
+    c.execute("ALTER TABLE runs RENAME TO legacy_runs")
+    c.execute("ALTER TABLE results RENAME TO legacy_results")
+    c.execute("DROP INDEX IF EXISTS idx_runs_timestamp")
+    c.execute("DROP INDEX IF EXISTS idx_results_run_id")
 
-    conn.commit()
-    conn.close()
+    # Rollups are rebuilt from the migrated results
+    for table in ("rollup_fqdn_hourly", "rollup_ns_hourly", "rollup_fqdn_daily", "rollup_ns_daily"):
+        c.execute(f"DROP TABLE IF EXISTS {table}")
 
-    return run_id
+    CreateSchema(c)
 
-# A function to save the results
-def SaveResult(run_id, fqdn, nameserver, result, perf):
-    conn = sqlite3.connect(DB_PATH)
+    c.execute("""
+        INSERT INTO runs (id, ts, status)
+        SELECT id, CAST(strftime('%s', timestamp, 'utc') AS INTEGER), status
+        FROM legacy_runs
+    """)
+    c.execute("INSERT OR IGNORE INTO targets (fqdn) SELECT DISTINCT fqdn FROM legacy_results")
+    c.execute("INSERT OR IGNORE INTO resolvers (address) SELECT DISTINCT nameserver FROM legacy_results")
 
-    c = conn.cursor()
+    # Sample statistics only exist for databases written after sampling was added
+    if "result_stats" in tables:
+        stats_join = "LEFT JOIN result_stats s ON s.run_id = r.run_id AND s.fqdn = r.fqdn AND s.nameserver = r.nameserver"
+    else:
+        stats_join = "LEFT JOIN (SELECT NULL AS samples, NULL AS failures, NULL AS min_perf, NULL AS p95, NULL AS p99, NULL AS max_perf, NULL AS jitter) s ON 0"
+
+    c.execute(f"""
+        INSERT OR IGNORE INTO results
+        SELECT v.id, t.id, u.ts, r.run_id,
+               CASE WHEN r.result = 'PASS' THEN {STATUS_PASS} ELSE {STATUS_FAIL} END,
+               CAST(ROUND(r.perf * 1000) AS INTEGER),
+               COALESCE(s.samples, 1),
+               COALESCE(s.failures, CASE WHEN r.result = 'PASS' THEN 0 ELSE 1 END),
+               CAST(ROUND(COALESCE(s.min_perf, r.perf) * 1000) AS INTEGER),
+               CAST(ROUND(COALESCE(s.p95, r.perf) * 1000) AS INTEGER),
+               CAST(ROUND(COALESCE(s.p99, r.perf) * 1000) AS INTEGER),
+               CAST(ROUND(COALESCE(s.max_perf, r.perf) * 1000) AS INTEGER),
+               CAST(ROUND(COALESCE(s.jitter, 0) * 1000) AS INTEGER)
+        FROM legacy_results r
+        JOIN runs u ON u.id = r.run_id
+        JOIN targets t ON t.fqdn = r.fqdn
+        JOIN resolvers v ON v.address = r.nameserver
+        {stats_join}
+    """)
+    migrated = c.rowcount
 
-    c.execute(
-        "INSERT INTO results (run_id, fqdn, nameserver, result, perf) VALUES (?, ?, ?, ?, ?)",
-        (run_id, fqdn, nameserver, result, perf)
-    )
+    # The new key keeps one result per run, nameserver and domain, so repeats (a domain listed
+    # twice in the config) and results of runs that no longer exist are not carried over
+    c.execute("SELECT COUNT(*) FROM legacy_results")
+    dropped = c.fetchone()[0] - migrated
+    if dropped:
+        Log(f"Dropped {dropped} legacy results that repeat a run, nameserver and domain or belong to no run")
+    Log(f"Migrated {migrated} legacy results")
+
+    c.execute("DROP TABLE legacy_results")
+    c.execute("DROP TABLE legacy_runs")
+    c.execute("DROP TABLE IF EXISTS result_stats")
 
     conn.commit()
-    conn.close()
 
-# A function to finalize the run with the overall status
-def FinalizeRun(run_id, status):
+# A function to initialize database
+def InitDB():
     conn = sqlite3.connect(DB_PATH)
-
     c = conn.cursor()
 
-    c.execute("UPDATE runs SET status = ? WHERE id = ?", (status, run_id))
+    # Databases from before the normalized schema are converted in place
+    c.execute("PRAGMA table_info(results)")
+    if "fqdn" in [column[1] for column in c.fetchall()]:
+        MigrateLegacyDB(conn)
+
+    CreateSchema(c)
+
+    # Schedules written before the baseline was shared with anomaly detection kept their own
+    # copy of it; the copy seeds the pairs that have no shared baseline yet
+    c.execute("PRAGMA table_info(schedule)")
+    columns = [column[1] for column in c.fetchall()]
+    if "baseline_us" in columns:
+        c.execute("ALTER TABLE schedule RENAME TO legacy_schedule")
+        CreateSchema(c)
+        expires = "expires" if "expires" in columns else "NULL"
+        c.execute(f"INSERT INTO schedule SELECT resolver_id, target_id, interval_s, next_due, {expires} FROM legacy_schedule")
+        c.execute("INSERT OR IGNORE INTO baselines SELECT resolver_id, target_id, baseline_us, 0, 1 FROM legacy_schedule WHERE baseline_us > 0")
+        c.execute("DROP TABLE legacy_schedule")
+
+    # Runs written before phase timing lack its columns
+    c.execute("PRAGMA table_info(runs)")
+    columns = [column[1] for column in c.fetchall()]
+    for phase in PHASES:
+        if f"{phase}_us" not in columns:
+            c.execute(f"ALTER TABLE runs ADD COLUMN {phase}_us INTEGER")
+
+    # Outboxes written before senders claimed their messages lack the lease
+    c.execute("PRAGMA table_info(outbox)")
+    if "lease_until" not in [column[1] for column in c.fetchall()]:
+        c.execute("ALTER TABLE outbox ADD COLUMN lease_until INTEGER")
+
+    # Backfill rollups once for databases created before rollups existed
+    for key, table in ROLLUP_TABLES.items():
+        c.execute(f"SELECT 1 FROM {table} LIMIT 1")
+        if c.fetchone() is None:
+            c.execute("SELECT 1 FROM results LIMIT 1")
+            if c.fetchone() is not None:
+                Log(f"Backfilling {table} from existing results")
+                c.execute(f"""
+                    INSERT INTO {table}
+                    SELECT r.ts - r.ts % 3600, r.{key}, {ROLLUP_AGGREGATES}
+                    FROM results r
+                    GROUP BY 1, 2
+                """)
+
+    for key, table in DAILY_ROLLUP_TABLES.items():
+        c.execute(f"SELECT 1 FROM {table} LIMIT 1")
+        empty = c.fetchone() is None
+        c.execute(f"SELECT 1 FROM {ROLLUP_TABLES[key]} LIMIT 1")
+        if empty and c.fetchone() is not None:
+            Log(f"Backfilling {table} from {ROLLUP_TABLES[key]}")
+            c.execute(f"""
+                INSERT INTO {table}
+                SELECT hour - hour % 86400, {key}, SUM(queries), SUM(passes), SUM(failures),
+                       SUM(latency_count), SUM(latency_sum_us), MIN(latency_min_us), MAX(latency_max_us)
+                FROM {ROLLUP_TABLES[key]}
+                GROUP BY 1, 2
+            """)
+
+    # Seed sketches once from the stored medians, the individual samples were never kept
+    c.execute(f"SELECT 1 FROM {SKETCH_TABLES['hour']} LIMIT 1")
+    if c.fetchone() is None:
+        c.execute("SELECT 1 FROM results LIMIT 1")
+        if c.fetchone() is not None:
+            Log("Backfilling latency sketches from existing results")
+            for ts, rows in BackfillGroups(c):
+                UpdateSketches(conn, rows, ts)
 
     conn.commit()
     conn.close()
 
+# A function to yield existing results grouped per hour as (ts, [(resolver_id, target_id, [latency_us])])
+def BackfillGroups(c):
+    c.execute("SELECT ts - ts % 3600, resolver_id, target_id, latency_us FROM results WHERE latency_us > 0 ORDER BY 1")
+
+    hour, rows = None, []
+    for bucket, resolver_id, target_id, latency in c.fetchall():
+        if bucket != hour and rows:
+            yield hour, rows
+            rows = []
+        hour = bucket
+        rows.append((resolver_id, target_id, [latency]))
+
+    if rows:
+        yield hour, rows
+
+# A function to merge the successful samples of one run into the hourly and daily sketches
+# rows are (resolver_id, target_id, [latency_us, ...])
+def UpdateSketches(conn, rows, ts, cold_targets=frozenset()):
+    run_sketches = {}
+    for resolver_id, target_id, latencies in rows:
+        if not latencies:
+            continue
+
+        merge = SKETCH_COLD if target_id in cold_targets else SKETCH_CACHED
+        for key in ((resolver_id, target_id), (resolver_id, merge)):
+            sketch = run_sketches.setdefault(key, LatencySketch())
+            for latency in latencies:
+                sketch.Add(latency)
+
+    for bucket, table in SKETCH_TABLES.items():
+        value = ts - ts % (3600 if bucket == "hour" else 86400)
+        sketches = {key: LatencySketch().Merge(sketch) for key, sketch in run_sketches.items()}
+
+        # Sketches already stored for this bucket are merged in memory and written back
+        updates = []
+        for (resolver_id, target_id), sketch in sketches.items():
+            stored = conn.execute(
+                f"SELECT sketch FROM {table} WHERE target_id = ? AND {bucket} = ? AND resolver_id = ?",
+                (target_id, value, resolver_id)
+            ).fetchone()
+            if stored:
+                sketch.Merge(LatencySketch.FromBytes(stored[0]))
+            updates.append((target_id, value, resolver_id, sketch.ToBytes()))
+
+        conn.executemany(f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?, ?)", updates)
+
+# A function to make sure every value has a row in a dimension table
+# Return a dictionary of value -> id
+def LoadDimension(conn, table, column, values):
+    conn.executemany(f"INSERT OR IGNORE INTO {table} ({column}) VALUES (?)", [(value,) for value in values])
+    return {value: id for id, value in conn.execute(f"SELECT id, {column} FROM {table}")}
+
+# A function to fold the results rows of one run into the hourly and daily rollup tables
+def UpdateRollups(conn, rows, ts):
+    buckets = [(ROLLUP_TABLES, "hour", ts - ts % 3600), (DAILY_ROLLUP_TABLES, "day", ts - ts % 86400)]
+
+    # rows are results tuples, starting (resolver_id, target_id, ts, run_id, status, latency_us)
+    for index, key in ((1, "target_id"), (0, "resolver_id")):
+        totals = {}
+        for row in rows:
+            status, latency = row[4], row[5]
+            total = totals.setdefault(row[index], [0, 0, 0, 0, 0, None, None])
+            total[0] += 1
+            total[1] += status == STATUS_PASS
+            total[2] += status == STATUS_FAIL
+            if latency > 0:
+                total[3] += 1
+                total[4] += latency
+                total[5] = latency if total[5] is None else min(total[5], latency)
+                total[6] = latency if total[6] is None else max(total[6], latency)
+
+        for tables, bucket, value in buckets:
+            UpsertRollup(conn, tables[key], bucket, key, [(value, id, *total) for id, total in totals.items()])
+
+# A function to add aggregated rows to their buckets of a rollup table
+def UpsertRollup(conn, table, bucket, key, rows):
+    conn.executemany(f"""
+        INSERT INTO {table} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT({bucket}, {key}) DO UPDATE SET
+            queries = queries + excluded.queries,
+            passes = passes + excluded.passes,
+            failures = failures + excluded.failures,
+            latency_count = latency_count + excluded.latency_count,
+            latency_sum_us = latency_sum_us + excluded.latency_sum_us,
+            latency_min_us = COALESCE(MIN(latency_min_us, excluded.latency_min_us), latency_min_us, excluded.latency_min_us),
+            latency_max_us = COALESCE(MAX(latency_max_us, excluded.latency_max_us), latency_max_us, excluded.latency_max_us)
+    """, rows)
+
+# A function to return the epoch day at which hourly rollups stop being kept
+def HourlyCutoff(hourly_days):
+    cutoff = int(time.time()) - hourly_days * 86400
+    return cutoff - cutoff % 86400
+
+# A function to delete the rows whose key columns are returned by a select, in bounded batches
+# Each batch is its own transaction so probe runs are never blocked for long
+# Return True when every matching row has been deleted
+def DeleteInBatches(conn, table, key, select, params, batch_size, deadline):
+    while time.monotonic() < deadline:
+        with conn:
+            c = conn.execute(f"DELETE FROM {table} WHERE ({key}) IN ({select} LIMIT ?)", (*params, batch_size))
+
+        if c.rowcount < batch_size:
+            return True
+
+    return False
+
+# A function to apply the retention policy in general.retention
+# Raw results older than raw_days and hourly rollups/sketches older than hourly_days
+# are deleted, daily rollups/sketches are kept indefinitely. Work stops after max_seconds and
+# resumes on the next call.
+# Return True when the database is fully compacted
+def CompactDB(conn, retention):
+    raw_days = retention.get("raw_days", 0)
+    hourly_days = retention.get("hourly_days", 0)
+    batch_size = retention.get("batch_size", 5000)
+    deadline = time.monotonic() + retention.get("max_seconds", 2)
+
+    done = True
+
+    if raw_days > 0:
+        cutoff = int(time.time()) - raw_days * 86400
+
+        # Run rows themselves are kept, they are one small row per run and digests count them
+        key = "resolver_id, target_id, ts, run_id"
+        select = f"SELECT r.resolver_id, r.target_id, r.ts, r.run_id FROM {RESULTS_BY_PAIR} WHERE r.ts < ?"
+        done = DeleteInBatches(conn, "results", key, select, (cutoff,), batch_size, deadline)
+
+        # Delivered and abandoned notifications follow the raw results
+        select = f"SELECT id FROM outbox WHERE status IN ('{OUTBOX_SENT}', '{OUTBOX_FAILED}') AND created < ?"
+        done = done and DeleteInBatches(conn, "outbox", "id", select, (cutoff,), batch_size, deadline)
+
+        select = "SELECT ts, resolver_id, target_id FROM anomalies WHERE ts < ?"
+        done = done and DeleteInBatches(conn, "anomalies", "ts, resolver_id, target_id", select, (cutoff,), batch_size, deadline)
+
+    if hourly_days > 0:
+        cutoff = HourlyCutoff(hourly_days)
+
+        for key, table in ROLLUP_TABLES.items():
+            select = f"SELECT hour, {key} FROM {table} WHERE hour < ?"
+            done = done and DeleteInBatches(conn, table, f"hour, {key}", select, (cutoff,), batch_size, deadline)
+
+        # Walk the sketches target by target (including the per-resolver merges) along their primary key
+        key = "target_id, hour, resolver_id"
+        select = f"""
+            SELECT s.target_id, s.hour, s.resolver_id
+            FROM (SELECT {SKETCH_CACHED} AS id UNION ALL SELECT {SKETCH_COLD} UNION ALL SELECT id FROM targets) t
+            CROSS JOIN {SKETCH_TABLES['hour']} s
+            WHERE s.target_id = t.id AND s.hour < ?
+        """
+        done = done and DeleteInBatches(conn, SKETCH_TABLES["hour"], key, select, (cutoff,), batch_size, deadline)
+
+    if not done:
+        Log("Compaction paused at its time budget, continuing next run")
+
+    return done
+
+# A function to advance the adaptive schedule of the pairs in a run
+# rows are (resolver_id, target_id, status, latency_us, ttl, cold, baseline_us) of the
+# configured pairs, baseline_us being the pair's EWMA mean from `baselines` before this run
+# (None without one). A healthy pair's interval is multiplied by `backoff` up to
+# `max_interval`; a failure or a median above `regression_factor` times the baseline (and at
+# least `regression_min_ms` above it) snaps it back to `min_interval`. Cold probes are slower
+# by nature and are kept in their own series, so they never count as a regression.
+# With `ttl_aware` and an answer TTL the probes alternate: after a cached probe the next one
+# is due just after the answer expires from the resolver's cache (a cold lookup), after a
+# cold probe the next one is due before the fresh answer expires again.
+def UpdateSchedule(conn, rows, ts, policy):
+    min_interval = policy["min_interval"]
+    max_interval = policy.get("max_interval", 3600)
+    backoff = policy.get("backoff", 2.0)
+    regression = policy.get("regression_factor", 2.0)
+    min_delta_us = policy.get("regression_min_ms", 10) * 1000
+    margin = policy.get("ttl_margin_seconds", 1)
+
+    state = {
+        (resolver_id, target_id): interval
+        for resolver_id, target_id, interval in conn.execute("SELECT resolver_id, target_id, interval_s FROM schedule")
+    }
+
+    updates = []
+    for resolver_id, target_id, status, latency_us, ttl, cold, baseline in rows:
+        interval = state.get((resolver_id, target_id), min_interval)
+
+        if status == STATUS_FAIL:
+            interval = min_interval
+        elif not cold and baseline and latency_us > baseline * regression and latency_us - baseline >= min_delta_us:
+            interval = min_interval
+        else:
+            interval = min(max(interval, min_interval) * backoff, max_interval)
+
+        next_due = ts + interval
+        expires = None
+        if ttl is not None and policy.get("ttl_aware"):
+            expires = ts + ttl
+            if not cold:
+                next_due = min(next_due, expires + margin)
+            elif expires - margin > ts:
+                next_due = min(next_due, expires - margin)
+
+        updates.append((resolver_id, target_id, interval, next_due, expires))
+
+    conn.executemany("""
+        INSERT INTO schedule (resolver_id, target_id, interval_s, next_due, expires)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(resolver_id, target_id) DO UPDATE SET
+            interval_s = excluded.interval_s,
+            next_due = excluded.next_due,
+            expires = excluded.expires
+    """, updates)
+
+# A function to list the configured pairs whose adaptive interval has elapsed
+# Pairs without schedule state (new in the config) are always due. slack lets a pair due
+# shortly after `now` go in this round rather than waiting a whole extra round, except for
+# probes timed to a cache expiry, which wait until `margin` seconds after the answer expired.
+# Return the due pairs and the subset whose cached answer has expired (cold lookups)
+def DuePairs(conn, nameservers, fqdns, now, slack=0, margin=0):
+    state = {
+        (fqdn, address): (due, expires)
+        for fqdn, address, due, expires in conn.execute("""
+            SELECT t.fqdn, v.address, s.next_due, s.expires
+            FROM schedule s
+            JOIN targets t ON t.id = s.target_id
+            JOIN resolvers v ON v.id = s.resolver_id
+        """)
+    }
+
+    pairs = []
+    expired = set()
+    for fqdn in fqdns:
+        for nameserver in nameservers:
+            due, expires = state.get((fqdn, nameserver), (0, None))
+
+            if expires is not None and expires <= due:
+                if expires + margin > now:
+                    continue
+            elif due > now + slack:
+                continue
+
+            pairs.append((fqdn, nameserver))
+            if expires is not None and expires <= now:
+                expired.add((fqdn, nameserver))
+
+    return pairs, expired
+
+# A function to advance a pair's latency baseline by one median latency in O(1)
+# state is (mean_us, var_us, observations), or None for a pair without a baseline yet.
+# The mean and variance are exponentially weighted, `alpha` being the weight of the newest
+# value. Once the baseline has `min_samples` observations, a latency more than `threshold`
+# standard deviations and at least `min_delta_ms` above the mean is an anomaly. Anomalies
+# still move the baseline, so a lasting shift becomes the new normal after about 1 / alpha runs.
+# Return the new state and the standard deviation the latency was flagged against (None when not)
+def ScoreBaseline(state, latency_us, policy):
+    if state is None:
+        return (float(latency_us), 0.0, 1), None
+
+    mean, var, observations = state
+    alpha = policy.get("alpha", 0.1)
+    diff = latency_us - mean
+    stddev = var ** 0.5
+
+    flagged = None
+    if (observations >= policy.get("min_samples", 10)
+            and diff > policy.get("threshold", 4.0) * stddev
+            and diff >= policy.get("min_delta_ms", 5) * 1000):
+        flagged = stddev
+
+    increment = alpha * diff
+    return (mean + increment, (1 - alpha) * (var + diff * increment), observations + 1), flagged
+
+# A function to read the baseline state of every pair, keyed by (address, stored fqdn)
+def LoadBaselines(conn):
+    return {
+        (address, fqdn): (mean, var, observations)
+        for address, fqdn, mean, var, observations in conn.execute("""
+            SELECT v.address, t.fqdn, b.mean_us, b.var_us, b.observations
+            FROM baselines b
+            JOIN targets t ON t.id = b.target_id
+            JOIN resolvers v ON v.id = b.resolver_id
+        """)
+    }
+
+# A function to store new and changed answer sets of typed probe pairs
+# rows are (resolver_id, target_id, old_hash, hash, pinned, records); only these rows are
+# written, the records of an answer set once per distinct set
+def UpdateAnswers(conn, rows, ts):
+    conn.executemany("INSERT OR IGNORE INTO answer_sets VALUES (?, ?)", [
+        (hash, json.dumps(records)) for _, _, _, hash, _, records in rows
+    ])
+    conn.executemany("INSERT OR REPLACE INTO answer_changes VALUES (?, ?, ?, ?, ?)", [
+        (resolver_id, target_id, ts, old_hash, hash)
+        for resolver_id, target_id, old_hash, hash, _, _ in rows if old_hash != hash
+    ])
+    conn.executemany("""
+        INSERT INTO answers (resolver_id, target_id, hash, pinned, since) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(resolver_id, target_id) DO UPDATE SET
+            since = CASE WHEN hash = excluded.hash THEN since ELSE excluded.since END,
+            hash = excluded.hash,
+            pinned = excluded.pinned
+    """, [
+        (resolver_id, target_id, hash, pinned, ts)
+        for resolver_id, target_id, _, hash, pinned, _ in rows
+    ])
+
+# A function to read the answer state of every typed probe pair, keyed by (address, target)
+def LoadAnswers(conn):
+    return {
+        (address, fqdn): (hash, pinned)
+        for address, fqdn, hash, pinned in conn.execute("""
+            SELECT v.address, t.fqdn, a.hash, a.pinned
+            FROM answers a
+            JOIN targets t ON t.id = a.target_id
+            JOIN resolvers v ON v.id = a.resolver_id
+        """)
+    }
+
+# A class to time the phases of a run (see PHASES)
+# Time spent in a phase adds up over every `with timer.Phase(name)` block of that name; the
+# totals are written to the run's row once it is over.
+class PhaseTimer:
+    def __init__(self):
+        self.run_id = None
+        self.seconds = {}
+
+    @contextlib.contextmanager
+    def Phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0) + time.perf_counter() - start
+
+    # A function to log the phase timings and store them on the run
+    def Save(self, conn):
+        if self.run_id is None:
+            return
+
+        Log(f"Run {self.run_id} phases: " + ", ".join(f"{phase} {round(self.seconds[phase] * 1000, 1)} ms" for phase in PHASES if phase in self.seconds))
+
+        with conn:
+            conn.execute(
+                f"UPDATE runs SET {', '.join(f'{phase}_us = ?' for phase in PHASES)} WHERE id = ?",
+                (*(Microseconds(self.seconds[phase] * 1000) if phase in self.seconds else None for phase in PHASES), self.run_id)
+            )
+
+# A class to persist a single run over one database connection
+# Results are buffered in memory and written together with the final run status in a
+# single transaction, so a run costs two commits instead of one per probe. The START
+# row is committed up front: if the process dies before Finalize, the row is left as
+# START and the next run marks it INCOMPLETE.
+class RunWriter:
+    def __init__(self, db_path, conn=None, schedule=None, anomaly=None, records=None):
+        # A connection passed in (daemon mode) is reused and left open on Close
+        self.owns_conn = conn is None
+        # Adaptive scheduling policy; when set the schedule is advanced on Finalize
+        self.schedule = schedule
+        # Anomaly detection policy; when set every passing result is scored against its baseline
+        self.anomaly = anomaly
+        # Latency baselines per pair, kept for the schedule's regression check and for scoring
+        self.track_baselines = schedule is not None or anomaly is not None
+        self.baselines = {}
+        # Typed probe specs by target; when set answer sets are checked and tracked
+        self.records = records
+        self.answers = {}
+        self.conn = conn if conn is not None else sqlite3.connect(db_path)
+        self.run_id = None
+        self.ts = None
+        self.pending = []
+        self.pending_samples = []
+        self.pending_schedule = []
+        self.pending_anomalies = []
+        self.scored = set()
+        self.pending_answers = []
+        self.finalized = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.Close()
+        return False
+
+    # A function to log a new run
+    def Start(self):
+        with self.conn:
+            # Update any existing runs with status 'START' or unfinished status to 'INCOMPLETE'
+            self.conn.execute("UPDATE runs SET status = 'INCOMPLETE' WHERE status = 'START'")
+
+            self.ts = int(time.time())
+            c = self.conn.execute("INSERT INTO runs (ts, status) VALUES (?, ?)", (self.ts, "START"))
+            self.run_id = c.lastrowid
+
+        # The whole baseline state is read once, so scoring a result never touches the database
+        if self.track_baselines:
+            self.baselines = LoadBaselines(self.conn)
+        if self.records:
+            self.answers = LoadAnswers(self.conn)
+
+        return self.run_id
+
+    # A function to buffer a result and its sample statistics until the run is finalized
+    # perf, the stats and the durations are in milliseconds as returned by TestDNS/SummarizeSamples
+    # series is the target the result is stored under when it differs from the configured
+    # fqdn (cold lookups), ttl the answer TTL used by TTL-aware scheduling
+    # Return the baseline in milliseconds a passing result was flagged against, or None
+    def SaveResult(self, fqdn, nameserver, status, perf, stats, durations=(), series=None, ttl=None):
+        cold = series is not None
+        series = series or fqdn
+        self.pending_samples.append((nameserver, series, [Microseconds(duration) for duration in durations if duration > 0]))
+        self.pending.append((
+            nameserver, series, status, Microseconds(perf),
+            stats["samples"], stats["failures"],
+            Microseconds(stats["min"]), Microseconds(stats["p95"]), Microseconds(stats["p99"]),
+            Microseconds(stats["max"]), Microseconds(stats["jitter"])
+        ))
+
+        # Cached and cold lookups of a domain are separate series with their own baseline; the
+        # schedule compares the result with the baseline as it was before this run
+        state = self.baselines.get((nameserver, series))
+        self.pending_schedule.append((nameserver, fqdn, status, Microseconds(perf), ttl, cold, state[0] if state else None))
+
+        if not self.track_baselines or status != STATUS_PASS:
+            return None
+
+        self.baselines[(nameserver, series)], stddev = ScoreBaseline(state, Microseconds(perf), self.anomaly or {})
+        self.scored.add((nameserver, series))
+        if self.anomaly is None or stddev is None:
+            return None
+
+        self.pending_anomalies.append((nameserver, series, Microseconds(perf), int(round(state[0])), int(round(stddev))))
+        return round(state[0] / 1000, 2)
+
+    # A function to check the answer set of a typed probe against its spec
+    # answer is the (hash, records) pair from ANSWER_SETS. With `expect` the records must match
+    # that set; otherwise, unless `pin` is false, they must match the set pinned on first sight.
+    # A new or changed answer set is buffered for Finalize, an unchanged one costs nothing.
+    # Return why the answer set is wrong, or None when it is accepted
+    def CheckAnswers(self, fqdn, nameserver, answer):
+        spec = self.records[fqdn]
+        hash, records = answer
+        state = self.answers.get((nameserver, fqdn))
+        current, pinned = state if state is not None else (None, None)
+
+        if "expect" in spec:
+            pinned = None
+        elif spec.get("pin", True):
+            pinned = hash if pinned is None else pinned
+        else:
+            pinned = None
+
+        if state != (hash, pinned):
+            self.answers[(nameserver, fqdn)] = (hash, pinned)
+            self.pending_answers.append((nameserver, fqdn, current, hash, pinned, records))
+
+        if "expect" in spec and hash != spec["expect"]:
+            return "unexpected answer"
+        if pinned is not None and hash != pinned:
+            return "answer changed"
+        return None
+
+    # A function to write the buffered results and the overall status in one transaction
+    def Finalize(self, status):
+        with self.conn:
+            resolver_ids = LoadDimension(self.conn, "resolvers", "address", {row[0] for row in self.pending})
+            target_ids = LoadDimension(self.conn, "targets", "fqdn", {row[1] for row in self.pending} | {row[1] for row in self.pending_schedule})
+            cold_targets = {id for name, id in target_ids.items() if name.startswith(COLD_PREFIX)}
+
+            rows = [
+                (resolver_ids[row[0]], target_ids[row[1]], self.ts, self.run_id, *row[2:])
+                for row in self.pending
+            ]
+            self.conn.executemany("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            UpdateRollups(self.conn, rows, self.ts)
+            UpdateSketches(self.conn, [
+                (resolver_ids[nameserver], target_ids[fqdn], latencies)
+                for nameserver, fqdn, latencies in self.pending_samples
+            ], self.ts, cold_targets)
+            if self.schedule is not None:
+                UpdateSchedule(self.conn, [
+                    (resolver_ids[nameserver], target_ids[fqdn], *row)
+                    for nameserver, fqdn, *row in self.pending_schedule
+                ], self.ts, self.schedule)
+            if self.scored:
+                self.conn.executemany("INSERT OR REPLACE INTO baselines VALUES (?, ?, ?, ?, ?)", [
+                    (resolver_ids[nameserver], target_ids[fqdn], *self.baselines[(nameserver, fqdn)])
+                    for nameserver, fqdn in self.scored
+                ])
+            if self.pending_anomalies:
+                self.conn.executemany("INSERT OR REPLACE INTO anomalies VALUES (?, ?, ?, ?, ?, ?)", [
+                    (self.ts, resolver_ids[nameserver], target_ids[fqdn], *row)
+                    for nameserver, fqdn, *row in self.pending_anomalies
+                ])
+            if self.pending_answers:
+                UpdateAnswers(self.conn, [
+                    (resolver_ids[nameserver], target_ids[fqdn], *row)
+                    for nameserver, fqdn, *row in self.pending_answers
+                ], self.ts)
+            self.conn.execute("UPDATE runs SET status = ? WHERE id = ?", (status, self.run_id))
+
+        self.pending = []
+        self.pending_samples = []
+        self.pending_schedule = []
+        self.pending_anomalies = []
+        self.scored = set()
+        self.pending_answers = []
+        self.finalized = True
+
+    # A function to close the connection, marking an unfinished run as INCOMPLETE
+    def Close(self):
+        if self.conn is None:
+            return
+
+        if self.run_id is not None and not self.finalized:
+            Log(f"Run {self.run_id} did not finish, marking it INCOMPLETE")
+            try:
+                self.Finalize("INCOMPLETE")
+            except sqlite3.Error as ex:
+                # The buffered results are what failed to write; still close the run out
+                Log(f"Failed to save the results of run {self.run_id} - {ex}")
+                try:
+                    with self.conn:
+                        self.conn.execute("UPDATE runs SET status = 'INCOMPLETE' WHERE id = ?", (self.run_id,))
+                except sqlite3.Error as ex:
+                    Log(f"Failed to mark run {self.run_id} INCOMPLETE - {ex}")
+
+        if self.owns_conn:
+            self.conn.close()
+        self.conn = None
+
+# A function to convert a latency in milliseconds to integer microseconds
+def Microseconds(ms):
+    return int(round(ms * 1000))
+
 # A function to read JSON File
 # Return List of Nameservers, List of Domains to Check, and Email Settings
 def ReadJson(filepath="config.json"):
     if not os.path.exists(filepath):
         Log(f"JSON file '{filepath}' not found.")
-        return [], [], {}
+        return [], [], {}, {}
 
     Log(f"Reading JSON file - {filepath}")
 
@@ -113,10 +995,11 @@ def ReadJson(filepath="config.json"):
             Log(f"Loaded JSON file")
         except Exception as e:
             Log(f"Error reading JSON: {e}")
-            return [], [], {}
+            return [], [], {}, {}
 
-    nameservers = data.get("nameservers", [])
-    domains = data.get("domains", [])
+    # A nameserver or domain listed twice is kept once, so schedules and totals count it once
+    nameservers = list(dict.fromkeys(data.get("nameservers", [])))
+    domains = list(dict.fromkeys(data.get("domains", [])))
     email = data.get("email", {})
     
     # General Options
@@ -125,131 +1008,829 @@ def ReadJson(filepath="config.json"):
     return nameservers, domains, email, settings
 
 # A function that will test if a DNS Server is properly working
+# transport "system" times the host resolver after checking the nameserver is reachable,
+# "udp"/"tcp" send the query to the nameserver itself (see DnsWire) and only a NOERROR
+# answer with records counts as a pass
 # Return non-negative for no errors
-def TestDNS(nameserver, fqdn):
+def TestDNS(nameserver, fqdn, transport="system", timeout=3):
+    transport = ProbeTransport(nameserver, transport)
+
+    # getaddrinfo cannot ask for a record type, so typed probes always query directly
+    if transport != "system" or TYPE_SEPARATOR in fqdn:
+        return QueryNameserver(nameserver, fqdn, "udp" if transport == "system" else transport, timeout)
+
+    query = ProbeName(fqdn)
+
     try:
         family = socket.AF_INET6 if ':' in nameserver else socket.AF_INET
 
         with socket.socket(family, socket.SOCK_DGRAM) as s:
-            s.settimeout(3)
+            s.settimeout(timeout)
             s.connect((nameserver, 53))
 
         start = datetime.now()
-        socket.getaddrinfo(fqdn, None, family)
+        socket.getaddrinfo(query, None, family)
         end = datetime.now()
         duration = round((end - start).total_seconds() * 1000, 3)
 
-        Log(f"Successfully queried {fqdn} with server {nameserver} in {duration} ms")
+        Log(f"Successfully queried {query} with server {nameserver} in {duration} ms")
 
         return duration
     except Exception as ex:
-        Log(f"Failed to query {fqdn} with server {nameserver}")
+        Log(f"Failed to query {query} with server {nameserver}")
         return 0.0
 
-def SendEmail(email, subject, body):
+# A function to return the name to put on the wire for a configured fqdn
+# A wildcard entry (*.zone) gets a fresh random label, so no resolver can answer it from cache
+def ProbeName(fqdn):
+    fqdn = SplitTarget(fqdn)[0]
+    if fqdn.startswith(WILDCARD_PREFIX):
+        return f"{random.getrandbits(48):012x}{fqdn[1:]}"
+    return fqdn
+
+# A function to pick the transport for a nameserver
+# tls:// and https:// nameservers are always probed over DoT and DoH, others use general.transport
+def ProbeTransport(nameserver, transport):
+    if nameserver.startswith("tls://"):
+        return "dot"
+    if nameserver.startswith("https://"):
+        return "doh"
+    return transport
+
+# A function to tell whether any of the nameservers is probed over DoT or DoH
+def UsesTls(nameservers, transport):
+    return any(ProbeTransport(nameserver, transport) in ("dot", "doh") for nameserver in nameservers)
+
+# A function to set up the DoT/DoH client of this process for general.tls
+# The client and its open connections are kept until the TLS settings change
+def ConfigureTls(tls):
+    global ENCRYPTED, ENCRYPTED_TLS
+    tls = tls or {}
+
+    if ENCRYPTED is not None and ENCRYPTED_TLS == tls:
+        return ENCRYPTED
+
+    CloseEncryptedClient()
+
+    context = ssl.create_default_context(cafile=tls.get("ca_file") or None)
+    if not tls.get("verify", True):
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+
+    ENCRYPTED = DnsWire.EncryptedClient(context)
+    ENCRYPTED_TLS = tls
+    return ENCRYPTED
+
+# A function to close the DoT/DoH connections, if any were opened
+def CloseEncryptedClient():
+    global ENCRYPTED, ENCRYPTED_TLS
+
+    if ENCRYPTED is not None:
+        ENCRYPTED.Close()
+        ENCRYPTED = None
+        ENCRYPTED_TLS = None
+
+# A function to turn the result of an EncryptedClient query into a probe result
+# The handshake, when the query opened the connection, is kept in TLS_HANDSHAKES
+def ScoreEncrypted(nameserver, fqdn, result):
+    response, seconds, handshake = result
+
+    if handshake is not None:
+        handshake = round(handshake * 1000, 3)
+        TLS_HANDSHAKES.setdefault(nameserver, []).append(handshake)
+        Log(f"Opened a TLS connection to {nameserver} in {handshake} ms")
+
+    return ScoreResponse(nameserver, fqdn, response, round(seconds * 1000, 3))
+
+# A function to split a probe target into the name and the record type to query
+def SplitTarget(fqdn):
+    name, _, rtype = fqdn.partition(TYPE_SEPARATOR)
+    return name, DnsWire.QTYPES[rtype.upper()] if rtype else DnsWire.QTYPE_A
+
+# A function to reduce an answer set to a signed 64-bit integer, so comparing it against the
+# previous answer is one integer compare; the records are sorted, so their order does not count
+def AnswerHash(records):
+    digest = hashlib.blake2b("\n".join(sorted(set(records))).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+# A function to time one direct query against a nameserver
+# Return the duration in ms, 0.0 on failure
+def QueryNameserver(nameserver, fqdn, transport, timeout):
     try:
-        sender_name = email.get("from_name", "")
-        senderFrom = email.get("from")
-        recipientTo = email.get("to")
-        host = email.get("host")
-        port = email.get("port")
-        useSsl = email.get("ssl", False)
-        username = email.get("username", "") or ""
-        password = email.get("password", "") or ""
+        # Encrypted queries are timed without the connection setup
+        if transport in ("dot", "doh"):
+            client = ENCRYPTED or ConfigureTls(None)
+            return ScoreEncrypted(nameserver, fqdn, client.Query(nameserver, ProbeName(fqdn), SplitTarget(fqdn)[1], transport, timeout))
 
-        msg = EmailMessage()
-        # attach display name if provided
-        if sender_name:
-            msg["From"] = formataddr((sender_name, senderFrom))
-        else:
-            msg["From"] = senderFrom
+        host, port = DnsWire.ParseNameserver(nameserver)
 
-        msg["To"] = recipientTo
-        msg["Subject"] = subject
-        msg.set_content(body, subtype="html")
+        start = time.perf_counter()
+        response = DnsWire.Query(host, port, ProbeName(fqdn), SplitTarget(fqdn)[1], transport, timeout)
+        duration = round((time.perf_counter() - start) * 1000, 3)
 
-        if useSsl:
-            with smtplib.SMTP_SSL(host, port) as server:
-                if username or password:
-                    server.login(username, password)
-                server.send_message(msg)
-        else:
-            with smtplib.SMTP(host, port) as server:
-                server.starttls()
-                if username or password:
-                    server.login(username, password)
-                server.send_message(msg)
+        return ScoreResponse(nameserver, fqdn, response, duration)
+    except Exception as ex:
+        Log(f"Failed to query {fqdn} with server {nameserver} - {ex}")
+        return 0.0
+
+# A function to time one direct query from an event loop, as QueryNameserver
+# The system transport blocks in getaddrinfo, so it runs on the default thread pool
+async def QueryNameserverAsync(nameserver, fqdn, transport, timeout):
+    transport = ProbeTransport(nameserver, transport)
+    if transport == "system" and TYPE_SEPARATOR not in fqdn:
+        return await asyncio.to_thread(TestDNS, nameserver, fqdn, transport, timeout)
+    transport = "udp" if transport == "system" else transport
+
+    try:
+        if transport in ("dot", "doh"):
+            client = ENCRYPTED or ConfigureTls(None)
+            result = await client.QueryAsync(nameserver, ProbeName(fqdn), SplitTarget(fqdn)[1], transport, timeout)
+            return ScoreEncrypted(nameserver, fqdn, result)
+
+        host, port = DnsWire.ParseNameserver(nameserver)
+
+        start = time.perf_counter()
+        response = await DnsWire.QueryAsync(host, port, ProbeName(fqdn), SplitTarget(fqdn)[1], transport, timeout)
+        duration = round((time.perf_counter() - start) * 1000, 3)
+
+        return ScoreResponse(nameserver, fqdn, response, duration)
+    except Exception as ex:
+        Log(f"Failed to query {fqdn} with server {nameserver} - {ex!r}")
+        return 0.0
+
+# A function to turn a direct query response into a probe result
+# The smallest answer TTL is kept in ANSWER_TTLS for TTL-aware scheduling, and for typed
+# probes the fingerprint and records of the answers of the queried type in ANSWER_SETS
+# Return the duration in ms, 0.0 unless NOERROR with records
+def ScoreResponse(nameserver, fqdn, response, duration):
+    if response["rcode"] != DnsWire.RCODE_NOERROR or not response["answers"]:
+        Log(f"Failed to query {fqdn} with server {nameserver} - rcode {response['rcode']}, {len(response['answers'])} answers")
+        return 0.0
+
+    ANSWER_TTLS[(fqdn, nameserver)] = min(answer["ttl"] for answer in response["answers"])
+
+    if TYPE_SEPARATOR in fqdn:
+        qtype = SplitTarget(fqdn)[1]
+        records = sorted({answer["text"] for answer in response["answers"] if answer["type"] == qtype})
+        if not records:
+            Log(f"Failed to query {fqdn} with server {nameserver} - no records of the queried type")
+            return 0.0
+        ANSWER_SETS[(fqdn, nameserver)] = (AnswerHash(records), records)
+
+    Log(f"Successfully queried {fqdn} with server {nameserver} in {duration} ms")
+
+    return duration
+
+# A function to return the nearest-rank percentile of an already sorted list
+def Percentile(values, pct):
+    if not values:
+        return 0.0
+
+    rank = max(1, -(-len(values) * pct // 100))
+    return values[int(rank) - 1]
+
+# A function to summarize the samples taken for one FQDN/nameserver pair
+# Failed samples (0.0) are counted but excluded from the latency figures
+# Jitter is the mean absolute difference between consecutive successful samples
+def SummarizeSamples(samples):
+    passed = [sample for sample in samples if sample > 0]
+    ordered = sorted(passed)
+
+    jitter = 0.0
+    if len(passed) > 1:
+        jitter = sum(abs(b - a) for a, b in zip(passed, passed[1:])) / (len(passed) - 1)
+
+    return {
+        "samples": len(samples),
+        "failures": len(samples) - len(passed),
+        "min": ordered[0] if ordered else 0.0,
+        "p50": Percentile(ordered, 50),
+        "p95": Percentile(ordered, 95),
+        "p99": Percentile(ordered, 99),
+        "max": ordered[-1] if ordered else 0.0,
+        "jitter": round(jitter, 3)
+    }
+
+# A function to probe every FQDN against every nameserver
+# Runs serially when concurrency is 1, otherwise fans out over a thread pool with
+# at most `concurrency` probes in flight and at most `per_nameserver` per nameserver
+# Each pair is probed `samples` times, `spacing_ms` apart
+# Return a dictionary of (fqdn, nameserver) -> list of durations as returned by TestDNS
+def RunProbes(nameservers, fqdns, concurrency=1, per_nameserver=0, samples=1, spacing_ms=0, transport="system", timeout=3, pairs=None, tls=None):
+    # Interleave nameservers so per-nameserver limits rarely block a worker
+    if pairs is None:
+        pairs = [(fqdn, nameserver) for fqdn in fqdns for nameserver in nameservers]
+    samples = max(1, samples)
+
+    if UsesTls(nameservers, transport):
+        ConfigureTls(tls)
+
+    limits = {}
+    if concurrency > 1 and per_nameserver > 0:
+        limits = {nameserver: threading.BoundedSemaphore(per_nameserver) for nameserver in nameservers}
+
+    def Probe(pair):
+        fqdn, nameserver = pair
+        limit = limits.get(nameserver)
+        durations = []
+
+        for i in range(samples):
+            if i > 0 and spacing_ms > 0:
+                time.sleep(spacing_ms / 1000)
+
+            if limit is None:
+                durations.append(TestDNS(nameserver, fqdn, transport, timeout))
+            else:
+                with limit:
+                    durations.append(TestDNS(nameserver, fqdn, transport, timeout))
+
+        return durations
+
+    if concurrency <= 1:
+        return {pair: Probe(pair) for pair in pairs}
+
+    Log(f"Probing {len(pairs)} pairs x {samples} samples with concurrency {concurrency} (per nameserver: {per_nameserver or 'unlimited'})")
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(pairs) or 1)) as pool:
+        durations = pool.map(Probe, pairs)
+        return dict(zip(pairs, durations))
+
+# A function to pick the worker that owns a pair
+# crc32 rather than hash() so a pair maps to the same worker in every process and run
+def ShardOf(fqdn, nameserver, workers):
+    return zlib.crc32(f"{fqdn}\0{nameserver}".encode("utf-8")) % workers
+
+# A function to set up a probe worker process
+def InitProbeWorker(log_path):
+    global LOG_PATH
+    LOG_PATH = log_path
+
+    # The coordinator handles Ctrl+C/SIGTERM and shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+# A function to probe one shard of pairs in a worker process
+# Return {(fqdn, nameserver): [durations]} like RunProbes, the answer TTLs, the answer sets
+# and the TLS handshakes seen
+def ProbeShard(pairs, concurrency, per_nameserver, samples, spacing_ms, transport, timeout, tls=None):
+    if UsesTls({nameserver for _, nameserver in pairs}, transport):
+        ConfigureTls(tls)
+
+    durations = asyncio.run(ProbeShardAsync(pairs, concurrency, per_nameserver, samples, spacing_ms, transport, timeout))
+    ttls = {pair: ANSWER_TTLS.pop(pair) for pair in pairs if pair in ANSWER_TTLS}
+    answers = {pair: ANSWER_SETS.pop(pair) for pair in pairs if pair in ANSWER_SETS}
+    handshakes = {nameserver: TLS_HANDSHAKES.pop(nameserver) for nameserver in list(TLS_HANDSHAKES)}
+    return durations, ttls, answers, handshakes
+
+# A function to probe pairs on one event loop with the same limits and sampling as RunProbes
+async def ProbeShardAsync(pairs, concurrency, per_nameserver, samples, spacing_ms, transport, timeout):
+    limit = asyncio.Semaphore(max(1, concurrency))
+    limits = {}
+    if per_nameserver > 0:
+        limits = {nameserver: asyncio.Semaphore(per_nameserver) for _, nameserver in pairs}
+
+    async def Probe(pair):
+        fqdn, nameserver = pair
+        durations = []
+
+        for i in range(samples):
+            if i > 0 and spacing_ms > 0:
+                await asyncio.sleep(spacing_ms / 1000)
+
+            async with limits.get(nameserver, contextlib.nullcontext()):
+                async with limit:
+                    durations.append(await QueryNameserverAsync(nameserver, fqdn, transport, timeout))
+
+        return durations
+
+    durations = await asyncio.gather(*(Probe(pair) for pair in pairs))
+    return dict(zip(pairs, durations))
+
+# A function to return the worker pool for sharded probing, started on first use
+# Workers are spawned rather than forked so they never inherit the sender or metrics threads
+def GetProbePool(workers):
+    global PROBE_POOL, PROBE_POOL_WORKERS
+
+    if PROBE_POOL is not None and PROBE_POOL_WORKERS != workers:
+        ShutdownProbePool()
+
+    if PROBE_POOL is None:
+        context = multiprocessing.get_context("spawn")
+        PROBE_POOL = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=InitProbeWorker, initargs=(LOG_PATH,))
+        PROBE_POOL_WORKERS = workers
+
+    return PROBE_POOL
+
+# A function to stop the probe workers, if any were started
+def ShutdownProbePool():
+    global PROBE_POOL, PROBE_POOL_WORKERS
+
+    if PROBE_POOL is not None:
+        PROBE_POOL.shutdown(cancel_futures=True)
+        PROBE_POOL = None
+        PROBE_POOL_WORKERS = 0
+
+# A function to probe every FQDN x nameserver pair across worker processes
+# Pairs are hash-partitioned over `workers` processes, each running an asyncio probe loop
+# with an equal share of `concurrency`; per_nameserver applies within each worker.
+# Return {(fqdn, nameserver): [durations]} in the same shape as RunProbes
+def RunShardedProbes(nameservers, fqdns, workers, concurrency=1, per_nameserver=0, samples=1, spacing_ms=0, transport="system", timeout=3, pairs=None, tls=None):
+    if pairs is None:
+        pairs = [(fqdn, nameserver) for fqdn in fqdns for nameserver in nameservers]
+
+    shards = [[] for _ in range(workers)]
+    for fqdn, nameserver in pairs:
+        shards[ShardOf(fqdn, nameserver, workers)].append((fqdn, nameserver))
+
+    samples = max(1, samples)
+    share = max(1, concurrency // workers)
+
+    Log(f"Probing {sum(len(shard) for shard in shards)} pairs x {samples} samples across {workers} workers with concurrency {share} each (per nameserver: {per_nameserver or 'unlimited'})")
+
+    pool = GetProbePool(workers)
+    futures = [
+        pool.submit(ProbeShard, shard, share, per_nameserver, samples, spacing_ms, transport, timeout, tls)
+        for shard in shards if shard
+    ]
+
+    durations = {}
+    for future in futures:
+        shard_durations, ttls, answers, handshakes = future.result()
+        durations.update(shard_durations)
+        ANSWER_TTLS.update(ttls)
+        ANSWER_SETS.update(answers)
+        for nameserver, times in handshakes.items():
+            TLS_HANDSHAKES.setdefault(nameserver, []).extend(times)
+
+    # Keep the configured fqdn x nameserver order for the report
+    return {pair: durations[pair] for pair in pairs}
+
+# A function to build the HTML email for a report
+# attachments are (filename, bytes) pairs, sent as application/gzip
+def BuildMessage(email, subject, body, attachments=()):
+    sender_name = email.get("from_name", "")
+    senderFrom = email.get("from")
+    recipientTo = email.get("to")
+
+    msg = EmailMessage()
+    # attach display name if provided
+    if sender_name:
+        msg["From"] = formataddr((sender_name, senderFrom))
+    else:
+        msg["From"] = senderFrom
+
+    msg["To"] = recipientTo
+    msg["Subject"] = subject
+    msg.set_content(body, subtype="html")
+
+    for filename, data in attachments:
+        msg.add_attachment(data, maintype="application", subtype="gzip", filename=filename)
+
+    return msg
+
+# A function to queue an email in the outbox and wake the background sender
+# Delivery happens asynchronously, see OutboxSender
+# Return True when the message could not be queued
+def SendEmail(email, subject, body, attachments=()):
+    try:
+        message = BuildMessage(email, subject, body, attachments).as_bytes()
+        now = int(time.time())
+
+        conn = sqlite3.connect(DB_PATH)
+        try:
+            with conn:
+                c = conn.execute(
+                    "INSERT INTO outbox (created, status, next_attempt, message) VALUES (?, ?, ?, ?)",
+                    (now, OUTBOX_PENDING, now, message)
+                )
+        finally:
+            conn.close()
+
+        Log(f"Queued email {c.lastrowid} - {subject}")
+
+        if OUTBOX is not None:
+            OUTBOX.Notify(c.lastrowid)
 
         return False
     except Exception as ex:
-        Log(f"Error sending email - {ex}")
+        Log(f"Error queueing email - {ex}")
         return True
 
-# Function to prep a digest summary
-def SendDigestSummary(db_path, email, company, digest_minutes):
-    if digest_minutes <= 0:
-        return True
+# A class to deliver queued emails from the outbox on a background thread
+# One SMTP connection (with STARTTLS/login) is reused for every message and closed after
+# keepalive_seconds idle. A failed message is retried with exponential backoff starting at
+# backoff_seconds and is marked FAILED after max_attempts; messages left PENDING are picked
+# up again by the next process that opens the database. A message is claimed (SENDING) before
+# it is sent, so overlapping cron runs or a daemon next to cron never send it twice; a claim
+# left behind by a sender that died is released once its lease_seconds run out.
+class OutboxSender(threading.Thread):
+    def __init__(self, db_path, email):
+        super().__init__(name="outbox", daemon=True)
+        self.db_path = db_path
+        self.email = email
+        self.server = None
+        self.last_used = 0
+        self.reconnect = False
+        self.queued = set()
+        self.delivered = set()
+        self.failed = set()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+
+    # A function to apply new email settings, the open connection is dropped on change
+    def Configure(self, email):
+        with self.lock:
+            if email != self.email:
+                self.email = email
+                self.reconnect = True
+        self.wake.set()
+
+    # A function to register a message queued by this process and wake the thread
+    def Notify(self, message_id):
+        with self.lock:
+            self.queued.add(message_id)
+        self.wake.set()
+
+    # A function to stop the thread after one last delivery pass over due messages
+    def Stop(self, timeout=None):
+        self.stopping.set()
+        self.wake.set()
+        self.join(timeout)
+
+    # A function to list messages queued by this process that are still waiting for delivery
+    def Undelivered(self):
+        with self.lock:
+            return sorted(self.queued - self.delivered - self.failed)
+
+    # A function to list messages queued by this process that were given up on (FAILED)
+    def Failed(self):
+        with self.lock:
+            return sorted(self.queued & self.failed)
+
+    def run(self):
+        conn = sqlite3.connect(self.db_path)
 
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
+        try:
+            while True:
+                stopping = self.stopping.is_set()
+                self.wake.clear()
+
+                wait = self.Drain(conn)
+
+                if stopping:
+                    break
+
+                # Hang up once the connection has sat idle for keepalive_seconds
+                keepalive = self.email.get("keepalive_seconds", 30)
+                if self.server is not None:
+                    idle = time.monotonic() - self.last_used
+                    if idle >= keepalive:
+                        self.Disconnect()
+                    else:
+                        wait = min(wait, keepalive - idle)
+
+                self.wake.wait(wait)
+        finally:
+            self.Disconnect()
+            conn.close()
+
+    # A function to send every due message
+    # Return the seconds until the next retry is due
+    def Drain(self, conn):
+        # Nothing can be delivered until a configuration with a host is loaded
+        if not self.email.get("host"):
+            return 3600
+
+        lease = self.email.get("lease_seconds", 300)
+
+        # Messages claimed by a sender that stopped before finishing them are due again
+        with conn:
+            c = conn.execute(
+                "UPDATE outbox SET status = ?, lease_until = NULL WHERE status = ? AND lease_until <= ?",
+                (OUTBOX_PENDING, OUTBOX_SENDING, int(time.time()))
+            )
+        if c.rowcount:
+            Log(f"Released {c.rowcount} email(s) left claimed by another sender")
+
+        while True:
+            now = int(time.time())
+            row = conn.execute(
+                "SELECT id, attempts, message FROM outbox WHERE status = ? AND next_attempt <= ? ORDER BY id LIMIT 1",
+                (OUTBOX_PENDING, now)
+            ).fetchone()
+
+            if row is None:
+                break
+
+            message_id, attempts, message = row
+
+            # Another sender may have claimed the same row since the select
+            with conn:
+                c = conn.execute(
+                    "UPDATE outbox SET status = ?, lease_until = ? WHERE id = ? AND status = ?",
+                    (OUTBOX_SENDING, now + lease, message_id, OUTBOX_PENDING)
+                )
+            if c.rowcount != 1:
+                continue
+
+            try:
+                self.Deliver(message)
+            except Exception as ex:
+                self.Disconnect()
+                attempts += 1
+
+                if attempts >= self.email.get("max_attempts", 5):
+                    Log(f"Giving up on email {message_id} after {attempts} attempts - {ex}")
+                    status, next_attempt = OUTBOX_FAILED, now
+                else:
+                    backoff = min(self.email.get("backoff_seconds", 30) * 2 ** (attempts - 1), 3600)
+                    Log(f"Error sending email {message_id}, retrying in {backoff} seconds - {ex}")
+                    status, next_attempt = OUTBOX_PENDING, now + backoff
+
+                with conn:
+                    conn.execute(
+                        "UPDATE outbox SET status = ?, attempts = ?, next_attempt = ?, last_error = ?, lease_until = NULL WHERE id = ?",
+                        (status, attempts, next_attempt, str(ex), message_id)
+                    )
+                if status == OUTBOX_FAILED:
+                    with self.lock:
+                        self.failed.add(message_id)
+
+                # Leave the remaining messages for the retry rather than hammering a dead server
+                break
+
+            with conn:
+                conn.execute(
+                    "UPDATE outbox SET status = ?, attempts = ?, sent = ?, last_error = NULL, lease_until = NULL WHERE id = ?",
+                    (OUTBOX_SENT, attempts + 1, int(time.time()), message_id)
+                )
+
+            with self.lock:
+                self.delivered.add(message_id)
+            Log(f"Sent email {message_id}")
+
+        # Wake for the next retry, or for a claim held elsewhere to run out
+        row = conn.execute(
+            "SELECT MIN(CASE WHEN status = ? THEN next_attempt ELSE lease_until END) FROM outbox WHERE status IN (?, ?)",
+            (OUTBOX_PENDING, OUTBOX_PENDING, OUTBOX_SENDING)
+        ).fetchone()
+
+        if row[0] is None:
+            return 3600
+        return max(1, row[0] - time.time())
+
+    # A function to send one serialized message over the shared connection
+    # A connection that went stale while idle is reopened once before giving up
+    def Deliver(self, message):
+        msg = message_from_bytes(message)
+        sender = getaddresses([msg["From"]])[0][1]
+        recipients = [address for _, address in getaddresses(msg.get_all("To", []))]
+
+        with self.lock:
+            if self.reconnect:
+                self.reconnect = False
+                self.Disconnect()
+
+        reused = self.server is not None
+        if not reused:
+            self.Connect()
 
-    # Select runs from within the digest window
-    window = datetime.now() - timedelta(minutes=digest_minutes)
-    c.execute("SELECT id, timestamp, status FROM runs WHERE timestamp >= ?", (window.isoformat(),))
-    runs = c.fetchall()
-    if not runs:
-        Log("No recent runs found for digest window.")
-        return
+        try:
+            self.server.sendmail(sender, recipients, message)
+        except smtplib.SMTPServerDisconnected:
+            if not reused:
+                raise
+            self.Disconnect()
+            self.Connect()
+            self.server.sendmail(sender, recipients, message)
+
+        self.last_used = time.monotonic()
+
+    # A function to open and authenticate the SMTP connection
+    def Connect(self):
+        email = self.email
+        host = email.get("host")
+        port = email.get("port")
+        useSsl = email.get("ssl", False)
+        username = email.get("username", "") or ""
+        password = email.get("password", "") or ""
+        timeout = email.get("timeout_seconds", 30)
 
-    run_ids = [r[0] for r in runs]
-    placeholders = ",".join("?" * len(run_ids))
+        if useSsl:
+            server = smtplib.SMTP_SSL(host, port, timeout=timeout)
+        else:
+            server = smtplib.SMTP(host, port, timeout=timeout)
 
-    # Run statistics
-    total_runs = len(runs)
-    pass_count = sum(1 for r in runs if r[2] == "PASS")
-    fail_count = total_runs - pass_count
+        try:
+            if not useSsl and email.get("starttls", True):
+                server.starttls()
+            if username or password:
+                server.login(username, password)
+        except Exception:
+            server.close()
+            raise
 
-    c.execute(f"SELECT COUNT(*) FROM results WHERE run_id IN ({placeholders})", run_ids)
-    total_queries = c.fetchone()[0]
+        self.server = server
+        self.last_used = time.monotonic()
 
-    c.execute(f"SELECT COUNT(*) FROM results WHERE run_id IN ({placeholders}) AND result = 'FAIL'", run_ids)
-    total_failures = c.fetchone()[0]
+    # A function to close the SMTP connection if one is open
+    def Disconnect(self):
+        if self.server is None:
+            return
 
-    # Overall average resolution time
-    c.execute(f"SELECT ROUND(AVG(perf), 2) FROM results WHERE run_id IN ({placeholders}) AND perf > 0", run_ids)
-    avg_perf = c.fetchone()[0] or 0.0
+        try:
+            self.server.quit()
+        except Exception:
+            self.server.close()
+        self.server = None
+
+# A function to aggregate results per target or resolver over a digest window
+# Hours from `boundary` onward are read from the rollup table, [window, boundary) from raw results
+# With daily_start, [daily_start, boundary) is read from the daily rollups instead and only
+# [window, daily_start) from raw results, which retention may already have removed
+# All bounds are epoch seconds
+# Return a dictionary of id -> [queries, passes, failures, latency_count, latency_sum_us, latency_min_us, latency_max_us]
+def ReadRollup(c, key, window, boundary, daily_start=None):
+    totals = {}
+    raw_end = boundary
+    columns = "queries, passes, failures, latency_count, latency_sum_us, latency_min_us, latency_max_us"
+
+    # Whole days whose hourly rows have been compacted away come from the daily rollups
+    if daily_start:
+        c.execute(f"""
+            SELECT {key}, {columns}
+            FROM {DAILY_ROLLUP_TABLES[key]}
+            WHERE day >= ? AND day < ?
+        """, (daily_start, boundary))
+        rows = c.fetchall()
+        raw_end = daily_start
+    else:
+        rows = []
 
     c.execute(f"""
-        SELECT fqdn, 
-               SUM(CASE WHEN result = 'PASS' THEN 1 ELSE 0 END) AS pass_count,
-               SUM(CASE WHEN result = 'FAIL' THEN 1 ELSE 0 END) AS fail_count
-        FROM results
-        WHERE run_id IN ({placeholders})
-        GROUP BY fqdn
-        ORDER BY fail_count DESC
-        LIMIT 10
-    """, run_ids)
-    fqdn_rows = c.fetchall()
+        SELECT {key}, {columns}
+        FROM {ROLLUP_TABLES[key]}
+        WHERE hour >= ?
+    """, (boundary,))
+    rows += c.fetchall()
 
     c.execute(f"""
-        SELECT fqdn, ROUND(AVG(perf), 2) as avg_perf
-        FROM results
-        WHERE run_id IN ({placeholders}) AND perf > 0
-        GROUP BY fqdn
-        ORDER BY avg_perf DESC
-    """, run_ids)
-    perf_fqdn_rows = c.fetchall()
+        SELECT r.{key}, {ROLLUP_AGGREGATES}
+        FROM {RESULTS_BY_PAIR}
+        WHERE r.ts >= ? AND r.ts < ?
+        GROUP BY r.{key}
+    """, (window, raw_end))
+    rows += c.fetchall()
+
+    for id, queries, passes, failures, latency_count, latency_sum, latency_min, latency_max in rows:
+        total = totals.setdefault(id, [0, 0, 0, 0, 0, None, None])
+        total[0] += queries
+        total[1] += passes
+        total[2] += failures
+        total[3] += latency_count
+        total[4] += latency_sum
+        if latency_min is not None:
+            total[5] = latency_min if total[5] is None else min(total[5], latency_min)
+        if latency_max is not None:
+            total[6] = latency_max if total[6] is None else max(total[6], latency_max)
+
+    return totals
+
+# A function to merge the per-resolver latency sketches over a digest window
+# Hours from `start` (or `boundary` when daily_start is given) come from hourly sketches,
+# [daily_start, boundary) from daily sketches
+# target_id selects the cached (SKETCH_CACHED) or cold (SKETCH_COLD) merge
+# Return a dictionary of resolver_id -> LatencySketch
+def ReadSketches(c, start, boundary, daily_start=None, target_id=SKETCH_CACHED):
+    merged = {}
+
+    if daily_start:
+        c.execute(f"SELECT resolver_id, sketch FROM {SKETCH_TABLES['day']} WHERE target_id = ? AND day >= ? AND day < ?", (target_id, daily_start, boundary))
+        rows = c.fetchall()
+        start = boundary
+    else:
+        rows = []
 
-    c.execute(f"""
-        SELECT nameserver, ROUND(AVG(perf), 2) as avg_perf
-        FROM results
-        WHERE run_id IN ({placeholders}) AND perf > 0
-        GROUP BY nameserver
-        ORDER BY avg_perf DESC
-    """, run_ids)
-    perf_ns_rows = c.fetchall()
+    c.execute(f"SELECT resolver_id, sketch FROM {SKETCH_TABLES['hour']} WHERE target_id = ? AND hour >= ?", (target_id, start))
+    rows += c.fetchall()
 
-    conn.close()
+    for resolver_id, blob in rows:
+        merged.setdefault(resolver_id, LatencySketch()).Merge(LatencySketch.FromBytes(blob))
+
+    return merged
+
+# Function to prep a digest summary
+def SendDigestSummary(db_path, email, company, digest_minutes, hourly_days=0, settings=None):
+    if digest_minutes <= 0:
+        return True
+
+    # The connection is closed on every exit path, the early return included
+    with contextlib.closing(sqlite3.connect(db_path)) as conn:
+        c = conn.cursor()
+
+        # Whole hours of the window come from the rollups, the partial hour at its start
+        # from the raw results in it
+        window = int(time.time() - digest_minutes * 60)
+        boundary = window + (-window % 3600)
+
+        c.execute("SELECT status, COUNT(*) FROM runs WHERE ts >= ? GROUP BY status", (window,))
+        runs = dict(c.fetchall())
+        if not runs:
+            Log("No recent runs found for digest window.")
+            return
+
+        # Run statistics
+        total_runs = sum(runs.values())
+        pass_count = runs.get("PASS", 0)
+        fail_count = total_runs - pass_count
+
+        # Past the hourly retention, whole days come from the daily rollups
+        daily_start = None
+        if hourly_days > 0 and boundary < HourlyCutoff(hourly_days):
+            daily_start = window + (-window % 86400)
+            boundary = HourlyCutoff(hourly_days)
+
+        fqdns = dict(c.execute("SELECT id, fqdn FROM targets"))
+        nameservers = dict(c.execute("SELECT id, address FROM resolvers"))
+
+        fqdn_stats = ReadRollup(c, "target_id", window, boundary, daily_start)
+        ns_stats = ReadRollup(c, "resolver_id", window, boundary, daily_start)
+
+        total_queries = sum(row[0] for row in fqdn_stats.values())
+        total_failures = sum(row[2] for row in fqdn_stats.values())
+
+        # Overall average resolution time
+        latency_count = sum(row[3] for row in fqdn_stats.values())
+        avg_perf = round(sum(row[4] for row in fqdn_stats.values()) / latency_count / 1000, 2) if latency_count else 0.0
+
+        fqdn_rows = sorted(((fqdns[id], row[1], row[2]) for id, row in fqdn_stats.items()), key=lambda row: row[2], reverse=True)[:10]
+
+        perf_fqdn_rows = [(fqdns[id], round(row[4] / row[3] / 1000, 2)) for id, row in fqdn_stats.items() if row[3]]
+        perf_fqdn_rows.sort(key=lambda row: row[1], reverse=True)
+
+        # Tail latency per Nameserver, ranked by p95 as that is what the SLO is defined on
+        # Percentiles come from merging the per-resolver hourly (and, past the hourly
+        # retention, daily) sketches, so they cover whole hours from the start of the window
+        tails = ReadSketches(c, window - window % 3600, boundary, daily_start)
+
+        # Jitter is only kept per run, so it is averaged over the raw results still retained
+        c.execute(f"""
+            SELECT r.resolver_id, AVG(r.jitter_us)
+            FROM {RESULTS_BY_PAIR}
+            WHERE r.ts >= ? AND r.failures < r.samples
+            GROUP BY r.resolver_id
+        """, (window,))
+        jitters = dict(c.fetchall())
+
+        perf_ns_rows = []
+        for id, row in ns_stats.items():
+            sketch = tails.get(id, LatencySketch())
+            perf_ns_rows.append((
+                nameservers[id],
+                row[0],
+                row[2],
+                round(row[4] / row[3] / 1000, 2) if row[3] else 0.0,
+                round(sketch.Quantile(50) / 1000, 2),
+                round(sketch.Quantile(95) / 1000, 2),
+                round(sketch.Quantile(99) / 1000, 2),
+                round(sketch.Quantile(100) / 1000, 2),
+                round((jitters.get(id) or 0) / 1000, 2)
+            ))
+        perf_ns_rows.sort(key=lambda row: row[5], reverse=True)
+
+        # Cold lookups (cache-busting and post-expiry probes) against the cached percentiles
+        cold_tails = ReadSketches(c, window - window % 3600, boundary, daily_start, SKETCH_COLD)
+        cold_ns_rows = []
+        for id, sketch in cold_tails.items():
+            cached_p50 = tails[id].Quantile(50) if id in tails else 0
+            cold_ns_rows.append((
+                nameservers[id],
+                sketch.count,
+                round(cached_p50 / 1000, 2),
+                round(sketch.Quantile(50) / 1000, 2),
+                round(sketch.Quantile(95) / 1000, 2),
+                round(sketch.Quantile(99) / 1000, 2),
+                f"{sketch.Quantile(50) / cached_p50:.1f}x" if cached_p50 else "-"
+            ))
+        cold_ns_rows.sort(key=lambda row: row[4], reverse=True)
+
+        # Latency anomalies flagged in the window; the baseline shown is the one the worst
+        # latency of the pair was flagged against
+        c.execute("""
+            SELECT v.address, t.fqdn, COUNT(*), MAX(a.latency_us), a.baseline_us, a.stddev_us, MAX(a.ts)
+            FROM anomalies a
+            JOIN targets t ON t.id = a.target_id
+            JOIN resolvers v ON v.id = a.resolver_id
+            WHERE a.ts >= ?
+            GROUP BY a.resolver_id, a.target_id
+            ORDER BY 3 DESC, 4 DESC
+        """, (window,))
+        anomaly_rows = [
+            (address, fqdn, count, round(worst / 1000, 2), round(baseline / 1000, 2), round(stddev / 1000, 2),
+             datetime.fromtimestamp(last).strftime("%Y-%m-%d %H:%M"))
+            for address, fqdn, count, worst, baseline, stddev, last in c.fetchall()
+        ]
 
     digest_unit = "minutes"
     digest_value = digest_minutes
@@ -268,56 +1849,116 @@ def SendDigestSummary(db_path, email, company, digest_minutes):
     if (digest_value <= 1):
         digest_unit = digest_unit[:-1]
 
-    # Build digest HTML
-    html = "<html><body>"
-    html += f"<h2>DNS Digest Summary (Last {digest_value} {digest_unit})</h2>"
-    html += f"<h3>{company}</h3>"
-    html += "<ul>"
-    html += f"<li>Total Runs: {total_runs}</li>"
-    html += f"<li>Successful Runs: {pass_count}</li>"
-    html += f"<li>Failed Runs: {fail_count}</li>"
-    html += f"<li>Total Queries: {total_queries}</li>"
-    html += f"<li>Failures Detected: {total_failures}</li>"
-    html += f"<li>Average Resolution Time: {avg_perf} ms</li>"
-    html += "</ul>"
+    # Build digest HTML; beyond the collapse threshold only the slowest domains are listed
+    # and the full per-FQDN table is attached as CSV
+    settings = settings or {}
+    collapse_cells = settings.get("report_collapse_cells", DEFAULT_COLLAPSE_CELLS)
+    max_rows = settings.get("report_max_rows", 25)
+    collapsed = 0 < collapse_cells < len(perf_fqdn_rows) * max(1, len(nameservers))
+
+    report = ReportWriter()
+    report.Write("<html><body>")
+    report.Element("h2", f"DNS Digest Summary (Last {digest_value} {digest_unit})")
+    report.Element("h3", company)
+    report.Write("<ul>")
+    report.Element("li", f"Total Runs: {total_runs}")
+    report.Element("li", f"Successful Runs: {pass_count}")
+    report.Element("li", f"Failed Runs: {fail_count}")
+    report.Element("li", f"Total Queries: {total_queries}")
+    report.Element("li", f"Failures Detected: {total_failures}")
+    report.Element("li", f"Average Resolution Time: {avg_perf} ms")
+    report.Element("li", f"Latency Anomalies: {sum(row[2] for row in anomaly_rows)}")
+    report.Write("</ul>")
 
     # Quantitative Measurements of pass/fail
-    html += "<h3>Top Failing Domains</h3>"
-    html += "<table border='1' cellpadding='5' cellspacing='0'><tr><th>FQDN</th><th>Passes</th><th>Fails</th></tr>"
-    for fqdn, passes, fails in fqdn_rows:
-        html += f"<tr><td>{fqdn}</td><td>{passes}</td><td>{fails}</td></tr>"
-    html += "</table></body></html>"
+    report.Element("h3", "Top Failing Domains")
+    report.Table(["FQDN", "Passes", "Fails"])
+    for row in fqdn_rows:
+        report.Row(row)
+    report.EndTable()
 
     # Average performance per FQDN
-    html += "<h3>Average Resolution Time per FQDN</h3>"
-    html += "<table border='1' cellpadding='5' cellspacing='0'><tr><th>FQDN</th><th>Avg Time (ms)</th></tr>"
-    for fqdn, avg in perf_fqdn_rows:
-        html += f"<tr><td>{fqdn}</td><td>{avg}</td></tr>"
-    html += "</table>"
-
-    # Average performance per Nameserver
-    html += "<h3>Average Resolution Time per Nameserver</h3>"
-    html += "<table border='1' cellpadding='5' cellspacing='0'><tr><th>Nameserver</th><th>Avg Time (ms)</th></tr>"
-    for ns, avg in perf_ns_rows:
-        html += f"<tr><td>{ns}</td><td>{avg}</td></tr>"
-    html += "</table>"
-
+    if collapsed:
+        report.Element("h3", f"Slowest {max_rows} of {len(perf_fqdn_rows)} FQDNs (full table attached)")
+    else:
+        report.Element("h3", "Average Resolution Time per FQDN")
+    report.Table(["FQDN", "Avg Time (ms)"])
+    for row in perf_fqdn_rows[:max_rows] if collapsed else perf_fqdn_rows:
+        report.Row(row)
+    report.EndTable()
+
+    # Tail performance per Nameserver
+    report.Element("h3", "Resolution Time per Nameserver (ranked by p95)")
+    report.Table(["Nameserver", "Queries", "Fails", "Avg (ms)", "p50 (ms)", "p95 (ms)", "p99 (ms)", "Max (ms)", "Avg Jitter (ms)"])
+    for row in perf_ns_rows:
+        report.Row(row)
+    report.EndTable()
+
+    if cold_ns_rows:
+        report.Element("h3", "Cached vs Cold Resolution per Nameserver (ranked by cold p95)")
+        report.Table(["Nameserver", "Cold Samples", "Cached p50 (ms)", "Cold p50 (ms)", "Cold p95 (ms)", "Cold p99 (ms)", "Cold / Cached p50"])
+        for row in cold_ns_rows:
+            report.Row(row)
+        report.EndTable()
+
+    if anomaly_rows:
+        report.Element("h3", "Latency Anomalies per Pair (against the pair's EWMA baseline)")
+        report.Table(["Nameserver", "FQDN", "Anomalies", "Worst (ms)", "Baseline (ms)", "Std Dev (ms)", "Last Seen"])
+        for row in anomaly_rows[:max_rows]:
+            report.Row(row)
+        report.EndTable()
+    report.Write("</body></html>")
+
+    attachments = []
+    if collapsed:
+        rows = ((fqdns[id], row[0], row[1], row[2], round(row[4] / row[3] / 1000, 2) if row[3] else "") for id, row in fqdn_stats.items())
+        attachments.append(("dns-digest-fqdn.csv.gz", CompressCsv(["fqdn", "queries", "passes", "failures", "avg ms"], rows)))
 
     subject = f"[Digest] DNS Summary - {company} - Last {digest_value} {digest_unit}"
 
     Log("Sending digest summary email...")
 
-    return SendEmail(email, subject, html)
-
-# The main function as script is to be ran as a program
+    return SendEmail(email, subject, report.getvalue(), attachments)
+
+# A function to add a wildcard entry for every zone in general.cold.zones and a typed
+# "fqdn/TYPE" entry for every spec in general.records (or the already read specs) to the domains
+# A target listed more than once is kept once, in first-seen order
+def ProbeTargets(fqdns, settings, records=None):
+    zones = settings.get("cold", {}).get("zones", [])
+    records = RecordSpecs(settings) if records is None else records
+    return list(dict.fromkeys(list(fqdns) + [WILDCARD_PREFIX + zone.strip(".") for zone in zones] + list(records)))
+
+# A function to read the typed probe specs in general.records
+# Return {"fqdn/TYPE": spec}, where an expected answer set is replaced by its fingerprint
+def RecordSpecs(settings):
+    specs = {}
+
+    for record in settings.get("records", []):
+        rtype = str(record.get("type", "A")).upper()
+        if rtype not in DnsWire.QTYPES or not record.get("name"):
+            Log(f"Skipping record probe {record} - needs a name and one of {', '.join(DnsWire.QTYPES)}")
+            continue
+
+        spec = {"pin": record.get("pin", True)}
+        if "expect" in record:
+            try:
+                spec["expect"] = AnswerHash(DnsWire.NormalizeRdata(DnsWire.QTYPES[rtype], value) for value in record["expect"])
+            except (ValueError, OSError) as ex:
+                Log(f"Skipping record probe {record} - bad expected record ({ex})")
+                continue
+
+        specs[f"{record['name'].strip('.')}{TYPE_SEPARATOR}{rtype}"] = spec
+
+    return specs
+
+# A function to run one round of checks, persist it and send the run email
+# conn is an open database connection to reuse, digest sends the digest after the run
+# pairs limits the run to those (fqdn, nameserver) pairs, schedule is the adaptive policy and
+# cold_pairs the pairs whose cached answer has expired, stored as cold lookups, and timer the
+# PhaseTimer the run's phases are added to (its run_id is set once the run is started)
 # Return False/0 for successful run
-def main():
-    nameservers, fqdns, email, settings = ReadJson(JSON_PATH)
-
-    # Initialize the database
-    InitDB()
-    run_id = StartRun()
-
+def RunCheck(nameservers, fqdns, email, settings, conn=None, digest=False, pairs=None, schedule=None, cold_pairs=frozenset(), timer=None):
+    timer = timer or PhaseTimer()
     company = email.get("from_name", "")
 
     if company in (None, ""):
@@ -325,74 +1966,145 @@ def main():
     else:
         subject = f"[SUCCESS] - {company} - DNS Server Check"
 
-    if nameservers in (None, [], {}):
-        Log("No nameservers found in configuration.")
-        return True
-    
-    if fqdns in (None, [], {}):
-        Log("No domains found in configuration.")
-        return True
-    
     results = []
     fail = False
+    anomalies = 0
+    run_start = time.monotonic()
 
-    for fqdn in fqdns:
-        result = {
-            "name": fqdn,
-            "overall": "PASS"
-        }
+    records = RecordSpecs(settings)
 
-        for nameserver in nameservers:
-            result[nameserver] = TestDNS(nameserver, fqdn)
+    with RunWriter(DB_PATH, conn, schedule, settings.get("anomaly"), records) as writer:
+        timer.run_id = writer.Start()
 
-            if result[nameserver] <= 0:
-                SaveResult(run_id, fqdn, nameserver, "FAIL", 0)
-                fail = True
-                result["overall"] = "FAIL"
-                result[nameserver] = 0.0
+        if nameservers in (None, [], {}):
+            Log("No nameservers found in configuration.")
+            return True
+        
+        if fqdns in (None, [], {}):
+            Log("No domains found in configuration.")
+            return True
+
+        # Cache-busting probes of the configured wildcard zones run alongside the domains
+        # A nameserver or domain listed twice is probed and stored once per run
+        nameservers = list(dict.fromkeys(nameservers))
+        fqdns = ProbeTargets(fqdns, settings, records)
+        if pairs is not None:
+            pairs = list(dict.fromkeys(pairs))
+
+        # Probe all (or the given) pairs, concurrently when configured
+        concurrency = CONCURRENCY or settings.get("concurrency", 1)
+        per_nameserver = settings.get("nameserver_concurrency", 0)
+        samples = settings.get("samples", 1)
+        spacing_ms = settings.get("sample_spacing_ms", 0)
+        transport = settings.get("transport", "system")
+        timeout = settings.get("timeout_ms", 3000) / 1000
+        workers = WORKERS or settings.get("workers", 1)
+        with timer.Phase("probe"):
+            if workers > 1:
+                durations = RunShardedProbes(nameservers, fqdns, workers, concurrency, per_nameserver, samples, spacing_ms, transport, timeout, pairs, settings.get("tls"))
             else:
-                SaveResult(run_id, fqdn, nameserver, "PASS", result[nameserver])
+                durations = RunProbes(nameservers, fqdns, concurrency, per_nameserver, samples, spacing_ms, transport, timeout, pairs, settings.get("tls"))
+
+        # Connection setup is timed apart from the queries, which only reuse the connections
+        handshakes = {nameserver: TLS_HANDSHAKES.pop(nameserver) for nameserver in nameservers if nameserver in TLS_HANDSHAKES}
+        for nameserver, times in handshakes.items():
+            Log(f"{len(times)} TLS connection(s) opened to {nameserver}, avg handshake {round(sum(times) / len(times), 3)} ms")
+
+        if METRICS is not None:
+            for (fqdn, nameserver), pair_durations in durations.items():
+                METRICS.ObservePair(nameserver, fqdn, pair_durations)
+            for nameserver, times in handshakes.items():
+                METRICS.ObserveHandshakes(nameserver, times)
+
+        for fqdn in fqdns:
+            # With adaptive scheduling only due pairs are probed; the rest show as skipped
+            if not any((fqdn, nameserver) in durations for nameserver in nameservers):
+                continue
+
+            result = {
+                "name": fqdn,
+                "overall": "PASS"
+            }
+
+            for nameserver in nameservers:
+                if (fqdn, nameserver) not in durations:
+                    result[nameserver] = None
+                    continue
+
+                # A pair passes only when every sample resolved; perf is the median sample
+                stats = SummarizeSamples(durations[(fqdn, nameserver)])
+                result[nameserver] = Percentile(sorted(durations[(fqdn, nameserver)]), 50)
+
+                # Wildcard probes and probes after a cache expiry are stored as cold lookups
+                series = None
+                if fqdn.startswith(WILDCARD_PREFIX) or (fqdn, nameserver) in cold_pairs:
+                    series = COLD_PREFIX + fqdn
+                    result[f"{nameserver}_cold"] = True
+                # A random label's TTL says nothing about when the next probe is cold
+                ttl = ANSWER_TTLS.pop((fqdn, nameserver), None)
+                if fqdn.startswith(WILDCARD_PREFIX):
+                    ttl = None
+
+                # A typed probe also fails when its answer set is not the expected or pinned one
+                answer = ANSWER_SETS.pop((fqdn, nameserver), None)
+                verdict = None
+                if fqdn in records and answer is not None and min(durations[(fqdn, nameserver)]) > 0:
+                    verdict = writer.CheckAnswers(fqdn, nameserver, answer)
+                    if verdict is not None:
+                        Log(f"{fqdn} on {nameserver}: {verdict} - {', '.join(answer[1])}")
+                        result[f"{nameserver}_answers"] = verdict
+
+                if min(durations[(fqdn, nameserver)]) <= 0 or verdict is not None:
+                    writer.SaveResult(fqdn, nameserver, STATUS_FAIL, 0, stats, durations[(fqdn, nameserver)], series, ttl)
+                    fail = True
+                    result["overall"] = "FAIL"
+                    result[nameserver] = 0.0
+                else:
+                    baseline = writer.SaveResult(fqdn, nameserver, STATUS_PASS, result[nameserver], stats, durations[(fqdn, nameserver)], series, ttl)
+                    if stats["samples"] > 1:
+                        result[f"{nameserver}_p95"] = stats["p95"]
+                    if baseline is not None:
+                        Log(f"Latency anomaly for {fqdn} on {nameserver}: {result[nameserver]} ms against a baseline of {baseline} ms")
+                        result[f"{nameserver}_anomaly"] = baseline
+                        anomalies += 1
+                    if METRICS is not None and writer.anomaly is not None:
+                        mean_us = writer.baselines[(nameserver, series or fqdn)][0]
+                        METRICS.ObserveBaseline(nameserver, series or fqdn, mean_us / 1000000, baseline is not None)
+            
+            results.append(result)
         
-        results.append(result)
-    
-    # Save the results to the SQLite Datbase
-    if fail:
-        # Finalize the run with a fail
-        Log("Finalizing the failed run in database")
-        FinalizeRun(run_id, "FAIL")
-        # Change the subject for the email
-        subject = f"[FAIL] - {company} - DNS Server Check"
-    else:
-        # Finalize the run with a pass
-        Log("Finalizing the successful run in database")
-        FinalizeRun(run_id, "PASS")
-
-    # Check if it is time to process a digest
-
-    # Build styled HTML table summarizing DNS check results
-    html = """<html><body><table border="1" cellpadding="5" cellspacing="0" style="border-collapse:collapse;"><tr><th>FQDN</th><th>Overall</th>"""
-
-    for nameserver in nameservers:
-        html += f"<th>{nameserver}</th>"
-
-    html += "</tr>"
-
-    for result in results:
-        overall_color = "#ccffcc" if result['overall'] == "PASS" else "#ffcccc"
-        html += f"<tr><td>{result['name']}</td><td style='background-color:{overall_color}'>{result['overall']}</td>"
+        # Save the results to the SQLite Datbase
+        if fail:
+            # Finalize the run with a fail
+            Log("Finalizing the failed run in database")
+            with timer.Phase("persist"):
+                writer.Finalize("FAIL")
+            # Change the subject for the email
+            subject = f"[FAIL] - {company} - DNS Server Check"
+        else:
+            # Finalize the run with a pass
+            Log("Finalizing the successful run in database")
+            with timer.Phase("persist"):
+                writer.Finalize("PASS")
+            if anomalies:
+                subject = f"[ANOMALY] - {company} - DNS Server Check"
 
-        for nameserver in nameservers:
-            status = result.get(nameserver, 0)
-            color = "#ccffcc" if status > 0 else "#ffcccc"
-            html += f"<td style='background-color:{color}'>{status} ms</td>"
+    if METRICS is not None:
+        METRICS.ObserveRun("FAIL" if fail else "PASS", time.monotonic() - run_start, len(durations), int(time.time()))
 
-        html += "</tr>"
+    # Check if it is time to process a digest
 
-    html += "</table></body></html>"
+    # Build styled HTML table summarizing DNS check results; large matrices only list the
+    # failing rows and carry the full matrix as a compressed CSV attachment
+    with timer.Phase("render"):
+        html, collapsed = RenderRunReport(nameservers, results, settings.get("report_collapse_cells", DEFAULT_COLLAPSE_CELLS), handshakes)
+        attachments = [("dns-matrix.csv.gz", RunMatrixCsv(nameservers, results))] if collapsed else []
 
-    if DIGEST:
+    if digest:
         Log("Requested a digest")
-        SendDigestSummary(DB_PATH, email, company, settings.get("digest_minutes", 60))
+        retention = settings.get("retention", {})
+        with timer.Phase("digest"):
+            SendDigestSummary(DB_PATH, email, company, settings.get("digest_minutes", 60), retention.get("hourly_days", 0), settings)
     else:
         Log("Skipping digest")
 
@@ -404,20 +2116,268 @@ def main():
             # Exit with 0
             return False
 
-    # Check if results passed
-    if not fail: 
+    # Check if results passed; latency anomalies are reported even when passes are not
+    if not fail and not anomalies:
         if not settings.get("send_pass", True):
             Log("Skip sending a pass email")
             return False
 
     # Send the HTML table via email
-    Log("Sending an email")
-    if SendEmail(email, subject, html):
-        Log("Failed to send an email")
+    Log("Queueing an email")
+    with timer.Phase("send"):
+        queue_failed = SendEmail(email, subject, html, attachments)
+    if queue_failed:
+        Log("Failed to queue an email")
         return True
     
     return False
 
+# A function to write METRICS to a textfile collector file
+# Return True on error
+def WriteMetrics(path):
+    try:
+        METRICS.WriteTextfile(path)
+        return False
+    except Exception as ex:
+        Log(f"Error writing metrics to {path} - {ex}")
+        return True
+
+# A function to serve METRICS on http://address:port/metrics
+# Return the running server, or None when the port cannot be bound
+def StartMetricsServer(metrics):
+    address = metrics.get("address", "127.0.0.1")
+    port = metrics["port"]
+
+    try:
+        server = MetricsServer(METRICS, address, port)
+    except OSError as ex:
+        Log(f"Error starting metrics endpoint on {address}:{port} - {ex}")
+        return None
+
+    server.Start()
+    Log(f"Serving metrics on http://{address}:{port}/metrics")
+    return server
+
+# A function to keep probing on a fixed interval until SIGTERM/SIGINT
+# The config file is reloaded when it changes, the database connection stays open
+# between rounds and the digest is sent on its own digest_minutes timer
+# Return False/0 for a clean shutdown
+def RunDaemon(interval):
+    stop = threading.Event()
+
+    def RequestStop(signum, frame):
+        Log(f"Received signal {signum}, stopping after the current run")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, RequestStop)
+    signal.signal(signal.SIGINT, RequestStop)
+
+    # Database setup is counted towards the first run
+    timer = PhaseTimer()
+    with timer.Phase("init"):
+        InitDB()
+    conn = sqlite3.connect(DB_PATH)
+
+    # Emails are delivered by one sender for the life of the daemon
+    global OUTBOX
+    OUTBOX = OutboxSender(DB_PATH, {})
+    OUTBOX.start()
+
+    # Metrics live in memory for the life of the daemon; the endpoint starts with the first config
+    global METRICS
+    metrics_server = None
+
+    config = None
+    config_mtime = None
+    next_digest = None
+
+    Log(f"Starting daemon with a {interval} second interval")
+
+    try:
+        while not stop.is_set():
+            # Reload the configuration when the file changes, keeping the last good copy
+            try:
+                mtime = os.path.getmtime(JSON_PATH)
+            except OSError:
+                mtime = None
+
+            if config is None or mtime != config_mtime:
+                with timer.Phase("config"):
+                    loaded = ReadJson(JSON_PATH)
+                if loaded[0] and loaded[1]:
+                    if config is not None:
+                        Log("Configuration changed, reloaded")
+                    config = loaded
+                    OUTBOX.Configure(config[2])
+
+                    metrics = config[3].get("metrics", {})
+                    if METRICS is None and metrics:
+                        METRICS = ProbeMetrics(metrics.get("buckets", DEFAULT_BUCKETS))
+                        if metrics.get("textfile"):
+                            METRICS.LoadTextfile(metrics["textfile"])
+                    if metrics_server is None and metrics.get("port"):
+                        metrics_server = StartMetricsServer(metrics)
+                elif config is None:
+                    Log("No usable configuration, retrying next interval")
+                else:
+                    Log("Configuration is not usable, keeping the previous one")
+                config_mtime = mtime
+
+            round_start = time.monotonic()
+
+            if config is not None:
+                nameservers, fqdns, email, settings = config
+
+                # With adaptive scheduling only the pairs whose own interval has elapsed are probed
+                schedule = None
+                pairs = None
+                expired = frozenset()
+                if settings.get("adaptive"):
+                    cold = settings.get("cold", {})
+                    schedule = {
+                        "min_interval": interval,
+                        "ttl_aware": cold.get("ttl_aware", False),
+                        "ttl_margin_seconds": cold.get("ttl_margin_seconds", 1),
+                        **settings["adaptive"]
+                    }
+                    targets = ProbeTargets(fqdns, settings)
+                    pairs, expired = DuePairs(conn, nameservers, targets, time.time(), schedule["min_interval"] / 2, schedule["ttl_margin_seconds"])
+                    Log(f"{len(pairs)} of {len(nameservers) * len(targets)} pairs due, {len(expired)} after a cache expiry")
+
+                if pairs == []:
+                    Log("No pairs due, skipping this round")
+                elif RunCheck(nameservers, fqdns, email, settings, conn, pairs=pairs, schedule=schedule, cold_pairs=expired, timer=timer):
+                    Log("Run finished with errors")
+
+                if settings.get("metrics", {}).get("textfile"):
+                    WriteMetrics(settings["metrics"]["textfile"])
+
+                # Apply retention between rounds, bounded by its own time budget
+                if settings.get("retention"):
+                    with timer.Phase("compact"):
+                        CompactDB(conn, settings["retention"])
+
+                try:
+                    timer.Save(conn)
+                except sqlite3.Error as ex:
+                    Log(f"Failed to store the phase timings of run {timer.run_id} - {ex}")
+
+                # Digests run on their own timer rather than every round
+                if DIGEST:
+                    digest_minutes = settings.get("digest_minutes", 60)
+                    if next_digest is None:
+                        next_digest = round_start + digest_minutes * 60
+                    elif time.monotonic() >= next_digest:
+                        retention = settings.get("retention", {})
+                        SendDigestSummary(DB_PATH, email, email.get("from_name", ""), digest_minutes, retention.get("hourly_days", 0), settings)
+                        next_digest = time.monotonic() + digest_minutes * 60
+
+            # Spread rounds out so several daemons do not burst at the same instant
+            jitter = config[3].get("jitter_seconds", interval * 0.1) if config else 0
+            delay = interval - (time.monotonic() - round_start) + random.uniform(-jitter, jitter)
+            timer = PhaseTimer()
+            stop.wait(max(0, delay))
+    finally:
+        conn.close()
+        ShutdownProbePool()
+        CloseEncryptedClient()
+        if metrics_server is not None:
+            metrics_server.Stop()
+        OUTBOX.Stop(config[2].get("timeout_seconds", 30) * 2 if config else 0)
+
+    Log("Daemon stopped")
+    return False
+
+# The main function as script is to be ran as a program
+# Return False/0 for successful run
+def main():
+    if DAEMON:
+        return RunDaemon(INTERVAL)
+
+    timer = PhaseTimer()
+    with timer.Phase("config"):
+        nameservers, fqdns, email, settings = ReadJson(JSON_PATH)
+
+    # Initialize the database
+    with timer.Phase("init"):
+        InitDB()
+
+    # Deliver queued emails, including ones left over from earlier runs, in the background
+    global OUTBOX
+    OUTBOX = OutboxSender(DB_PATH, email)
+    OUTBOX.start()
+
+    # Counters continue from the textfile the previous run left behind
+    global METRICS
+    textfile = settings.get("metrics", {}).get("textfile")
+    if textfile:
+        METRICS = ProbeMetrics(settings["metrics"].get("buckets", DEFAULT_BUCKETS))
+        METRICS.LoadTextfile(textfile)
+
+    try:
+        error = RunCheck(nameservers, fqdns, email, settings, digest=DIGEST, timer=timer)
+    finally:
+        ShutdownProbePool()
+        CloseEncryptedClient()
+
+    if textfile and WriteMetrics(textfile):
+        error = True
+
+    # Give the sender one pass at this run's emails. A message that could not be sent yet stays
+    # queued for the next run to retry and does not fail this one; one given up on does
+    with timer.Phase("send"):
+        OUTBOX.Stop(email.get("timeout_seconds", 30) * 2)
+    failed = OUTBOX.Failed()
+    if failed:
+        Log(f"{len(failed)} email(s) failed after {email.get('max_attempts', 5)} attempts and were given up on, see last_error in the outbox")
+        error = True
+    undelivered = OUTBOX.Undelivered()
+    if undelivered:
+        Log(f"{len(undelivered)} email(s) not delivered yet, kept in the outbox for the next run to retry")
+
+    # Apply retention after the run so it never delays the probes
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        if settings.get("retention"):
+            with timer.Phase("compact"):
+                CompactDB(conn, settings["retention"])
+
+        try:
+            timer.Save(conn)
+        except sqlite3.Error as ex:
+            Log(f"Failed to store the phase timings of run {timer.run_id} - {ex}")
+    finally:
+        conn.close()
+
+    return error
+
+# A function to run function under cProfile and tracemalloc (--profile)
+# The raw profile is written next to the log as dns-profile-<time>.pstats for pstats/snakeviz,
+# and the slowest functions, the largest allocation sites and peak memory are logged.
+# Only the main thread is profiled; time in probe threads or worker processes shows up as
+# the main thread waiting on them.
+def RunProfiled(function):
+    tracemalloc.start(10)
+    profiler = cProfile.Profile()
+
+    try:
+        return profiler.runcall(function)
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(os.path.dirname(os.path.abspath(LOG_PATH)), f"dns-profile-{stamp}.pstats")
+        profiler.dump_stats(path)
+
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).strip_dirs().sort_stats("cumulative").print_stats(25)
+        Log(f"Profile written to {path}\n{out.getvalue().strip()}")
+
+        sites = "\n".join(f"  {stat}" for stat in snapshot.statistics("lineno")[:15])
+        Log(f"Memory: {current / 1048576:.1f} MiB traced at exit, {peak / 1048576:.1f} MiB peak; largest allocation sites:\n{sites}")
+
 # Bootstrap into the main function
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Monitor DNS Servers")
@@ -425,14 +2385,24 @@ if __name__ == "__main__":
     parser.add_argument("--db-path", type=str, default="dns.db", help="Path to SQLite3 database file")
     parser.add_argument("--config", type=str, default="config.json", help="Path to JSON config file")
     parser.add_argument("--digest", action="store_true", default=False, help="Whether or not to calculate digest")
+    parser.add_argument("--concurrency", type=int, default=0, help="Maximum probes in flight (overrides general.concurrency, 1 = serial)")
+    parser.add_argument("--workers", type=int, default=0, help="Probe worker processes (overrides general.workers, 1 = in process)")
+    parser.add_argument("--daemon", action="store_true", default=False, help="Keep running and probe every --interval seconds")
+    parser.add_argument("--interval", type=float, default=60, help="Seconds between probe rounds in daemon mode")
+    parser.add_argument("--profile", action="store_true", default=False, help="Profile the run with cProfile and tracemalloc")
     args = parser.parse_args()
 
     LOG_PATH = args.log_path
     JSON_PATH = args.config
     DB_PATH = args.db_path
     DIGEST = args.digest
+    CONCURRENCY = args.concurrency
+    WORKERS = args.workers
+    DAEMON = args.daemon
+    INTERVAL = args.interval
 
-    if main():
+    error = RunProfiled(main) if args.profile else main()
+    if error:
         Log("Exit with errors")
         sys.exit(1)
     else:
@@ -17,11 +17,63 @@
     "username": "",
     "password": "",
     "from": "dnscheck@example.com",
-    "to": "check@example.com"
+    "to": "check@example.com",
+    "starttls": true,
+    "timeout_seconds": 30,
+    "keepalive_seconds": 30,
+    "max_attempts": 5,
+    "backoff_seconds": 30,
+    "lease_seconds": 300
   },
     "general": {
     "send_pass": true,
     "send_fail": true,
-    "digest_minutes": 60
+    "digest_minutes": 60,
+    "concurrency": 1,
+    "nameserver_concurrency": 0,
+    "workers": 1,
+    "transport": "system",
+    "timeout_ms": 3000,
+    "tls": {
+      "ca_file": "",
+      "verify": true
+    },
+    "samples": 1,
+    "sample_spacing_ms": 0,
+    "report_collapse_cells": 2000,
+    "report_max_rows": 25,
+    "metrics": {
+      "address": "127.0.0.1",
+      "port": 9153,
+      "textfile": ""
+    },
+    "cold": {
+      "zones": [],
+      "ttl_aware": false,
+      "ttl_margin_seconds": 1
+    },
+    "adaptive": {
+      "max_interval": 3600,
+      "backoff": 2,
+      "regression_factor": 2,
+      "regression_min_ms": 10
+    },
+    "records": [
+      { "name": "google.com", "type": "MX", "pin": true },
+      { "name": "google.com", "type": "NS", "expect": ["ns1.google.com", "ns2.google.com", "ns3.google.com", "ns4.google.com"] }
+    ],
+    "anomaly": {
+      "alpha": 0.1,
+      "threshold": 4,
+      "min_samples": 10,
+      "min_delta_ms": 5
+    },
+    "jitter_seconds": 5,
+    "retention": {
+      "raw_days": 30,
+      "hourly_days": 180,
+      "batch_size": 5000,
+      "max_seconds": 2
+    }
   }
 }
\ No newline at end of file
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+# The scripts live one directory up and are imported as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import TestDNS
+
+
+# TestDNS pointed at a fresh temporary directory, with the globals __main__ would set
+@pytest.fixture
+def dns_paths(tmp_path, monkeypatch):
+    monkeypatch.setattr(TestDNS, "LOG_PATH", str(tmp_path / "dns.log"), raising=False)
+    monkeypatch.setattr(TestDNS, "DB_PATH", str(tmp_path / "dns.db"), raising=False)
+    monkeypatch.setattr(TestDNS, "JSON_PATH", str(tmp_path / "config.json"), raising=False)
+    monkeypatch.setattr(TestDNS, "DIGEST", False, raising=False)
+    monkeypatch.setattr(TestDNS, "CONCURRENCY", 0, raising=False)
+    monkeypatch.setattr(TestDNS, "WORKERS", 0, raising=False)
+    monkeypatch.setattr(TestDNS, "DAEMON", False, raising=False)
+    monkeypatch.setattr(TestDNS, "OUTBOX", None)
+    monkeypatch.setattr(TestDNS, "METRICS", None)
+    return TestDNS
+
+
+# TestDNS with its database created
+@pytest.fixture
+def dns(dns_paths):
+    dns_paths.InitDB()
+    return dns_paths
@@ -0,0 +1,44 @@
+import sqlite3
+
+from test_runcheck import FakeProbes
+
+EMAIL = {"from": "dns@example.test", "to": "ops@example.test"}
+
+
+# Connections opened by TestDNS, to check they are all closed again
+def TrackConnections(dns, monkeypatch):
+    opened = []
+    connect = sqlite3.connect
+
+    class Connection(sqlite3.Connection):
+        def close(self):
+            opened.remove(self)
+            super().close()
+
+    def Connect(path, *args, **kwargs):
+        conn = connect(path, *args, factory=Connection, **kwargs)
+        opened.append(conn)
+        return conn
+
+    monkeypatch.setattr(dns.sqlite3, "connect", Connect)
+    return opened
+
+
+def test_digest_without_runs_closes_its_connection(dns, monkeypatch):
+    opened = TrackConnections(dns, monkeypatch)
+
+    assert dns.SendDigestSummary(dns.DB_PATH, EMAIL, "Example", 60) is None
+    assert opened == []
+
+
+def test_digest_is_queued_and_closes_its_connection(dns, monkeypatch):
+    monkeypatch.setattr(dns, "RunProbes", FakeProbes)
+    dns.RunCheck(["192.0.2.1"], ["a.example.test"], EMAIL, {"send_pass": False})
+    opened = TrackConnections(dns, monkeypatch)
+
+    assert dns.SendDigestSummary(dns.DB_PATH, EMAIL, "Example", 60) is False
+    assert opened == []
+
+    conn = sqlite3.connect(dns.DB_PATH)
+    assert conn.execute("SELECT COUNT(*) FROM outbox").fetchone() == (1,)
+    conn.close()
@@ -0,0 +1,146 @@
+import asyncio
+import shutil
+import socket
+import ssl
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import DnsWire
+from BenchDNS import StubResolver
+
+
+# A self-signed certificate for 127.0.0.1, as in the README's Encrypted Transports section
+@pytest.fixture(scope="module")
+def certificate(tmp_path_factory):
+    if shutil.which("openssl") is None:
+        pytest.skip("openssl is needed to create the test certificate")
+
+    path = tmp_path_factory.mktemp("tls")
+    cert, key = str(path / "cert.pem"), str(path / "key.pem")
+    subprocess.run([
+        "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key, "-out", cert,
+        "-days", "1", "-subj", "/CN=localhost", "-addext", "subjectAltName=IP:127.0.0.1"
+    ], check=True, capture_output=True)
+    return cert, key
+
+
+# A stub resolver on loopback answering UDP, TCP, DoT and DoH after `latency`
+def Stub(certificate, latency="constant:1", loss=0.0, servfail=0.0):
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(*certificate)
+    return StubResolver(latency, loss, servfail, tls=context).Start()
+
+
+@pytest.fixture
+def stub(certificate):
+    stub = Stub(certificate)
+    yield stub
+    stub.Stop()
+
+
+@pytest.fixture
+def client(certificate):
+    client = DnsWire.EncryptedClient(ssl.create_default_context(cafile=certificate[0]))
+    yield client
+    client.Close()
+
+
+def Servers(stub):
+    return {
+        "dot": f"tls://127.0.0.1:{stub.dot_port}",
+        "doh": f"https://127.0.0.1:{stub.doh_port}/dns-query",
+    }
+
+
+@pytest.mark.parametrize("transport", ["dot", "doh"])
+def test_encrypted_query_reuses_its_connection(stub, client, transport):
+    server = Servers(stub)[transport]
+
+    first, seconds, handshake = client.Query(server, "a.example.test", transport=transport)
+    second, _, again = client.Query(server, "b.example.test", transport=transport)
+
+    assert first["rcode"] == DnsWire.RCODE_NOERROR
+    assert [answer["text"] for answer in first["answers"]] == ["192.0.2.1"]
+    assert second["question"] == ("b.example.test", DnsWire.QTYPE_A)
+    assert seconds > 0 and handshake > 0
+    assert again is None
+
+
+@pytest.mark.parametrize("transport", ["dot", "doh"])
+def test_pipelined_queries_get_their_own_answers(stub, client, transport):
+    server = Servers(stub)[transport]
+    names = [f"host{index}.example.test" for index in range(40)]
+
+    with ThreadPoolExecutor(8) as pool:
+        responses = list(pool.map(lambda name: client.Query(server, name, transport=transport)[0], names))
+
+    assert [response["question"][0] for response in responses] == names
+    assert all(response["answers"] for response in responses)
+    assert sum(len(stub.injected[name]) for name in names) == len(names)
+
+
+@pytest.mark.parametrize("transport", ["dot", "doh"])
+def test_servfail_is_returned(certificate, client, transport):
+    stub = Stub(certificate, servfail=1.0)
+    try:
+        response, _, _ = client.Query(Servers(stub)[transport], "a.example.test", transport=transport)
+    finally:
+        stub.Stop()
+
+    assert response["rcode"] == DnsWire.RCODE_SERVFAIL
+    assert response["answers"] == []
+
+
+def test_lost_doh_query_fails_and_the_connection_stays_usable(certificate, client):
+    stub = Stub(certificate, loss=1.0)
+    try:
+        server = Servers(stub)["doh"]
+        with pytest.raises(DnsWire.DnsError):
+            client.Query(server, "a.example.test", transport="doh")
+
+        stub.loss = 0.0
+        response, _, handshake = client.Query(server, "b.example.test", transport="doh")
+    finally:
+        stub.Stop()
+
+    assert response["answers"]
+    assert handshake is None
+
+
+def test_lost_dot_query_times_out(certificate, client):
+    stub = Stub(certificate, loss=1.0)
+    try:
+        with pytest.raises(asyncio.TimeoutError):
+            client.Query(Servers(stub)["dot"], "a.example.test", transport="dot", timeout=0.3)
+    finally:
+        stub.Stop()
+
+
+@pytest.mark.parametrize("transport", ["dot", "doh"])
+def test_untrusted_certificate_is_rejected(stub, transport):
+    client = DnsWire.EncryptedClient(ssl.create_default_context())
+    try:
+        with pytest.raises(ssl.SSLCertVerificationError):
+            client.Query(Servers(stub)[transport], "a.example.test", transport=transport)
+    finally:
+        client.Close()
+
+
+@pytest.mark.parametrize("transport", ["udp", "tcp"])
+def test_plain_query(stub, transport):
+    response = DnsWire.Query("127.0.0.1", stub.port, "a.example.test", transport=transport)
+
+    assert response["answers"][0]["rdata"] == socket.inet_aton("192.0.2.1")
+
+
+@pytest.mark.parametrize("transport", ["dot", "doh"])
+def test_probe_over_encrypted_transport(dns, stub, certificate, transport):
+    dns.ConfigureTls({"ca_file": certificate[0]})
+    try:
+        server = Servers(stub)[transport]
+        assert dns.QueryNameserver(server, "a.example.test", transport, 2.0) > 0
+        assert len(dns.TLS_HANDSHAKES.pop(server)) == 1
+    finally:
+        dns.CloseEncryptedClient()
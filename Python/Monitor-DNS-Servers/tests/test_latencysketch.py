@@ -0,0 +1,61 @@
+import random
+
+import pytest
+
+from LatencySketch import LatencySketch, ExactPercentile, ShardedSketch, SyntheticDistributions
+
+
+@pytest.mark.parametrize("name", ["lognormal", "uniform", "bimodal", "exponential"])
+@pytest.mark.parametrize("alpha", [0.01, 0.05])
+def test_percentiles_are_within_the_relative_error_bound(name, alpha):
+    draw = SyntheticDistributions(random.Random(1))[name]
+    values = [max(1, draw()) for _ in range(20000)]
+    sketch = ShardedSketch(values, alpha)
+    ordered = sorted(values)
+
+    assert sketch.count == len(values)
+    for pct in (1, 50, 90, 95, 99, 99.9, 100):
+        exact = ExactPercentile(ordered, pct)
+        assert abs(sketch.Quantile(pct) - exact) / exact <= alpha + 1e-9
+
+
+def test_merged_shards_equal_one_sketch_of_every_value():
+    draw = SyntheticDistributions(random.Random(2))["bimodal"]
+    values = [max(1, draw()) for _ in range(5000)]
+
+    whole = LatencySketch()
+    for value in values:
+        whole.Add(value)
+    merged = ShardedSketch(values, shards=7)
+
+    assert merged.buckets == whole.buckets
+    assert merged.count == whole.count
+    assert merged.ToBytes() == whole.ToBytes()
+    assert [merged.Quantile(pct) for pct in (50, 99)] == [whole.Quantile(pct) for pct in (50, 99)]
+
+
+def test_merge_is_order_independent():
+    rng = random.Random(3)
+    a, b = LatencySketch(), LatencySketch()
+    for _ in range(1000):
+        a.Add(rng.uniform(1, 1000))
+        b.Add(rng.lognormvariate(5, 1))
+
+    left = LatencySketch.FromBytes(a.ToBytes()).Merge(b)
+    right = LatencySketch.FromBytes(b.ToBytes()).Merge(a)
+    assert left.buckets == right.buckets and left.count == right.count == 2000
+
+
+def test_failures_and_empty_sketches():
+    sketch = LatencySketch()
+    sketch.Add(0)
+    sketch.Add(-5)
+
+    assert sketch.count == 0
+    assert sketch.Quantile(50) == 0.0
+    assert LatencySketch.FromBytes(sketch.ToBytes()).count == 0
+
+
+def test_sketches_with_different_accuracy_do_not_merge():
+    with pytest.raises(ValueError):
+        LatencySketch(0.01).Merge(LatencySketch(0.02))
@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+from Metrics import ProbeMetrics
+
+# A target with a quote, a backslash and a newline, which must be escaped in label values
+TARGET = 'a"b\\c\nd'
+
+EXPOSITION = """\
+# HELP dns_last_run_timestamp_seconds Epoch time the last run finished
+# TYPE dns_last_run_timestamp_seconds gauge
+dns_last_run_timestamp_seconds 1700000000
+# HELP dns_probe_duration_seconds Latency of successful DNS probe samples
+# TYPE dns_probe_duration_seconds histogram
+dns_probe_duration_seconds_bucket{resolver="192.0.2.1",target="a\\"b\\\\c\\nd",le="0.01"} 1
+dns_probe_duration_seconds_bucket{resolver="192.0.2.1",target="a\\"b\\\\c\\nd",le="0.1"} 2
+dns_probe_duration_seconds_bucket{resolver="192.0.2.1",target="a\\"b\\\\c\\nd",le="+Inf"} 2
+dns_probe_duration_seconds_sum{resolver="192.0.2.1",target="a\\"b\\\\c\\nd"} 0.055
+dns_probe_duration_seconds_count{resolver="192.0.2.1",target="a\\"b\\\\c\\nd"} 2
+# HELP dns_probes_total DNS probe samples by result
+# TYPE dns_probes_total counter
+dns_probes_total{resolver="192.0.2.1",target="a\\"b\\\\c\\nd",result="failure"} 1
+dns_probes_total{resolver="192.0.2.1",target="a\\"b\\\\c\\nd",result="success"} 2
+# HELP dns_run_duration_seconds Wall time of the last probe run
+# TYPE dns_run_duration_seconds gauge
+dns_run_duration_seconds 1.5
+# HELP dns_run_pairs FQDN x nameserver pairs probed in the last run
+# TYPE dns_run_pairs gauge
+dns_run_pairs 2
+# HELP dns_runs_total Probe runs by final status
+# TYPE dns_runs_total counter
+dns_runs_total{status="PASS"} 1
+"""
+
+
+# Metrics of one run: two successful samples (5 and 50 ms) and a failed one
+def KnownMetrics():
+    metrics = ProbeMetrics((0.01, 0.1))
+    metrics.ObservePair("192.0.2.1", TARGET, [5, 0, 50])
+    metrics.ObserveRun("PASS", 1.5, 2, 1700000000)
+    return metrics
+
+
+def test_render_exposition_text():
+    assert KnownMetrics().Render() == EXPOSITION
+
+
+def test_textfile_is_replaced_atomically_and_read_back(tmp_path, monkeypatch):
+    path = tmp_path / "dns.prom"
+    path.write_text("stale\n")
+    metrics = KnownMetrics()
+
+    # The file only ever changes by rename, and no temporary file is left behind
+    replaced = []
+    replace = os.replace
+
+    def Replace(source, target):
+        replaced.append((os.path.dirname(source), target))
+        replace(source, target)
+
+    monkeypatch.setattr(os, "replace", Replace)
+    metrics.WriteTextfile(str(path))
+
+    assert replaced == [(str(tmp_path), str(path))]
+    assert path.read_text() == EXPOSITION
+    assert os.stat(path).st_mode & 0o777 == 0o644
+    assert os.listdir(tmp_path) == ["dns.prom"]
+
+    # Counters carry over, label escaping included
+    loaded = ProbeMetrics((0.01, 0.1))
+    loaded.LoadTextfile(str(path))
+    assert loaded.samples == metrics.samples
+
+
+def test_failed_textfile_write_keeps_the_old_file(tmp_path, monkeypatch):
+    path = tmp_path / "dns.prom"
+    path.write_text("previous\n")
+    metrics = KnownMetrics()
+
+    def Fail(self):
+        raise RuntimeError("render failed")
+
+    monkeypatch.setattr(ProbeMetrics, "Render", Fail)
+    with pytest.raises(RuntimeError):
+        metrics.WriteTextfile(str(path))
+
+    assert path.read_text() == "previous\n"
+    assert os.listdir(tmp_path) == ["dns.prom"]
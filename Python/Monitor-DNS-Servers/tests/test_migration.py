@@ -0,0 +1,39 @@
+import sqlite3
+
+
+# A database in the schema TestDNS wrote before results were normalized
+def CreateLegacyDB(path, results):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE runs (id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TEXT NOT NULL, status TEXT NOT NULL)")
+    conn.execute("""
+        CREATE TABLE results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id INTEGER NOT NULL,
+            fqdn TEXT NOT NULL,
+            nameserver TEXT NOT NULL,
+            result TEXT NOT NULL,
+            perf REAL NOT NULL
+        )
+    """)
+    conn.execute("INSERT INTO runs (timestamp, status) VALUES ('2024-01-01 00:00:00', 'PASS')")
+    conn.executemany("INSERT INTO results (run_id, fqdn, nameserver, result, perf) VALUES (?, ?, ?, ?, ?)", results)
+    conn.commit()
+    conn.close()
+
+
+def test_migration_logs_the_legacy_results_it_drops(dns_paths):
+    CreateLegacyDB(dns_paths.DB_PATH, [
+        (1, "a.example.test", "192.0.2.1", "PASS", 5.0),
+        (1, "b.example.test", "192.0.2.1", "PASS", 6.0),
+        (1, "a.example.test", "192.0.2.1", "PASS", 7.0),
+    ])
+
+    dns_paths.InitDB()
+
+    conn = sqlite3.connect(dns_paths.DB_PATH)
+    assert conn.execute("SELECT COUNT(*) FROM results").fetchone() == (2,)
+    conn.close()
+    with open(dns_paths.LOG_PATH) as f:
+        log = f.read()
+    assert "Dropped 1 legacy results" in log
+    assert "Migrated 2 legacy results" in log
@@ -0,0 +1,208 @@
+import sqlite3
+import threading
+import time
+import socketserver
+from email import message_from_bytes
+
+import pytest
+
+
+# A minimal SMTP server that keeps every accepted message, or rejects them all with a 451
+class SmtpStub(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), SmtpHandler)
+        self.messages = []
+        self.reject = False
+        self.lock = threading.Lock()
+
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.reply("220 stub ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip().upper()
+
+            if command.startswith("EHLO"):
+                self.reply("250-stub")
+                self.reply("250 8BITMIME")
+            elif command.startswith("DATA"):
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                lines = []
+                while True:
+                    line = self.rfile.readline()
+                    if line in (b".\r\n", b""):
+                        break
+                    lines.append(line[1:] if line.startswith(b"..") else line)
+                if self.server.reject:
+                    self.reply("451 Try again later")
+                else:
+                    with self.server.lock:
+                        self.server.messages.append(b"".join(lines))
+                    self.reply("250 OK")
+            elif command.startswith("QUIT"):
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+@pytest.fixture
+def smtp():
+    server = SmtpStub()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def email(smtp):
+    return {
+        "host": "127.0.0.1", "port": smtp.server_address[1], "ssl": False, "starttls": False,
+        "from": "dns@example.test", "to": "ops@example.test",
+        "backoff_seconds": 30, "max_attempts": 3, "timeout_seconds": 5,
+    }
+
+
+def Outbox(dns):
+    conn = sqlite3.connect(dns.DB_PATH)
+    rows = conn.execute("SELECT status, attempts, next_attempt, lease_until FROM outbox ORDER BY id").fetchall()
+    conn.close()
+    return rows
+
+
+def Drain(dns, email):
+    sender = dns.OutboxSender(dns.DB_PATH, email)
+    conn = sqlite3.connect(dns.DB_PATH)
+    try:
+        return sender.Drain(conn)
+    finally:
+        sender.Disconnect()
+        conn.close()
+
+
+def test_queued_email_is_delivered_once(dns, smtp, email):
+    assert dns.SendEmail(email, "DNS check", "<p>ok</p>") is False
+
+    Drain(dns, email)
+    Drain(dns, email)
+
+    assert len(smtp.messages) == 1
+    assert message_from_bytes(smtp.messages[0])["Subject"] == "DNS check"
+    assert [row[:2] for row in Outbox(dns)] == [("SENT", 1)]
+
+
+def test_rejected_email_backs_off_then_fails(dns, smtp, email):
+    smtp.reject = True
+    dns.SendEmail(email, "DNS check", "<p>ok</p>")
+
+    start = int(time.time())
+    wait = Drain(dns, email)
+    status, attempts, next_attempt, lease_until = Outbox(dns)[0]
+    assert (status, attempts, lease_until) == ("PENDING", 1, None)
+    assert start + 30 <= next_attempt <= int(time.time()) + 30
+    assert 1 <= wait <= 30
+
+    # Not due yet, so nothing is attempted
+    Drain(dns, email)
+    assert Outbox(dns)[0][1] == 1
+
+    # The second failure doubles the backoff, the third gives up
+    conn = sqlite3.connect(dns.DB_PATH)
+    with conn:
+        conn.execute("UPDATE outbox SET next_attempt = 0")
+    Drain(dns, email)
+    status, attempts, next_attempt, _ = Outbox(dns)[0]
+    assert (status, attempts) == ("PENDING", 2)
+    assert next_attempt >= start + 60
+
+    with conn:
+        conn.execute("UPDATE outbox SET next_attempt = 0")
+    conn.close()
+    Drain(dns, email)
+    assert [row[:2] for row in Outbox(dns)] == [("FAILED", 3)]
+    assert smtp.messages == []
+
+
+def test_retry_delivers_once_the_server_accepts(dns, smtp, email):
+    smtp.reject = True
+    dns.SendEmail(email, "DNS check", "<p>ok</p>")
+    Drain(dns, email)
+
+    smtp.reject = False
+    conn = sqlite3.connect(dns.DB_PATH)
+    with conn:
+        conn.execute("UPDATE outbox SET next_attempt = 0")
+    conn.close()
+    Drain(dns, email)
+
+    assert len(smtp.messages) == 1
+    assert [row[:2] for row in Outbox(dns)] == [("SENT", 2)]
+
+
+def test_claimed_email_is_left_until_its_lease_runs_out(dns, smtp, email):
+    dns.SendEmail(email, "DNS check", "<p>ok</p>")
+    conn = sqlite3.connect(dns.DB_PATH)
+    with conn:
+        conn.execute("UPDATE outbox SET status = 'SENDING', lease_until = ?", (int(time.time()) + 300,))
+
+    Drain(dns, email)
+    assert smtp.messages == []
+    assert Outbox(dns)[0][0] == "SENDING"
+
+    # The sender holding it died; once the lease has expired the message is sent again
+    with conn:
+        conn.execute("UPDATE outbox SET lease_until = ?", (int(time.time()) - 1,))
+    conn.close()
+    Drain(dns, email)
+    assert len(smtp.messages) == 1
+    assert [row[:2] for row in Outbox(dns)] == [("SENT", 1)]
+
+
+def test_overlapping_senders_send_each_email_once(dns, smtp, email):
+    for index in range(20):
+        dns.SendEmail(email, f"DNS check {index}", "<p>ok</p>")
+
+    senders = [threading.Thread(target=Drain, args=(dns, email)) for _ in range(4)]
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+
+    subjects = sorted(message_from_bytes(message)["Subject"] for message in smtp.messages)
+    assert subjects == sorted(f"DNS check {index}" for index in range(20))
+    assert {row[:2] for row in Outbox(dns)} == {("SENT", 1)}
+
+
+def test_given_up_emails_are_reported_apart_from_pending_ones(dns, smtp, email):
+    smtp.reject = True
+    dns.SendEmail(email, "given up", "<p>ok</p>")
+    dns.SendEmail(email, "retried", "<p>ok</p>")
+    conn = sqlite3.connect(dns.DB_PATH)
+    with conn:
+        conn.execute("UPDATE outbox SET attempts = 2 WHERE id = 1")
+
+    sender = dns.OutboxSender(dns.DB_PATH, email)
+    sender.Notify(1)
+    sender.Notify(2)
+    try:
+        # A failure ends the pass, so each drain makes one attempt
+        sender.Drain(conn)
+        sender.Drain(conn)
+    finally:
+        sender.Disconnect()
+        conn.close()
+
+    assert [row[:2] for row in Outbox(dns)] == [("FAILED", 3), ("PENDING", 1)]
+    assert sender.Failed() == [1]
+    assert sender.Undelivered() == [2]
@@ -0,0 +1,71 @@
+import csv
+import gzip
+import io
+import random
+
+import Report
+from Report import BenchmarkReport, RenderRunReport, SyntheticResults
+
+NAMESERVERS = [f"10.0.0.{index + 1}" for index in range(8)]
+
+
+def Matrix(domains, fail_rate=0.001, seed=1):
+    return SyntheticResults(random.Random(seed), domains, NAMESERVERS, fail_rate)
+
+
+def test_small_matrix_is_rendered_in_full():
+    results = Matrix(250)
+    body, attachment, _, _ = BenchmarkReport(NAMESERVERS, results)
+
+    assert attachment == b""
+    assert all(result["name"] in body for result in results)
+
+
+def test_large_matrix_is_collapsed_and_attached():
+    results = Matrix(25000)
+    body, attachment, _, _ = BenchmarkReport(NAMESERVERS, results)
+    full, _ = RenderRunReport(NAMESERVERS, results, collapse_cells=0)
+
+    # Only failing rows and the summary row are listed; every row is in the attachment
+    failing = [result for result in results if result["overall"] == "FAIL"]
+    assert all(result["name"] in body for result in failing)
+    assert "host0.example.com" in full
+    assert len(body) < len(full) / 50
+    assert len(body) < 1000 * (len(failing) + 1)
+
+    rows = list(csv.reader(io.StringIO(gzip.decompress(attachment).decode("utf-8"))))
+    assert len(rows) == len(results) + 1
+    assert len(attachment) < len(full) / 5
+
+
+def test_collapsed_matrix_keeps_anomalous_rows():
+    results = Matrix(1000, fail_rate=0)
+    results[500][NAMESERVERS[0] + "_anomaly"] = 1.5
+
+    body, attachment, _, _ = BenchmarkReport(NAMESERVERS, results)
+
+    assert attachment
+    assert results[500]["name"] in body
+    assert "baseline 1.5 ms" in body
+    assert results[501]["name"] not in body
+
+
+def test_render_work_grows_linearly(monkeypatch):
+    # Count the rows written instead of timing them, so a busy machine cannot fail the test
+    rows = []
+    row = Report.ReportWriter.Row
+
+    def CountingRow(self, cells):
+        rows.append(len(cells))
+        row(self, cells)
+
+    monkeypatch.setattr(Report.ReportWriter, "Row", CountingRow)
+
+    per_cell = []
+    for domains in (500, 5000):
+        rows.clear()
+        body, _, _, _ = BenchmarkReport(NAMESERVERS, Matrix(domains), 0)
+        assert rows == [len(NAMESERVERS) + 2] * domains
+        per_cell.append(len(body) / (domains * len(NAMESERVERS)))
+
+    assert abs(per_cell[1] / per_cell[0] - 1) < 0.05
@@ -0,0 +1,32 @@
+import sqlite3
+
+
+# Probes every pair it is given once, every sample resolving in 5 ms
+def FakeProbes(nameservers, fqdns, *args, **kwargs):
+    pairs = kwargs.get("pairs") or [(fqdn, nameserver) for fqdn in fqdns for nameserver in nameservers]
+    return {pair: [5.0] for pair in pairs}
+
+
+def test_duplicated_domain_and_nameserver_finish_the_run(dns, monkeypatch):
+    monkeypatch.setattr(dns, "RunProbes", FakeProbes)
+    nameservers = ["192.0.2.1", "192.0.2.2", "192.0.2.1"]
+    fqdns = ["a.example.test", "b.example.test", "a.example.test"]
+
+    assert dns.RunCheck(nameservers, fqdns, {"from": "dns@example.test", "to": "ops@example.test"}, {}) is False
+
+    conn = sqlite3.connect(dns.DB_PATH)
+    assert conn.execute("SELECT status FROM runs").fetchall() == [("PASS",)]
+    assert conn.execute("SELECT COUNT(*) FROM results").fetchone() == (4,)
+    assert conn.execute("SELECT COUNT(*) FROM outbox").fetchone() == (1,)
+    conn.close()
+
+
+def test_duplicated_pairs_in_a_scheduled_run_are_stored_once(dns, monkeypatch):
+    monkeypatch.setattr(dns, "RunProbes", FakeProbes)
+    pairs = [("a.example.test", "192.0.2.1"), ("a.example.test", "192.0.2.1")]
+
+    assert dns.RunCheck(["192.0.2.1"], ["a.example.test"], {}, {"send_pass": False}, pairs=pairs) is False
+
+    conn = sqlite3.connect(dns.DB_PATH)
+    assert conn.execute("SELECT COUNT(*) FROM results").fetchone() == (1,)
+    conn.close()
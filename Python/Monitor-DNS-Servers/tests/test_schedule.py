@@ -0,0 +1,99 @@
+import sqlite3
+
+
+POLICY = {"min_interval": 60, "max_interval": 3600, "backoff": 2.0}
+
+
+# Probes every pair it is given once, every sample resolving in `latency` ms
+def Probes(latency):
+    def RunProbes(nameservers, fqdns, *args, **kwargs):
+        pairs = kwargs.get("pairs") or [(fqdn, nameserver) for fqdn in fqdns for nameserver in nameservers]
+        return {pair: [latency] for pair in pairs}
+    return RunProbes
+
+
+def Round(dns, monkeypatch, latency, settings=None):
+    monkeypatch.setattr(dns, "RunProbes", Probes(latency))
+    dns.RunCheck(["192.0.2.1"], ["a.example.test"], {}, {"send_pass": False, **(settings or {})}, schedule=POLICY)
+
+    conn = sqlite3.connect(dns.DB_PATH)
+    interval = conn.execute("SELECT interval_s FROM schedule").fetchone()[0]
+    baselines = conn.execute("SELECT mean_us, observations FROM baselines").fetchall()
+    conn.close()
+    return interval, baselines
+
+
+def test_schedule_and_anomaly_detection_share_one_baseline(dns, monkeypatch):
+    settings = {"anomaly": {"alpha": 0.5, "min_samples": 100}}
+
+    assert Round(dns, monkeypatch, 5.0, settings) == (120, [(5000.0, 1)])
+    assert Round(dns, monkeypatch, 7.0, settings) == (240, [(6000.0, 2)])
+
+    # 30 ms is a regression against the 6 ms baseline; the baseline then takes the new median
+    assert Round(dns, monkeypatch, 30.0, settings) == (60, [(18000.0, 3)])
+
+    conn = sqlite3.connect(dns.DB_PATH)
+    assert "baseline_us" not in [column[1] for column in conn.execute("PRAGMA table_info(schedule)")]
+    conn.close()
+
+
+def test_schedule_keeps_a_baseline_without_anomaly_detection(dns, monkeypatch):
+    Round(dns, monkeypatch, 5.0)
+    interval, baselines = Round(dns, monkeypatch, 5.0)
+
+    assert interval == 240
+    assert baselines == [(5000.0, 2)]
+    assert Round(dns, monkeypatch, 30.0)[0] == 60
+
+
+def test_schedule_baseline_seeds_the_shared_baseline(dns_paths):
+    conn = sqlite3.connect(dns_paths.DB_PATH)
+    conn.execute("""
+        CREATE TABLE schedule (
+            resolver_id INTEGER NOT NULL,
+            target_id INTEGER NOT NULL,
+            interval_s REAL NOT NULL,
+            next_due REAL NOT NULL,
+            baseline_us INTEGER NOT NULL,
+            expires REAL,
+            PRIMARY KEY(resolver_id, target_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("INSERT INTO schedule VALUES (1, 1, 120, 1000, 5000, 990)")
+    conn.commit()
+    conn.close()
+
+    dns_paths.InitDB()
+
+    conn = sqlite3.connect(dns_paths.DB_PATH)
+    assert conn.execute("SELECT * FROM schedule").fetchall() == [(1, 1, 120.0, 1000.0, 990.0)]
+    assert conn.execute("SELECT * FROM baselines").fetchall() == [(1, 1, 5000.0, 0.0, 1)]
+    conn.close()
+
+
+def test_cold_probe_waits_for_the_ttl_margin(dns):
+    conn = sqlite3.connect(dns.DB_PATH)
+    conn.execute("INSERT INTO targets (id, fqdn) VALUES (1, 'a.example.test')")
+    conn.execute("INSERT INTO resolvers (id, address) VALUES (1, '192.0.2.1')")
+    # Due one second after the cached answer expires at 1000
+    conn.execute("INSERT INTO schedule VALUES (1, 1, 60, 1001, 1000)")
+    conn.commit()
+
+    assert dns.DuePairs(conn, ["192.0.2.1"], ["a.example.test"], 1000.5, 30, 1) == ([], set())
+    pair = ("a.example.test", "192.0.2.1")
+    assert dns.DuePairs(conn, ["192.0.2.1"], ["a.example.test"], 1001, 30, 1) == ([pair], {pair})
+    conn.close()
+
+
+def test_config_lists_each_pair_once(dns):
+    with open(dns.JSON_PATH, "w") as f:
+        f.write('{"nameservers": ["192.0.2.1", "192.0.2.2", "192.0.2.1"], "domains": ["a.example.test", "a.example.test"]}')
+
+    nameservers, fqdns, _, _ = dns.ReadJson(dns.JSON_PATH)
+    assert nameservers == ["192.0.2.1", "192.0.2.2"]
+    assert fqdns == ["a.example.test"]
+
+    conn = sqlite3.connect(dns.DB_PATH)
+    pairs, _ = dns.DuePairs(conn, nameservers, dns.ProbeTargets(fqdns, {}), 0)
+    conn.close()
+    assert pairs == [("a.example.test", "192.0.2.1"), ("a.example.test", "192.0.2.2")]
@@ -0,0 +1,27 @@
+# A UDP socket that records the timeout it was given instead of touching the network
+class RecordingSocket:
+    timeouts = []
+
+    def __init__(self, *args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def settimeout(self, timeout):
+        self.timeouts.append(timeout)
+
+    def connect(self, address):
+        pass
+
+
+def test_system_transport_uses_the_probe_timeout(dns, monkeypatch):
+    monkeypatch.setattr(dns.socket, "socket", RecordingSocket)
+    monkeypatch.setattr(dns.socket, "getaddrinfo", lambda *args: [])
+    monkeypatch.setattr(RecordingSocket, "timeouts", [])
+
+    assert dns.TestDNS("192.0.2.1", "a.example.test", "system", 7.5) >= 0
+    assert RecordingSocket.timeouts == [7.5]
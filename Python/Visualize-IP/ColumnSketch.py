@@ -0,0 +1,162 @@
+#!/bin/python3
+
+# Import statements
+import math
+import heapq
+import itertools
+
+# HyperLogLog precision: 2^14 registers, about 0.8% standard error in 16 KB per column
+DEFAULT_PRECISION = 14
+
+# Most frequent values kept per column
+DEFAULT_TOP = 20
+
+# Values monitored per top value asked for; more slots make the kept counts more accurate
+TOP_SLOTS = 10
+
+# Odd 64-bit constant to spread Python's hash() over all 64 bits
+HASH_MIX = 0x9E3779B97F4A7C15
+HASH_MASK = (1 << 64) - 1
+
+# A class implementing a HyperLogLog distinct-count estimator
+# Every value is hashed to 64 bits; the first `precision` bits pick a register and the
+# register keeps the longest run of leading zeros seen in the remaining bits. Memory is
+# 2^precision bytes whatever the number of values. Python's hash() is salted per process,
+# so the registers are only comparable within one run.
+class HyperLogLog:
+    def __init__(self, precision=DEFAULT_PRECISION):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+        self.shift = 64 - precision
+        self.rest = (1 << self.shift) - 1
+
+    # A function to record a value
+    def Add(self, value):
+        hashed = (hash(value) * HASH_MIX) & HASH_MASK
+        index = hashed >> self.shift
+        rank = self.shift - (hashed & self.rest).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    # A function to fold another sketch with the same precision into this one
+    def Merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError(f"Cannot merge sketches with precision {self.precision} and {other.precision}")
+
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+        return self
+
+    # A function to estimate the number of distinct values recorded
+    # Small counts use linear counting over the empty registers, as in the original paper
+    def Count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size * self.size / sum(2.0 ** -register for register in self.registers)
+
+        empty = self.registers.count(0)
+        if estimate <= 2.5 * self.size and empty:
+            estimate = self.size * math.log(self.size / empty)
+
+        return round(estimate)
+
+# A class implementing the space-saving top-k summary
+# At most `capacity` values are monitored. A value that is not monitored when the summary is
+# full takes the slot of the least counted one and inherits its count as the error bound, so
+# every kept count overestimates the true count by at most its error. The minimum is found
+# through a heap with lazy updates: increments never touch the heap, and a popped entry whose
+# count is stale is pushed back with its current count.
+class SpaceSaving:
+    def __init__(self, top=DEFAULT_TOP, capacity=None):
+        self.top = top
+        self.capacity = capacity or top * TOP_SLOTS
+        self.counts = {}
+        self.heap = []
+        self.sequence = itertools.count()
+
+    # A function to record a value
+    def Add(self, value):
+        entry = self.counts.get(value)
+        if entry is not None:
+            entry[0] += 1
+            return
+
+        floor = 0
+        if len(self.counts) >= self.capacity:
+            while True:
+                count, _, victim = heapq.heappop(self.heap)
+                current = self.counts[victim][0]
+                if current == count:
+                    break
+                heapq.heappush(self.heap, (current, next(self.sequence), victim))
+            del self.counts[victim]
+            floor = count
+
+        self.counts[value] = [floor + 1, floor]
+        heapq.heappush(self.heap, (floor + 1, next(self.sequence), value))
+
+    # A function to return the count a value missing from the summary may have reached
+    # 0 until the summary is full, then the least kept count
+    def Floor(self):
+        if len(self.counts) < self.capacity:
+            return 0
+        return min(count for count, _ in self.counts.values())
+
+    # A function to fold another summary into this one
+    # A value missing from one side may have been counted up to that side's floor, so it takes
+    # the floor as both count and error. The `capacity` highest merged counts are kept, and every
+    # kept count still overestimates the true count by at most its error.
+    def Merge(self, other):
+        floor, other_floor = self.Floor(), other.Floor()
+        merged = {}
+        for value in self.counts.keys() | other.counts.keys():
+            count, error = self.counts.get(value, (floor, floor))
+            other_count, other_error = other.counts.get(value, (other_floor, other_floor))
+            merged[value] = [count + other_count, error + other_error]
+
+        self.counts = dict(heapq.nlargest(self.capacity, merged.items(), key=lambda item: item[1][0]))
+        self.heap = [(count, next(self.sequence), value) for value, (count, _) in self.counts.items()]
+        heapq.heapify(self.heap)
+
+        return self
+
+    # A function to return the most frequent values as (value, count, error), highest first
+    # Values that inherited more than half their count are left out: on a column without heavy
+    # hitters (session ids) every slot churns and those counts say nothing about the value
+    def Top(self):
+        ranked = sorted(self.counts.items(), key=lambda item: item[1][0], reverse=True)
+        return [(value, count, error) for value, (count, error) in ranked if count > 2 * error][:self.top]
+
+# A class to profile every column of a table in one pass with bounded memory
+# Each column gets a HyperLogLog for its distinct count and a SpaceSaving summary for its most
+# frequent values; Add takes one row of values in column order.
+class ColumnProfile:
+    def __init__(self, columns, top=DEFAULT_TOP, precision=DEFAULT_PRECISION):
+        self.columns = list(columns)
+        self.distinct = [HyperLogLog(precision) for _ in self.columns]
+        self.frequent = [SpaceSaving(top) for _ in self.columns]
+        self.rows = 0
+
+    # A function to record one row
+    def Add(self, values):
+        self.rows += 1
+        for value, distinct, frequent in zip(values, self.distinct, self.frequent):
+            distinct.Add(value)
+            frequent.Add(value)
+
+    # A function to fold the profile of another part of the same table into this one
+    def Merge(self, other):
+        if other.columns != self.columns:
+            raise ValueError(f"Cannot merge profiles of columns {self.columns} and {other.columns}")
+
+        for distinct, frequent, other_distinct, other_frequent in zip(self.distinct, self.frequent, other.distinct, other.frequent):
+            distinct.Merge(other_distinct)
+            frequent.Merge(other_frequent)
+        self.rows += other.rows
+
+        return self
+
+    # A function to return column -> (estimated distinct values, [(value, count, error), ...])
+    def Summary(self):
+        return {column: (distinct.Count(), frequent.Top())
+                for column, distinct, frequent in zip(self.columns, self.distinct, self.frequent)}
@@ -7,13 +7,21 @@ import sqlite3
 import sys
 import json
 import ipaddress
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor
 
 # Module defaults for import-friendly usage
 LOG_PATH = os.environ.get("GEO_LOG_PATH", "geo.log")
 CONFIG_PATH = os.environ.get("GEO_CONFIG_PATH", "config.json")
 DB_PATH = os.environ.get("GEO_DB_PATH", "geo.db")
 
+# Concurrent MaxMind requests for bulk lookups, unless general.workers says otherwise
+DEFAULT_WORKERS = 8
+
+# IPs per cache lookup query, below SQLite's bound parameter limit
+LOOKUP_CHUNK = 500
+
 # Exceptions
 class GeoError(Exception):
     pass
@@ -32,10 +40,13 @@ class InvalidIPError(GeoError):
 
 __all__ = [
     "get_ip_info",
+    "get_ip_infos",
     "ReadConfig",
     "InitDatabase",
     "SaveIPInfo",
     "CheckIPInfo",
+    "CheckIPInfos",
+    "SaveIPInfos",
     "GeolocateIP",
     "Log",
     "GeoError",
@@ -204,8 +215,65 @@ def CheckIPInfo(ip, ttl=7, filepath=None):
     Log(f"No valid IP info found for: {ip}")
     return None
 
+# Function to check the cache for many IP addresses over one connection
+# Return a dictionary of IP address -> IP info for the records still valid under the TTL
+def CheckIPInfos(ips, ttl=7, filepath=None):
+    db_path = filepath or DB_PATH
+    ips = list(ips)
+    Log(f"Checking IP info for {len(ips)} addresses")
+
+    found = {}
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    for start in range(0, len(ips), LOOKUP_CHUNK):
+        chunk = ips[start:start + LOOKUP_CHUNK]
+        placeholders = ", ".join("?" for _ in chunk)
+        cursor.execute(f"SELECT * FROM geoip WHERE ip_address IN ({placeholders})", chunk)
+        columns = [column[0] for column in cursor.description]
+
+        for row in cursor.fetchall():
+            ipinfo = dict(zip(columns, row))
+            updated_at = datetime.strptime(ipinfo["updated_at"], "%Y-%m-%d %H:%M:%S")
+            if (datetime.now() - updated_at).days <= ttl:
+                found[ipinfo["ip_address"]] = ipinfo
+
+    conn.close()
+
+    Log(f"Found valid IP info for {len(found)} of {len(ips)} addresses (TTL: {ttl} days)")
+    return found
+
+# Function to save many IP records to the database in one transaction
+# created_at is kept for addresses already in the cache, like SaveIPInfo does
+def SaveIPInfos(filepath="geo.db", ipinfos=None):
+    if not ipinfos:
+        Log("No IP info to save")
+        return True
+
+    try:
+        conn = sqlite3.connect(filepath)
+        cursor = conn.cursor()
+
+        for ipinfo in ipinfos:
+            columns = ', '.join(ipinfo.keys())
+            placeholders = ', '.join('?' * len(ipinfo))
+            updates = ', '.join(f"{column} = excluded.{column}" for column in ipinfo if column != "ip_address")
+            cursor.execute(f'''INSERT INTO geoip ({columns}) VALUES ({placeholders})
+                              ON CONFLICT(ip_address) DO UPDATE SET {updates}, updated_at = CURRENT_TIMESTAMP''',
+                           tuple(ipinfo.values()))
+
+        conn.commit()
+        conn.close()
+    except sqlite3.Error as ex:
+        Log(f"Failed to save IP info to {filepath}: {ex}")
+        return True
+
+    Log(f"Saved IP info for {len(ipinfos)} addresses")
+    return False
+
 # Function to geolocate an IP address using MaxMind
-def GeolocateIP(ip, maxmind_config=None):
+# session, when given, is a requests.Session whose connection is reused across calls
+def GeolocateIP(ip, maxmind_config=None, session=None):
     # Check if MaxMind config is provided
     if maxmind_config is None:
         Log("MaxMind configuration is missing!")
@@ -238,7 +306,7 @@ def GeolocateIP(ip, maxmind_config=None):
     Log(f"MaxMind URI: {uri}")
 
     # Make a GET request to MaxMind and save the JSON response
-    raw_response = requests.get(uri, auth=auth)
+    raw_response = (session or requests).get(uri, auth=auth)
     raw_json = raw_response.json()
 
     # Get city from raw JSON
@@ -367,6 +435,78 @@ def get_ip_info(ip="me", *, config_path=None, db_path=None, force=False, ttl=Non
 
     return ipinfo
 
+# Bulk import-friendly API
+# Reads the config and opens the cache once for the whole set, then fetches the cache misses
+# from MaxMind concurrently (workers, default general.workers or 8) with one kept-alive
+# session per worker thread. Invalid addresses and failed lookups are logged and left out.
+# Returns a dictionary of IP address -> IP info; raises ConfigError or DatabaseError
+def get_ip_infos(ips, *, config_path=None, db_path=None, force=False, ttl=None, workers=None):
+    cfg_path = config_path or CONFIG_PATH
+    dbp = db_path or DB_PATH
+
+    # Validate IPs, once each
+    valid = []
+    for ip in set(ips):
+        try:
+            ipaddress.ip_address(ip)
+            valid.append(ip)
+        except ValueError:
+            Log(f"Invalid IP address: {ip}")
+
+    # Read config
+    general, maxmind = ReadConfig(cfg_path)
+    if general is None or maxmind is None:
+        raise ConfigError(f"Failed to read configuration from {cfg_path}")
+
+    edition = maxmind.get("edition")
+    editions = maxmind.get("editions", {})
+    if edition not in editions:
+        raise ConfigError(f"Invalid MaxMind edition: {edition}")
+
+    # Ensure DB exists
+    InitDatabase(dbp)
+
+    # Use cached values unless forcing
+    ttl_days = ttl if ttl is not None else general.get("ttl", 7)
+    ipinfos = {} if force else CheckIPInfos(valid, ttl_days, filepath=dbp)
+    misses = [ip for ip in valid if ip not in ipinfos]
+
+    if not misses:
+        return ipinfos
+
+    # Fetch the misses concurrently, each worker thread keeping its own session
+    local = threading.local()
+
+    def Fetch(ip):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        try:
+            ipinfo = GeolocateIP(ip, maxmind, local.session)
+            # Key the cache by the address asked for, even if traits.ip_address is missing
+            if ipinfo:
+                ipinfo["ip_address"] = ipinfo.get("ip_address") or ip
+            return ip, ipinfo
+        except Exception as ex:
+            Log(f"Failed to geolocate IP address {ip}: {ex}")
+            return ip, None
+
+    workers = workers or general.get("workers", DEFAULT_WORKERS)
+    Log(f"Geolocating {len(misses)} addresses with {workers} workers")
+
+    fetched = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for ip, ipinfo in executor.map(Fetch, misses):
+            if ipinfo:
+                fetched[ip] = ipinfo
+            else:
+                Log(f"Failed to geolocate IP address: {ip}")
+
+    if fetched and SaveIPInfos(dbp, list(fetched.values())):
+        raise DatabaseError(f"Failed to save IP info to database: {dbp}")
+
+    ipinfos.update(fetched)
+    return ipinfos
+
 # Main function
 def main():
     # Read the configuration
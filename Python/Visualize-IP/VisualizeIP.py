@@ -2,16 +2,54 @@
 
 import json
 import csv
+import itertools
 import sys
 import argparse
 import sqlite3
 import os
+import hashlib
 from datetime import datetime
-from GeolocateIP import get_ip_info
+from GeolocateIP import get_ip_infos, GeoError
+from ColumnSketch import ColumnProfile, DEFAULT_TOP
+import numpy as np
+import matplotlib
 import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import cartopy
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 
+# Rows per executemany batch during the CSV load
+CHUNK_SIZE = 10000
+
+# Geolocation columns of the ip_info table, in insert order
+IP_INFO_COLUMNS = ("ip_address", "city", "state", "state_code", "country", "country_code",
+                   "continent", "continent_code", "postal_code", "latitude", "longitude")
+
+# Location columns of the aggregates table, coarsest first, and how many of them each level keeps
+AGGREGATE_COLUMNS = ("continent", "continent_code", "country", "country_code", "state", "state_code", "city")
+AGGREGATE_LEVELS = {"continent": 2, "country": 4, "state": 6, "city": 7}
+
+# Map locations above which points are binned into a density grid instead of scattered
+DENSITY_THRESHOLD = 5000
+
+# Map extents (lon min, lon max, lat min, lat max) and density grid cell sizes in degrees
+WORLD_EXTENT = (-180, 180, -90, 90)
+WORLD_CELL = 1.0
+US_EXTENT = (-125, -66.5, 24, 49.5)
+US_CELL = 0.25
+
+# Base map layers: (cartopy.feature name, style) drawn under the data, in order
+WORLD_FEATURES = (("LAND", {}), ("OCEAN", {}), ("COASTLINE", {}), ("BORDERS", {"linestyle": ":", "edgecolor": "gray"}),
+                  ("LAKES", {"alpha": 0.5}), ("RIVERS", {}))
+US_FEATURES = (("LAND", {}), ("OCEAN", {}), ("COASTLINE", {}), ("BORDERS", {"linestyle": ":"}),
+               ("LAKES", {"alpha": 0.5}), ("RIVERS", {}), ("STATES", {"edgecolor": "gray"}))
+
+# Directory of rendered base map rasters, reused across runs
+BASEMAP_CACHE = "basemap_cache"
+
 # A function to write a log file
 def Log(message, tee=False):
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -28,21 +66,23 @@ def Log(message, tee=False):
     except Exception as ex:
         print(f"[{timestamp}] Failed to write log to {LOG_PATH}: {ex}")
 
-# Function to read CSV file and return data as a list of dictionaries
+# A function to normalize a CSV header into a column name
+# Lowercase, with spaces and path/dash symbols turned into underscores
+def NormalizeKey(key):
+    return key.lower().strip().replace(" ", "_").replace("-", "_").replace("/", "_").replace("\\", "_")
+
+# Function to read CSV file and yield one dictionary per row
+# Rows are streamed, so memory stays the same whatever the file size
 def ReadCSV(file_path="data.csv"):
     # Check if the file exists
     try:
-        data = []
-        with open(file_path, mode='r') as file:
+        with open(file_path, mode='r', newline='') as file:
             csv_reader = csv.DictReader(file)
             for row in csv_reader:
-                data.append(row)
-        return data
+                yield row
     except FileNotFoundError:
         Log(f"Error: The file {file_path} does not exist.")
 
-    return []
-
 # Function to create a sqlite database from CSV data
 def InitDB(columns, db_file="data.db"):
     # Check if the file exists and return True if it does
@@ -59,13 +99,12 @@ def InitDB(columns, db_file="data.db"):
         create_table_query = f"CREATE TABLE data ({columns_with_types});"
         cursor.execute(create_table_query)
 
-        # Create table that stores IP address lookups
+        # Create table that stores IP address lookups, one row per distinct address
         # Primary Key - IP Address
-        # Columns - City, State, Country, Continent, Latitude, Longitude
+        # Columns - City, State, Country, Continent, Latitude, Longitude, and the activity
+        # (first/last seen in UTC, row count) summarized from the data table
         create_ip_table_query = """CREATE TABLE ip_info (
             ip_address TEXT PRIMARY KEY,
-            date TIMESTAMP,
-            user TEXT,
             city TEXT,
             state TEXT,
             state_code TEXT,
@@ -75,10 +114,36 @@ def InitDB(columns, db_file="data.db"):
             continent_code TEXT,
             postal_code TEXT,
             latitude REAL,
-            longitude REAL
+            longitude REAL,
+            first_seen TIMESTAMP,
+            last_seen TIMESTAMP,
+            count INTEGER
         );"""
         cursor.execute(create_ip_table_query)
 
+        # Create table that stores the location breakdowns computed by BuildAggregates
+        cursor.execute(f"""CREATE TABLE aggregates (
+            level TEXT,
+            {" TEXT, ".join(AGGREGATE_COLUMNS)} TEXT,
+            ips INTEGER,
+            hits INTEGER
+        );""")
+        cursor.execute("CREATE INDEX aggregates_level ON aggregates (level);")
+
+        # Create tables that store the per-column profile: distinct values and most frequent values
+        # exact is 0 for sketch estimates (top counts overestimate by at most error) and 1 for counted values
+        cursor.execute("""CREATE TABLE column_profile (
+            column_name TEXT PRIMARY KEY,
+            distinct_values INTEGER,
+            exact BOOLEAN
+        );""")
+        cursor.execute("""CREATE TABLE column_top (
+            column_name TEXT,
+            value TEXT,
+            count INTEGER,
+            error INTEGER
+        );""")
+
         conn.commit()
         conn.close()
     except sqlite3.Error as e:
@@ -88,55 +153,107 @@ def InitDB(columns, db_file="data.db"):
     return False
 
 # Function to save data to the database
-def SaveCsvToDB(data, db_file="data.db"):
+# rows is any iterable of CSV row dictionaries and is consumed once. Rows are inserted in
+# chunks of chunk_size with executemany under bulk-load pragmas, and indexes are built after
+# the load. ips, when given, is a set that collects the distinct ip_address values from the
+# same pass, so the addresses can be geolocated without reading the data again. profile, when
+# given, is a ColumnProfile over the data columns that is fed every row from the same pass.
+# Return the number of rows saved, or None on error
+def SaveCsvToDB(rows, db_file="data.db", chunk_size=CHUNK_SIZE, ips=None, profile=None):
     try:
         conn = sqlite3.connect(db_file)
         cursor = conn.cursor()
 
+        # The database is rebuilt from the CSV on failure, so skip the journal and fsyncs
+        cursor.execute("PRAGMA journal_mode = OFF;")
+        cursor.execute("PRAGMA synchronous = OFF;")
+        cursor.execute("PRAGMA temp_store = MEMORY;")
+
+        cursor.execute("PRAGMA table_info(data);")
+        columns = [info[1] for info in cursor.fetchall()]
+        ip_index = columns.index("ip_address") if ips is not None and "ip_address" in columns else None
+
         # Prepare insert query
-        placeholders = ", ".join(["?" for _ in data[0]])
+        placeholders = ", ".join(["?" for _ in columns])
         insert_query = f"INSERT INTO data VALUES ({placeholders});"
 
-        # Insert each row
-        for row in data:
-            cursor.execute(insert_query, tuple(row.values()))
+        # Insert rows a chunk at a time
+        count = 0
+        chunk = []
+        for row in rows:
+            # Short rows are padded and extra fields (DictReader's restkey list) are cut
+            values = list(row.values())[:len(columns)]
+            values += [None] * (len(columns) - len(values))
+            chunk.append(values)
+
+            if ip_index is not None and values[ip_index]:
+                ips.add(values[ip_index])
+
+            if profile is not None:
+                profile.Add(values)
 
+            if len(chunk) >= chunk_size:
+                cursor.executemany(insert_query, chunk)
+                count += len(chunk)
+                chunk = []
+                Log(f"Saved {count} rows to {db_file}.")
+
+        cursor.executemany(insert_query, chunk)
+        count += len(chunk)
         conn.commit()
+
+        CreateIndexes(conn, columns)
+
         conn.close()
     except sqlite3.Error as e:
         Log(f"Error saving to database: {e}")
-        return True
-    
-    return False
+        return None
+
+    return count
+
+# Function to create the lookup indexes once the bulk load is done
+# Building them after the load sorts each index once instead of updating it per row
+def CreateIndexes(conn, columns):
+    cursor = conn.cursor()
+
+    if "ip_address" in columns:
+        cursor.execute("CREATE INDEX IF NOT EXISTS data_ip_address ON data (ip_address);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ip_info_country ON ip_info (country);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ip_info_country_code ON ip_info (country_code);")
 
-# Function to save IP info to the database
+    conn.commit()
+
+# Function to turn an ip_info dictionary into the values of IP_INFO_COLUMNS
+def IPInfoValues(info):
+    return tuple(info.get(column) for column in IP_INFO_COLUMNS)
+
+# Function to save IP info to the database, one row per address
+# The geolocation is staged in a temporary table and joined to the activity of each address,
+# which SQL summarizes from the data table: first and last seen (UTC, from the date column
+# when there is one) and the number of rows.
 def SaveIPInfoToDB(ip_info, db_file="data.db"):
     try:
         conn = sqlite3.connect(db_file)
         cursor = conn.cursor()
 
-        # Prepare insert query with ON CONFLICT clause to ignore duplicates
-        insert_query = """INSERT INTO ip_info (ip_address, date, user, city, state, state_code, country, country_code, continent, continent_code, postal_code, latitude, longitude)
-                          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                          ON CONFLICT(ip_address) DO NOTHING;"""
-
-        # Insert each IP info
-        for ip, info in ip_info.items():
-            cursor.execute(insert_query, (
-                ip,
-                info.get("date"),
-                info.get("user"),
-                info.get("city"),
-                info.get("state"),
-                info.get("state_code"),
-                info.get("country"),
-                info.get("country_code"),
-                info.get("continent"),
-                info.get("continent_code"),
-                info.get("postal_code"),
-                info.get("latitude"),
-                info.get("longitude")
-            ))
+        cursor.execute(f"CREATE TEMP TABLE ip_geo ({', '.join(IP_INFO_COLUMNS)});")
+        cursor.executemany(f"INSERT INTO ip_geo VALUES ({', '.join('?' for _ in IP_INFO_COLUMNS)});",
+                           [IPInfoValues({**info, "ip_address": ip}) for ip, info in ip_info.items()])
+
+        cursor.execute("PRAGMA table_info(data);")
+        if "date" in [info[1] for info in cursor.fetchall()]:
+            first_seen, last_seen = "datetime(MIN(julianday(date)))", "datetime(MAX(julianday(date)))"
+        else:
+            first_seen, last_seen = "NULL", "NULL"
+
+        # data is indexed on ip_address, so the GROUP BY walks the index without sorting
+        geo_columns = ", ".join(f"g.{column}" for column in IP_INFO_COLUMNS)
+        cursor.execute(f"""INSERT INTO ip_info ({", ".join(IP_INFO_COLUMNS)}, first_seen, last_seen, count)
+                           SELECT {geo_columns}, a.first_seen, a.last_seen, a.count
+                           FROM (SELECT ip_address, {first_seen} AS first_seen, {last_seen} AS last_seen, COUNT(*) AS count
+                                 FROM data
+                                 GROUP BY ip_address) a
+                           JOIN temp.ip_geo g ON g.ip_address = a.ip_address;""")
 
         conn.commit()
         conn.close()
@@ -146,192 +263,322 @@ def SaveIPInfoToDB(ip_info, db_file="data.db"):
     
     return False
 
-# Function to get occurrence count where same city, state, country, continent appear
-def GetCityCount(db_file="data.db"):
-    city_count = {}
+# Function to simplify the GeolocateIP record of one address into the ip_info columns
+def SimplifyIPInfo(ip, info):
+    simple = {"ip_address": ip}
+    simple["city"] = info.get("city_name", "unknown")
+    # State is name from the first element in subdivisions array after converting from JSON string to Python list
+    subdivisions = info.get("subdivisions", [])
+    if isinstance(subdivisions, str):
+        try:
+            subdivisions = json.loads(subdivisions)
+        except json.JSONDecodeError:
+            subdivisions = []
+    subdivision = subdivisions[0] if subdivisions else None
+    simple["state"] = subdivision.get("name", "unknown") if subdivision else "unknown"
+    simple["state_code"] = subdivision.get("iso_code", "unknown") if subdivision else "unknown"
+    simple["country"] = info.get("country_name", "unknown")
+    simple["country_code"] = info.get("country_iso_code", "unknown")
+    simple["continent"] = info.get("continent_name", "unknown")
+    simple["continent_code"] = info.get("continent_code", "unknown")
+    simple["postal_code"] = info.get("postal_code", "unknown")
+    simple["latitude"] = info.get("latitude", 0.0)
+    simple["longitude"] = info.get("longitude", 0.0)
+
+    return simple
+
+# Function to compute every location breakdown into the aggregates table in one pass
+# ip_info is grouped once at the finest level (continent, country, state, city) and the groups
+# are rolled up into each coarser level as they stream by, so the cost is one scan of ip_info
+# plus one pass over its groups however many levels are kept. Each aggregates row holds the
+# level, the location columns down to that level ('' below it), the distinct addresses (ips)
+# and the data rows behind them (hits).
+def BuildAggregates(db_file="data.db"):
     try:
         conn = sqlite3.connect(db_file)
         cursor = conn.cursor()
 
-        # Query to get city, state, country, continent counts
-        query = """SELECT city, state_code, country_code, continent_code, COUNT(*) as count
-                   FROM ip_info
-                   GROUP BY city, state_code, country_code, continent_code;"""
+        # Query the finest groups
+        query = f"""SELECT {", ".join(AGGREGATE_COLUMNS)}, COUNT(*), SUM(count)
+                    FROM ip_info
+                    GROUP BY {", ".join(AGGREGATE_COLUMNS)};"""
         cursor.execute(query)
-        rows = cursor.fetchall()
 
-        for row in rows:
-            city, state, country, continent, count = row
-            key = f"{city}, {state}, {country}, {continent}"
-            city_count[key] = count
+        # Roll each group up into every level; a level keeps its prefix of the columns
+        totals = {level: {} for level in AGGREGATE_LEVELS}
+        for row in cursor:
+            location, ips, hits = row[:-2], row[-2], row[-1] or 0
+            for level, depth in AGGREGATE_LEVELS.items():
+                key = location[:depth] + ("",) * (len(AGGREGATE_COLUMNS) - depth)
+                total = totals[level].get(key, (0, 0))
+                totals[level][key] = (total[0] + ips, total[1] + hits)
+
+        cursor.execute("DELETE FROM aggregates;")
+        cursor.executemany(f"INSERT INTO aggregates VALUES (?, {', '.join('?' for _ in AGGREGATE_COLUMNS)}, ?, ?);",
+                           ((level, *key, ips, hits) for level, groups in totals.items() for key, (ips, hits) in groups.items()))
 
+        conn.commit()
         conn.close()
     except sqlite3.Error as e:
-        Log(f"Error retrieving city counts: {e}")
-        return {}
+        Log(f"Error building aggregates: {e}")
+        return True
 
-    return city_count
+    return False
 
-# Function to get occurence count where same state, country, continent appear
-def GetStateCount(db_file="data.db"):
-    state_count = {}
+# Function to read one level of the aggregates table as an occurrence count
+# key_columns are joined with ", " into each key; rows that share a key are added together.
+# value is "ips" (distinct addresses) or "hits" (data rows). country_filter keeps the rows
+# whose country or country_code matches.
+def GetAggregateCount(level, key_columns, db_file="data.db", value="ips", country_filter=None):
+    counts = {}
     try:
         conn = sqlite3.connect(db_file)
         cursor = conn.cursor()
 
-        # Query to get state, country, continent counts
-        query = """SELECT state, country_code, continent_code, COUNT(*) as count
-                   FROM ip_info
-                   GROUP BY state, country_code, continent_code;"""
-        cursor.execute(query)
-        rows = cursor.fetchall()
+        query = f"SELECT {', '.join(key_columns)}, {value} FROM aggregates WHERE level = ?"
+        params = [level]
+        if country_filter is not None:
+            query += " AND (country = ? OR country_code = ?)"
+            params += [country_filter, country_filter]
+        cursor.execute(query + ";", params)
 
-        for row in rows:
-            state, country, continent, count = row
-            key = f"{state}, {country}, {continent}"
-            state_count[key] = count
+        for row in cursor.fetchall():
+            key = ", ".join(f"{column}" for column in row[:-1])
+            counts[key] = counts.get(key, 0) + row[-1]
 
         conn.close()
     except sqlite3.Error as e:
-        Log(f"Error retrieving state counts: {e}")
+        Log(f"Error retrieving {level} counts: {e}")
         return {}
 
-    return state_count
-
-# Function to get occurence count where same state filtered by country or country_code
-def GetStateByCountryCount(country_filter, db_file="data.db"):
-    state_count = {}
-    try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-
-        # Query to get state counts filtered by country or country_code
-        query = """SELECT state, COUNT(*) as count
-                   FROM ip_info
-                   WHERE country = ? OR country_code = ?
-                   GROUP BY state;"""
-        cursor.execute(query, (country_filter, country_filter))
-        rows = cursor.fetchall()
+    return counts
 
-        for row in rows:
-            state, count = row
-            key = f"{state}"
-            state_count[key] = count
+# Function to get occurrence count where same city, state, country, continent appear
+def GetCityCount(db_file="data.db", value="ips"):
+    return GetAggregateCount("city", ["city", "state_code", "country_code", "continent_code"], db_file, value)
 
-        conn.close()
-    except sqlite3.Error as e:
-        Log(f"Error retrieving state by country counts: {e}")
-        return {}
+# Function to get occurence count where same state, country, continent appear
+def GetStateCount(db_file="data.db", value="ips"):
+    return GetAggregateCount("state", ["state", "country_code", "continent_code"], db_file, value)
 
-    return state_count
+# Function to get occurence count where same state filtered by country or country_code
+def GetStateByCountryCount(country_filter, db_file="data.db", value="ips"):
+    return GetAggregateCount("state", ["state"], db_file, value, country_filter)
 
 # Function to get occurrence count where same country, continent appear
-def GetCountryCount(db_file="data.db"):
-    country_count = {}
+def GetCountryCount(db_file="data.db", value="ips"):
+    return GetAggregateCount("country", ["country", "continent_code"], db_file, value)
+
+# Function to get occurrence count where same continent appears
+def GetContinentCount(db_file="data.db", value="ips"):
+    return GetAggregateCount("continent", ["continent"], db_file, value)
+
+# Function to get Latitude and Longitude for mapping, one point per distinct location
+# Addresses that share a location are folded in SQL and weighted by their data rows, and the
+# rows are read straight into NumPy without building Python tuples. country_filter keeps the
+# addresses whose country or country_code matches.
+# Return latitude, longitude and weight arrays (empty on error)
+def GetLatLong(db_file="data.db", country_filter=None):
     try:
         conn = sqlite3.connect(db_file)
         cursor = conn.cursor()
 
-        # Query to get country, continent counts
-        query = """SELECT country, continent_code, COUNT(*) as count
+        # Query to get latitude, longitude and sign-ins per location
+        # A NULL count (no matching data rows) still marks the location once
+        query = """SELECT latitude, longitude, SUM(COALESCE(count, 1))
                    FROM ip_info
-                   GROUP BY country, continent_code;"""
-        cursor.execute(query)
-        rows = cursor.fetchall()
+                   WHERE latitude IS NOT NULL AND longitude IS NOT NULL"""
+        params = ()
+        if country_filter is not None:
+            query += " AND (country = ? OR country_code = ?)"
+            params = (country_filter, country_filter)
+        cursor.execute(query + " GROUP BY latitude, longitude;", params)
 
-        for row in rows:
-            country, continent, count = row
-            key = f"{country}, {continent}"
-            country_count[key] = count
+        points = np.fromiter(itertools.chain.from_iterable(cursor), dtype=float).reshape(-1, 3)
 
         conn.close()
     except sqlite3.Error as e:
-        Log(f"Error retrieving country counts: {e}")
-        return {}
+        Log(f"Error retrieving latitude and longitude: {e}")
+        points = np.empty((0, 3))
 
-    return country_count
+    return points[:, 0], points[:, 1], points[:, 2]
 
-# Function to get occurrence count where same continent appears
-def GetContinentCount(db_file="data.db"):
-    continent_count = {}
+# Function to get Latitude and Longitude for mapping, filtered by country or country_code
+def GetLatLongByCountry(country_filter, db_file="data.db"):
+    return GetLatLong(db_file, country_filter)
+
+# Function to draw weighted map points on a Cartopy axes
+# Up to threshold locations are scattered with the marker area following the weight. Above it
+# the points are summed into a grid of cell degrees over extent and drawn as one mesh on a log
+# color scale, so the cost follows the number of cells rather than the number of points.
+# Return "points" or "density"
+def PlotLocations(ax, latitudes, longitudes, weights, extent, cell, color, cmap, threshold=DENSITY_THRESHOLD):
+    if len(latitudes) <= threshold:
+        ax.scatter(longitudes, latitudes, color=color, s=10 * np.sqrt(weights), alpha=0.7, transform=ccrs.PlateCarree())
+        return "points"
+
+    lon_edges = np.arange(extent[0], extent[1] + cell, cell)
+    lat_edges = np.arange(extent[2], extent[3] + cell, cell)
+    grid, _, _ = np.histogram2d(longitudes, latitudes, bins=(lon_edges, lat_edges), weights=weights)
+
+    # Empty cells stay transparent so the base map shows through
+    grid = np.ma.masked_equal(grid.T, 0)
+    if grid.count():
+        mesh = ax.pcolormesh(lon_edges, lat_edges, grid, cmap=cmap, norm=LogNorm(), alpha=0.8, linewidth=0, antialiased=False, transform=ccrs.PlateCarree())
+        plt.colorbar(mesh, ax=ax, shrink=0.6, label=f"Sign-ins per {cell} degree cell")
+
+    return "density"
+
+# Function to set a map to an extent (lon min, lon max, lat min, lat max), the whole globe for WORLD_EXTENT
+def SetMapExtent(ax, extent):
+    if extent == WORLD_EXTENT:
+        ax.set_global()
+    else:
+        ax.set_extent(extent, crs=ccrs.PlateCarree())
+
+# Function to add base map features to a map
+def AddMapFeatures(ax, features):
+    for name, style in features:
+        ax.add_feature(getattr(cfeature, name), **style)
+
+# Function to key a base map raster by everything that changes its pixels
+def BaseMapKey(projection, extent, figsize, dpi, features):
+    key = json.dumps({"projection": projection.proj4_init, "extent": extent, "figsize": figsize, "dpi": dpi,
+                      "features": features, "cartopy": cartopy.__version__, "matplotlib": matplotlib.__version__}, sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+# Function to render the base layer of a map into a PNG holding just the map area
+# Drawn on its own Agg canvas, outside pyplot, so the figure being built is not disturbed.
+# The file is written next to its destination and renamed over it, so a concurrent run never
+# reads a partial raster.
+def RenderBaseMap(projection, extent, figsize, dpi, features, path):
+    fig = Figure(figsize=figsize, dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1], projection=projection)
+    SetMapExtent(ax, extent)
+    AddMapFeatures(ax, features)
+    canvas.draw()
+
+    # Crop the canvas to the map, which keeps its aspect inside the figure
+    height = canvas.get_width_height()[1]
+    box = ax.get_window_extent()
+    x0, x1 = round(box.x0), round(box.x1)
+    y0, y1 = height - round(box.y1), height - round(box.y0)
+    image = np.asarray(canvas.buffer_rgba())[y0:y1, x0:x1]
+
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    plt.imsave(temp_path, image, format="png")
+    os.replace(temp_path, path)
+
+# Function to draw the base layer of a map under the data
+# The features are rendered once per projection, extent, size and Cartopy version and cached as a
+# raster in cache_dir; later runs only place that image, so the Natural Earth geometry is not
+# loaded or projected again. An empty cache_dir draws the features directly.
+# Return "cached", "rendered" or "drawn"
+def DrawBaseMap(ax, extent, figsize, features, cache_dir=BASEMAP_CACHE):
+    if not cache_dir:
+        AddMapFeatures(ax, features)
+        return "drawn"
+
+    key = BaseMapKey(ax.projection, extent, figsize, ax.figure.dpi, features)
+    path = os.path.join(cache_dir, f"basemap_{key}.png")
+
+    status = "cached"
+    if not os.path.isfile(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        RenderBaseMap(ax.projection, extent, figsize, ax.figure.dpi, features, path)
+        status = "rendered"
+        Log(f"Base map rendered to {path}")
+
+    # Same projection as the axes, so Cartopy places the image without regridding it
+    ax.imshow(plt.imread(path), origin="upper", extent=ax.get_extent(), transform=ax.projection, zorder=0)
+    SetMapExtent(ax, extent)
+
+    return status
+
+# Function to save a column profile to the database, replacing any previous one
+# summary is column -> (distinct values, [(value, count, error), ...]) as ColumnProfile.Summary returns
+def SaveProfileToDB(summary, exact=False, db_file="data.db"):
     try:
         conn = sqlite3.connect(db_file)
         cursor = conn.cursor()
 
-        # Query to get continent counts
-        query = """SELECT continent, COUNT(*) as count
-                   FROM ip_info
-                   GROUP BY continent;"""
-        cursor.execute(query)
-        rows = cursor.fetchall()
-
-        for row in rows:
-            continent, count = row
-            key = f"{continent}"
-            continent_count[key] = count
+        cursor.execute("DELETE FROM column_profile;")
+        cursor.execute("DELETE FROM column_top;")
+        cursor.executemany("INSERT INTO column_profile VALUES (?, ?, ?);",
+                           [(column, distinct, exact) for column, (distinct, _) in summary.items()])
+        cursor.executemany("INSERT INTO column_top VALUES (?, ?, ?, ?);",
+                           [(column, *top) for column, (_, tops) in summary.items() for top in tops])
 
+        conn.commit()
         conn.close()
     except sqlite3.Error as e:
-        Log(f"Error retrieving continent counts: {e}")
-        return {}
+        Log(f"Error saving column profile: {e}")
+        return True
 
-    return continent_count
+    return False
 
-# Function to get Latitude and Longitude for mapping
-def GetLatLong(db_file="data.db"):
-    lat_long = []
+# Function to profile every column exactly with one GROUP BY scan per column
+# The slow path the sketches replace, kept for when exact counts are needed
+# Return the same shape as ColumnProfile.Summary, with every error 0
+def ExactProfile(top=DEFAULT_TOP, db_file="data.db"):
+    summary = {}
     try:
         conn = sqlite3.connect(db_file)
         cursor = conn.cursor()
 
-        # Query to get latitude and longitude
-        query = """SELECT latitude, longitude
-                   FROM ip_info
-                   WHERE latitude IS NOT NULL AND longitude IS NOT NULL;"""
-        cursor.execute(query)
-        rows = cursor.fetchall()
+        # Get column names
+        cursor.execute("PRAGMA table_info(data);")
+        columns = [info[1] for info in cursor.fetchall()]
 
-        for row in rows:
-            lat, lon = row
-            if lat is not None and lon is not None:
-                lat_long.append((lat, lon))
+        # For each column, count the distinct values and keep the most frequent
+        for col in columns:
+            cursor.execute(f"SELECT {col}, COUNT(*) AS count FROM data GROUP BY {col} ORDER BY count DESC;")
+            distinct = 0
+            tops = []
+            for value, count in cursor:
+                distinct += 1
+                if len(tops) < top:
+                    tops.append((value, count, 0))
+            summary[col] = (distinct, tops)
 
         conn.close()
     except sqlite3.Error as e:
-        Log(f"Error retrieving latitude and longitude: {e}")
-        return []
+        Log(f"Error profiling columns: {e}")
+        return {}
 
-    return lat_long
+    return summary
 
-# Function to get Latitude and Longitude for mapping, filtered by country or country_code
-def GetLatLongByCountry(country_filter, db_file="data.db"):
-    lat_long = []
+# Function to read the stored column profile
+# Return column -> (distinct values, exact, [(value, count, error), ...])
+def GetColumnProfile(db_file="data.db"):
+    profile = {}
     try:
         conn = sqlite3.connect(db_file)
         cursor = conn.cursor()
 
-        # Query to get latitude and longitude filtered by country or country_code
-        query = """SELECT latitude, longitude
-                   FROM ip_info
-                   WHERE (country = ? OR country_code = ?)
-                     AND latitude IS NOT NULL AND longitude IS NOT NULL;"""
-        cursor.execute(query, (country_filter, country_filter))
-        rows = cursor.fetchall()
+        cursor.execute("SELECT column_name, distinct_values, exact FROM column_profile;")
+        for column, distinct, exact in cursor.fetchall():
+            profile[column] = (distinct, bool(exact), [])
 
-        for row in rows:
-            lat, lon = row
-            if lat is not None and lon is not None:
-                lat_long.append((lat, lon))
+        cursor.execute("SELECT column_name, value, count, error FROM column_top ORDER BY column_name, count DESC;")
+        for column, value, count, error in cursor.fetchall():
+            profile[column][2].append((value, count, error))
 
         conn.close()
     except sqlite3.Error as e:
-        Log(f"Error retrieving latitude and longitude by country: {e}")
-        return []
+        Log(f"Error retrieving column profile: {e}")
+        return {}
+
+    return profile
 
-    return lat_long
+# Function that returns the most frequent values of every column with their occurrence count
+# Read from the profile stored at ingest, so no column is rescanned; exact=True counts every
+# distinct value with a GROUP BY per column instead, as this function used to
+def GetUniqueValues(db_file="data.db", exact=False):
+    if not exact:
+        return {column: [(value, count) for value, count, _ in tops] for column, (_, _, tops) in GetColumnProfile(db_file).items()}
 
-# Function that takes unique values from all columns and returns an occurrence count
-def GetUniqueValues(db_file="data.db"):
     unique_values = {}
     try:
         conn = sqlite3.connect(db_file)
@@ -357,66 +604,70 @@ def main():
     # Parse Arguments
     parser = argparse.ArgumentParser(description="Convert CSV to JSON")
     parser.add_argument("--input", type=str, default="data.csv", help="Input CSV file path")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Rows per insert batch")
+    parser.add_argument("--profile-top", type=int, default=DEFAULT_TOP, help="Most frequent values kept per column, 0 = no column profile")
+    parser.add_argument("--exact-profile", action="store_true", help="Profile columns with exact GROUP BY counts instead of sketches")
+    parser.add_argument("--density-threshold", type=int, default=DENSITY_THRESHOLD, help="Map locations above which points are binned into a density grid")
+    parser.add_argument("--basemap-cache", type=str, default=BASEMAP_CACHE, help="Directory of cached base map rasters, empty to draw the features every run")
+    parser.add_argument("--workers", type=int, default=None, help="Concurrent MaxMind lookups (default general.workers or 8)")
     args = parser.parse_args()
     Log(f"Input file: {args.input}")
 
+    # Rows are streamed; only the first one is read ahead for type inference
     rows = ReadCSV(args.input)
-    Log(f"Read {len(rows)} rows from {args.input}.")
+    first = next(rows, None)
 
     # Check if there is data to convert
-    if rows in [None, []]:
+    if not first:
         Log("No data found.")
         return 1
     
     # Try to associate keys/Values to a SQLite data type
     keys = {}
-    if rows[0]:
-        for key, value in rows[0].items():
-            # Clean up the key for database
-            Log(f"Processing key: '{key}' with sample value: '{value}'")
-            key = key.lower()
-            Log(f"Normalized key to lowercase: '{key}'")
-            key = key.strip().replace(" ", "_").replace("-", "_").replace("/", "_").replace("\\", "_")
-            Log(f"Sanitized key for database: '{key}'")
-
-            # Check if value is int, float, bool, date or string
-
-            # Int check
-            try:
-                int(value)
-                keys[key] = "INTEGER"
-                Log(f"Key '{key}' detected as INTEGER.")
-                continue
-            except ValueError:
-                pass
-            
-            # Float check
-            try:
-                float(value)
-                keys[key] = "REAL"
-                Log(f"Key '{key}' detected as REAL.")
-                continue
-            except ValueError:
-                pass
-            
-            # Date check (2025-10-15T08:13:39-06:00)
-            try:
-                datetime.strptime(value, "%Y-%m-%dT%H:%M:%S%z")
-                keys[key] = "DATE"
-                Log(f"Key '{key}' detected as DATE.")
-                continue
-            except ValueError:
-                pass    
-
-            # Bool check
-            if value.lower() in ["true", "false"]:
-                keys[key] = "BOOLEAN"
-                Log(f"Key '{key}' detected as BOOLEAN.")
-                continue
-
-            # If we reach here, it's a string
-            keys[key] = "TEXT"
-            Log(f"Key '{key}' detected as TEXT.")
+    for key, value in first.items():
+        # Clean up the key for database
+        Log(f"Processing key: '{key}' with sample value: '{value}'")
+        key = NormalizeKey(key)
+        Log(f"Sanitized key for database: '{key}'")
+
+        # Check if value is int, float, bool, date or string
+
+        # Int check
+        try:
+            int(value)
+            keys[key] = "INTEGER"
+            Log(f"Key '{key}' detected as INTEGER.")
+            continue
+        except ValueError:
+            pass
+        
+        # Float check
+        try:
+            float(value)
+            keys[key] = "REAL"
+            Log(f"Key '{key}' detected as REAL.")
+            continue
+        except ValueError:
+            pass
+        
+        # Date check (2025-10-15T08:13:39-06:00)
+        try:
+            datetime.strptime(value, "%Y-%m-%dT%H:%M:%S%z")
+            keys[key] = "DATE"
+            Log(f"Key '{key}' detected as DATE.")
+            continue
+        except ValueError:
+            pass    
+
+        # Bool check
+        if value.lower() in ["true", "false"]:
+            keys[key] = "BOOLEAN"
+            Log(f"Key '{key}' detected as BOOLEAN.")
+            continue
+
+        # If we reach here, it's a string
+        keys[key] = "TEXT"
+        Log(f"Key '{key}' detected as TEXT.")
 
     # Append data.db with timestamp, yyyymmdd_hhmmss
     db_file = f"data_{TIMESTAMP}.db"
@@ -424,52 +675,52 @@ def main():
         Log(f"Database {db_file} failed to create.")
         return 1
     Log(f"Database {db_file} created successfully.")
-    
-    if SaveCsvToDB(rows, db_file):
+
+    # Collect the distinct IP addresses in the same pass as the load
+    ips = set()
+    if "ip_address" not in keys:
+        Log("No 'ip_address' column found in data.")
+        ips = None
+
+    # Profile every column in the same pass too, unless exact counts were asked for
+    profile = None
+    if args.profile_top > 0 and not args.exact_profile:
+        profile = ColumnProfile(keys, args.profile_top)
+
+    count = SaveCsvToDB(itertools.chain([first], rows), db_file, args.chunk_size, ips, profile)
+    if count is None:
         Log(f"Failed to save data to database {db_file}.")
         return 1
-    Log(f"Data successfully saved to database {db_file}.")
-    
-    # Get Date, User, IP Address, and get IP info from GeolocateIP to save to DB
-    for row in rows:
-        # Normalize keys to lowercase and underscores
-        row = {k.lower().strip().replace(" ", "_").replace("-", "_").replace("/", "_").replace("\\", "_"): v for k, v in row.items()}   
-        if "ip_address" in row:
-            ip = row["ip_address"]
-            user = row.get("user", "unknown")
-            date = row.get("date", datetime.now().strftime("%Y-%m-%dT%H:%M:%S%z"))
-            if ip:
-                info = get_ip_info(ip)
-                if info:
-                    info["date"] = date
-                    info["user"] = user
-                    info["city"] = info.get("city_name", "unknown")
-                    # State is name from the first element in subdivisions array after converting from JSON string to Python list
-                    subdivisions = info.get("subdivisions", [])
-                    if isinstance(subdivisions, str):
-                        try:
-                            subdivisions = json.loads(subdivisions)
-                        except json.JSONDecodeError:
-                            subdivisions = []
-                    subdivision = subdivisions[0] if subdivisions else None
-                    info["state"] = subdivision.get("name", "unknown") if subdivision else "unknown"
-                    info["state_code"] = subdivision.get("iso_code", "unknown") if subdivision else "unknown"
-                    info["country"] = info.get("country_name", "unknown")
-                    info["country_code"] = info.get("country_iso_code", "unknown")
-                    info["continent"] = info.get("continent_name", "unknown")
-                    info["continent_code"] = info.get("continent_code", "unknown")
-                    info["postal_code"] = info.get("postal_code", "unknown")
-                    info["latitude"] = info.get("latitude", 0.0)
-                    info["longitude"] = info.get("longitude", 0.0)
-                    SaveIPInfoToDB({ip: info}, db_file)
-                    Log(f"Saved IP info for {ip}: {info}")
-                else:
-                    Log(f"Failed to get IP info for {ip}")
-            else:
-                Log("No IP address found in row.")
-        else:
-            Log("No 'ip_address' column found in data.")
+    Log(f"Saved {count} rows from {args.input} to database {db_file}.")
+
+    if args.profile_top > 0:
+        summary = ExactProfile(args.profile_top, db_file) if args.exact_profile else profile.Summary()
+        if SaveProfileToDB(summary, args.exact_profile, db_file):
+            Log(f"Failed to save column profile to database {db_file}.")
+            return 1
+        for column, (distinct, tops) in summary.items():
+            Log(f"Column '{column}': {'' if args.exact_profile else '~'}{distinct} distinct values, top {[(value, count) for value, count, _ in tops[:5]]}")
+
+    # Geolocate each distinct address once; GeolocateIP serves the cache and fetches the misses concurrently
+    if ips:
+        Log(f"Geolocating {len(ips)} distinct IP addresses.")
+        try:
+            infos = get_ip_infos(ips, workers=args.workers)
+        except GeoError as e:
+            Log(f"Failed to geolocate IP addresses: {e}")
+            return 1
+
+        ip_info = {ip: SimplifyIPInfo(ip, info) for ip, info in infos.items()}
+        if SaveIPInfoToDB(ip_info, db_file):
+            Log(f"Failed to save IP info to database {db_file}.")
+            return 1
+        Log(f"Saved IP info for {len(ip_info)} of {len(ips)} addresses to database {db_file}.")
     
+    # Compute every breakdown in one pass, then read the levels from the aggregates table
+    if BuildAggregates(db_file):
+        Log(f"Failed to build aggregates in database {db_file}.")
+        return 1
+
     # Get city counts
     city_count = GetCityCount(db_file)
     state_count = GetStateCount(db_file)
@@ -524,26 +775,19 @@ def main():
     # Use Cartopy to create a world map of the IP addresses
     try:
         # Get all latitude and longitude from ip_info table
-        lat_long = GetLatLong(db_file)
-        latitudes = [lat for lat, lon in lat_long]
-        longitudes = [lon for lat, lon in lat_long]
+        latitudes, longitudes, weights = GetLatLong(db_file)
 
-        if latitudes and longitudes:
+        if len(latitudes):
             plt.figure(figsize=(20, 8))
             ax = plt.axes(projection=ccrs.PlateCarree())
-            ax.add_feature(cfeature.LAND)
-            ax.add_feature(cfeature.OCEAN)
-            ax.add_feature(cfeature.COASTLINE)
-            ax.add_feature(cfeature.BORDERS, linestyle=':')
-            ax.add_feature(cfeature.LAKES, alpha=0.5)
-            ax.add_feature(cfeature.RIVERS)
-            ax.add_feature(cfeature.COUNTRIES, edgecolor='gray')
-            plt.scatter(longitudes, latitudes, color='red', s=10, alpha=0.7, transform=ccrs.PlateCarree())
+            SetMapExtent(ax, WORLD_EXTENT)
+            base = DrawBaseMap(ax, WORLD_EXTENT, (20, 8), WORLD_FEATURES, args.basemap_cache)
+            mode = PlotLocations(ax, latitudes, longitudes, weights, WORLD_EXTENT, WORLD_CELL, 'red', 'Reds', args.density_threshold)
             plt.title('Geolocation of IP Addresses')
             
             map_file = f"ip_geolocation_map_{TIMESTAMP}.png"
             plt.savefig(map_file)
-            Log(f"IP geolocation map saved to {map_file}")
+            Log(f"IP geolocation map saved to {map_file} ({len(latitudes)} locations, {mode} mode, base map {base})")
         else:
             Log("No latitude and longitude data available for mapping.")
     except ImportError:
@@ -554,27 +798,19 @@ def main():
     # Use Cartopy to create a US map with state borders of the IP addresses filtered by country or country_code
     try:
         # Get all latitude and longitude from ip_info table filtered by US
-        lat_long = GetLatLongByCountry("US", db_file)
-        latitudes = [lat for lat, lon in lat_long]
-        longitudes = [lon for lat, lon in lat_long]
+        latitudes, longitudes, weights = GetLatLongByCountry("US", db_file)
 
-        if latitudes and longitudes:
+        if len(latitudes):
             plt.figure(figsize=(20, 12))
             ax = plt.axes(projection=ccrs.LambertConformal())
-            ax.set_extent([-125, -66.5, 24, 49.5], crs=ccrs.PlateCarree())
-            ax.add_feature(cfeature.LAND)
-            ax.add_feature(cfeature.OCEAN)
-            ax.add_feature(cfeature.COASTLINE)
-            ax.add_feature(cfeature.BORDERS, linestyle=':')
-            ax.add_feature(cfeature.LAKES, alpha=0.5)
-            ax.add_feature(cfeature.RIVERS)
-            ax.add_feature(cfeature.STATES, edgecolor='gray')
-            plt.scatter(longitudes, latitudes, color='blue', s=10, alpha=0.7, transform=ccrs.PlateCarree())
+            SetMapExtent(ax, US_EXTENT)
+            base = DrawBaseMap(ax, US_EXTENT, (20, 12), US_FEATURES, args.basemap_cache)
+            mode = PlotLocations(ax, latitudes, longitudes, weights, US_EXTENT, US_CELL, 'blue', 'Blues', args.density_threshold)
             plt.title('Geolocation of IP Addresses in the US')
             
             map_file = f"us_ip_geolocation_map_{TIMESTAMP}.png"
             plt.savefig(map_file)
-            Log(f"US IP geolocation map saved to {map_file}")
+            Log(f"US IP geolocation map saved to {map_file} ({len(latitudes)} locations, {mode} mode, base map {base})")
         else:
             Log("No latitude and longitude data available for US mapping.")
     except ImportError:
@@ -1,6 +1,7 @@
 {
     "general": {
-        "ttl": 7
+        "ttl": 7,
+        "workers": 8
     },
     "maxmind": {
         "account": "MAXMIND_ID",
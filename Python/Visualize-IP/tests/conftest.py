@@ -0,0 +1,41 @@
+import os
+import sys
+
+import pytest
+
+# The scripts live one directory up and are imported as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Charts and maps are drawn off screen
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+
+# GeolocateIP logging into a fresh temporary directory
+@pytest.fixture
+def geo(tmp_path, monkeypatch):
+    import GeolocateIP
+
+    monkeypatch.setattr(GeolocateIP, "LOG_PATH", str(tmp_path / "geo.log"))
+    return GeolocateIP
+
+
+# VisualizeIP with the globals __main__ would set, skipped without its plotting dependencies
+@pytest.fixture
+def viz(geo, tmp_path, monkeypatch):
+    for module in ("numpy", "matplotlib", "cartopy"):
+        pytest.importorskip(module)
+    import VisualizeIP
+
+    monkeypatch.setattr(VisualizeIP, "LOG_PATH", str(tmp_path / "visualize.log"), raising=False)
+    monkeypatch.setattr(VisualizeIP, "TIMESTAMP", "test", raising=False)
+    return VisualizeIP
+
+
+# A data table for the rows of `columns` (name -> SQLite type) in a fresh database
+@pytest.fixture
+def database(viz, tmp_path):
+    def Create(columns):
+        db_file = str(tmp_path / "data.db")
+        assert viz.InitDB(columns, db_file) is False
+        return db_file
+    return Create
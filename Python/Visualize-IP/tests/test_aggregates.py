@@ -0,0 +1,70 @@
+import sqlite3
+
+COLUMNS = {"ip_address": "TEXT", "date": "DATE"}
+
+# Address -> (city, state, state_code, country, country_code, continent, continent_code, rows in data)
+LOCATIONS = {
+    "192.0.2.1": ("Denver", "Colorado", "CO", "United States", "US", "North America", "NA", 5),
+    "192.0.2.2": ("Denver", "Colorado", "CO", "United States", "US", "North America", "NA", 3),
+    "192.0.2.3": ("Boulder", "Colorado", "CO", "United States", "US", "North America", "NA", 2),
+    "192.0.2.4": ("Austin", "Texas", "TX", "United States", "US", "North America", "NA", 1),
+    "192.0.2.5": ("Toronto", "Ontario", "ON", "Canada", "CA", "North America", "NA", 4),
+    "192.0.2.6": ("Paris", "Ile-de-France", "IDF", "France", "FR", "Europe", "EU", 6),
+}
+
+
+# A database holding the data rows and ip_info of LOCATIONS, as main() leaves it before BuildAggregates
+def Locations(viz, database):
+    db_file = database(COLUMNS)
+    rows = [{"ip_address": ip, "date": f"2025-10-{day + 1:02d}T08:00:00-06:00"}
+            for ip, location in LOCATIONS.items() for day in range(location[-1])]
+    viz.SaveCsvToDB(rows, db_file)
+
+    ip_info = {}
+    for ip, (city, state, state_code, country, country_code, continent, continent_code, _) in LOCATIONS.items():
+        ip_info[ip] = {"city": city, "state": state, "state_code": state_code, "country": country, "country_code": country_code,
+                       "continent": continent, "continent_code": continent_code, "latitude": 1.0, "longitude": 2.0}
+    assert viz.SaveIPInfoToDB(ip_info, db_file) is False
+    return db_file
+
+
+def test_ip_info_summarizes_the_activity_of_each_address(viz, database):
+    db_file = Locations(viz, database)
+
+    conn = sqlite3.connect(db_file)
+    row = conn.execute("SELECT city, first_seen, last_seen, count FROM ip_info WHERE ip_address = '192.0.2.1'").fetchone()
+    conn.close()
+    assert row == ("Denver", "2025-10-01 14:00:00", "2025-10-05 14:00:00", 5)
+
+
+def test_every_level_is_built_in_one_pass(viz, database):
+    db_file = Locations(viz, database)
+    assert viz.BuildAggregates(db_file) is False
+
+    assert viz.GetContinentCount(db_file) == {"North America": 5, "Europe": 1}
+    assert viz.GetContinentCount(db_file, value="hits") == {"North America": 15, "Europe": 6}
+    assert viz.GetCountryCount(db_file) == {"United States, NA": 4, "Canada, NA": 1, "France, EU": 1}
+    assert viz.GetStateCount(db_file, value="hits") == {"Colorado, US, NA": 10, "Texas, US, NA": 1, "Ontario, CA, NA": 4, "Ile-de-France, FR, EU": 6}
+    assert viz.GetCityCount(db_file) == {"Denver, CO, US, NA": 2, "Boulder, CO, US, NA": 1, "Austin, TX, US, NA": 1,
+                                         "Toronto, ON, CA, NA": 1, "Paris, IDF, FR, EU": 1}
+
+
+def test_levels_are_filtered_by_country_name_or_code(viz, database):
+    db_file = Locations(viz, database)
+    viz.BuildAggregates(db_file)
+
+    assert viz.GetStateByCountryCount("US", db_file) == {"Colorado": 3, "Texas": 1}
+    assert viz.GetStateByCountryCount("United States", db_file, value="hits") == {"Colorado": 10, "Texas": 1}
+    assert viz.GetStateByCountryCount("Germany", db_file) == {}
+
+
+def test_rebuilding_replaces_the_previous_aggregates(viz, database):
+    db_file = Locations(viz, database)
+    viz.BuildAggregates(db_file)
+    viz.BuildAggregates(db_file)
+
+    conn = sqlite3.connect(db_file)
+    levels = dict(conn.execute("SELECT level, COUNT(*) FROM aggregates GROUP BY level").fetchall())
+    conn.close()
+    assert levels == {"continent": 2, "country": 3, "state": 4, "city": 5}
+    assert sum(viz.GetCityCount(db_file, value="hits").values()) == 21
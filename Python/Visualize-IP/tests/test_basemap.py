@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+plt = pytest.importorskip("matplotlib.pyplot")
+ccrs = pytest.importorskip("cartopy.crs")
+
+FIGSIZE = (4, 2)
+
+
+# Draws the raster Cartopy ships instead of the Natural Earth features, which need a download,
+# counting every time the base layer is drawn
+@pytest.fixture
+def drawn(viz, monkeypatch):
+    calls = []
+
+    def AddMapFeatures(ax, features):
+        calls.append(features)
+        ax.stock_img()
+
+    monkeypatch.setattr(viz, "AddMapFeatures", AddMapFeatures)
+    return calls
+
+
+def Draw(viz, cache_dir, extent=None, features=None):
+    fig = plt.figure(figsize=FIGSIZE)
+    try:
+        ax = fig.add_subplot(1, 1, 1, projection=ccrs.PlateCarree())
+        status = viz.DrawBaseMap(ax, extent or viz.WORLD_EXTENT, FIGSIZE, features or viz.WORLD_FEATURES, str(cache_dir) if cache_dir else "")
+        return status, len(ax.images)
+    finally:
+        plt.close(fig)
+
+
+def test_base_map_is_rendered_once_then_reused(viz, drawn, tmp_path):
+    cache_dir = tmp_path / "basemap_cache"
+
+    assert Draw(viz, cache_dir) == ("rendered", 1)
+    assert Draw(viz, cache_dir) == ("cached", 1)
+
+    assert drawn == [viz.WORLD_FEATURES]
+    key = viz.BaseMapKey(ccrs.PlateCarree(), viz.WORLD_EXTENT, FIGSIZE, plt.rcParams["figure.dpi"], viz.WORLD_FEATURES)
+    assert os.listdir(cache_dir) == [f"basemap_{key}.png"]
+
+
+def test_each_map_gets_its_own_raster(viz, drawn, tmp_path):
+    cache_dir = tmp_path / "basemap_cache"
+
+    assert Draw(viz, cache_dir)[0] == "rendered"
+    assert Draw(viz, cache_dir, extent=viz.US_EXTENT)[0] == "rendered"
+    assert Draw(viz, cache_dir, features=viz.US_FEATURES)[0] == "rendered"
+    assert Draw(viz, cache_dir, extent=viz.US_EXTENT)[0] == "cached"
+    assert len(os.listdir(cache_dir)) == 3
+
+
+def test_key_follows_everything_that_changes_the_pixels(viz):
+    projection = ccrs.PlateCarree()
+    key = viz.BaseMapKey(projection, viz.WORLD_EXTENT, FIGSIZE, 100, viz.WORLD_FEATURES)
+
+    assert viz.BaseMapKey(projection, viz.WORLD_EXTENT, FIGSIZE, 100, viz.WORLD_FEATURES) == key
+    assert viz.BaseMapKey(ccrs.Mercator(), viz.WORLD_EXTENT, FIGSIZE, 100, viz.WORLD_FEATURES) != key
+    assert viz.BaseMapKey(projection, viz.WORLD_EXTENT, (8, 4), 100, viz.WORLD_FEATURES) != key
+    assert viz.BaseMapKey(projection, viz.WORLD_EXTENT, FIGSIZE, 200, viz.WORLD_FEATURES) != key
+
+
+def test_empty_cache_dir_draws_the_features_every_time(viz, drawn):
+    assert Draw(viz, None) == ("drawn", 1)
+    assert Draw(viz, None) == ("drawn", 1)
+
+    assert len(drawn) == 2
@@ -0,0 +1,140 @@
+import math
+import random
+
+import pytest
+
+from ColumnSketch import HyperLogLog, SpaceSaving, ColumnProfile, DEFAULT_PRECISION
+
+# Three standard errors of a HyperLogLog estimate, 1.04 / sqrt(registers)
+HLL_BOUND = 3 * 1.04 / math.sqrt(1 << DEFAULT_PRECISION)
+
+
+# Seeded random 64-bit values; Python hashes ints without the per-process salt, so the
+# estimates are the same on every run
+def Distinct(count, seed):
+    rng = random.Random(seed)
+    return [rng.getrandbits(64) for _ in range(count)]
+
+
+# A skewed column: a few values make up most of the rows, with a long tail
+def Skewed(count, seed):
+    rng = random.Random(seed)
+    return [f"agent{int(rng.paretovariate(1.2))}" for _ in range(count)]
+
+
+def Counts(values):
+    counts = {}
+    for value in values:
+        counts[value] = counts.get(value, 0) + 1
+    return counts
+
+
+def Summary(values, top=20):
+    summary = SpaceSaving(top)
+    for value in values:
+        summary.Add(value)
+    return summary
+
+
+# Every reported count is within its error of the true count
+def AssertBounded(top, counts):
+    for value, count, error in top:
+        assert counts[value] <= count <= counts[value] + error
+
+
+@pytest.mark.parametrize("size", [10, 1000, 30000, 200000])
+def test_distinct_estimate_is_within_its_error_bound(size):
+    values = Distinct(size, size)
+    sketch = HyperLogLog()
+    for value in values + values[:size // 2]:
+        sketch.Add(value)
+
+    assert abs(sketch.Count() - size) <= max(HLL_BOUND * size, 1)
+
+
+def test_merged_sketches_equal_one_sketch_of_the_union():
+    values = Distinct(20000, 1)
+    left, right, union = HyperLogLog(), HyperLogLog(), HyperLogLog()
+    for value in values[:12000]:
+        left.Add(value)
+    for value in values[8000:]:
+        right.Add(value)
+    for value in values:
+        union.Add(value)
+
+    assert left.Merge(right).registers == union.registers
+    assert left.Count() == union.Count()
+
+    with pytest.raises(ValueError):
+        HyperLogLog(12).Merge(HyperLogLog(14))
+
+
+def test_top_values_match_exact_counts_on_a_skewed_column():
+    values = Skewed(100000, 2)
+    counts = Counts(values)
+    top = Summary(values).Top()
+
+    assert [value for value, _, _ in top[:10]] == sorted(counts, key=counts.get, reverse=True)[:10]
+    AssertBounded(top, counts)
+
+
+def test_unmonitored_values_are_counted_exactly_below_capacity():
+    values = Skewed(5000, 3)
+    counts = Counts(values)
+    summary = SpaceSaving(top=len(counts), capacity=len(counts))
+    for value in values:
+        summary.Add(value)
+
+    assert {value: (count, error) for value, count, error in summary.Top()} == {value: (count, 0) for value, count in counts.items()}
+
+
+def test_column_without_heavy_hitters_reports_no_top_values():
+    assert Summary(f"s{index}" for index in range(10000)).Top() == []
+
+
+def test_merged_summaries_keep_the_top_values_and_their_bounds():
+    values = Skewed(100000, 4)
+    counts = Counts(values)
+    merged = Summary(values[:40000]).Merge(Summary(values[40000:]))
+    top = merged.Top()
+
+    assert [value for value, _, _ in top[:10]] == sorted(counts, key=counts.get, reverse=True)[:10]
+    AssertBounded(top, counts)
+
+    # Later values are still counted within the bounds after a merge
+    for value in values[:1000]:
+        merged.Add(value)
+        counts[value] += 1
+    AssertBounded(merged.Top(), counts)
+
+
+def test_profile_summary_and_merge():
+    rng = random.Random(5)
+    rows = [(rng.getrandbits(64), f"agent{int(rng.paretovariate(1.2))}", rng.choice(["Success", "Failure", None]))
+            for _ in range(20000)]
+    columns = ["session_id", "user_agent", "result"]
+
+    whole, left, right = ColumnProfile(columns, 5), ColumnProfile(columns, 5), ColumnProfile(columns, 5)
+    for index, row in enumerate(rows):
+        whole.Add(row)
+        (left if index % 3 else right).Add(row)
+    merged = left.Merge(right)
+    summary = merged.Summary()
+
+    assert merged.rows == whole.rows == len(rows)
+    for position, column in enumerate(columns):
+        counts = Counts(row[position] for row in rows)
+        distinct, top = summary[column]
+
+        # Both profiles saw the same values, so their distinct estimates agree exactly
+        assert distinct == whole.Summary()[column][0]
+        assert abs(distinct - len(counts)) <= HLL_BOUND * len(counts)
+        AssertBounded(top, counts)
+
+    results = Counts(row[2] for row in rows)
+    assert summary["session_id"][1] == []
+    assert [value for value, _, _ in summary["result"][1]] == sorted(results, key=results.get, reverse=True)
+    assert [value for value, _, _ in summary["user_agent"][1]] == [value for value, _, _ in whole.Summary()["user_agent"][1]]
+
+    with pytest.raises(ValueError):
+        whole.Merge(ColumnProfile(["session_id"]))
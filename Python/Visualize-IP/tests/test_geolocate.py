@@ -0,0 +1,79 @@
+import json
+import threading
+
+import pytest
+
+
+# A config.json with the example's editions and fake credentials
+@pytest.fixture
+def config(tmp_path):
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps({
+        "general": {"ttl": 7, "workers": 4},
+        "maxmind": {"account": "1", "key": "key", "edition": "geolite-city",
+                    "editions": {"geolite-city": "https://geolite.invalid/geoip/v2.1/city/"}},
+    }))
+    return str(path)
+
+
+# Stands in for the MaxMind request, recording every address asked for
+class Lookups:
+    def __init__(self, failing=()):
+        self.asked = []
+        self.failing = set(failing)
+        self.lock = threading.Lock()
+
+    def __call__(self, ip, maxmind_config=None, session=None):
+        with self.lock:
+            self.asked.append(ip)
+        if ip in self.failing:
+            return None
+        # MaxMind leaves traits.ip_address out for some editions
+        return {"ip_address": "", "city_name": f"City {ip}", "latitude": 1.0, "longitude": 2.0}
+
+
+def Locate(geo, config, tmp_path, ips, **kwargs):
+    return geo.get_ip_infos(ips, config_path=config, db_path=str(tmp_path / "geo.db"), **kwargs)
+
+
+def test_each_distinct_address_is_fetched_once(geo, config, tmp_path, monkeypatch):
+    lookups = Lookups()
+    monkeypatch.setattr(geo, "GeolocateIP", lookups)
+
+    infos = Locate(geo, config, tmp_path, ["192.0.2.1", "192.0.2.2", "192.0.2.1", "not an ip", "2001:db8::1"])
+
+    assert sorted(lookups.asked) == ["192.0.2.1", "192.0.2.2", "2001:db8::1"]
+    assert sorted(infos) == ["192.0.2.1", "192.0.2.2", "2001:db8::1"]
+    assert infos["192.0.2.2"]["ip_address"] == "192.0.2.2"
+    assert infos["192.0.2.2"]["city_name"] == "City 192.0.2.2"
+
+
+def test_cached_addresses_are_not_fetched_again(geo, config, tmp_path, monkeypatch):
+    lookups = Lookups()
+    monkeypatch.setattr(geo, "GeolocateIP", lookups)
+    Locate(geo, config, tmp_path, ["192.0.2.1", "192.0.2.2"])
+
+    lookups.asked = []
+    infos = Locate(geo, config, tmp_path, ["192.0.2.1", "192.0.2.2", "192.0.2.3"])
+    assert lookups.asked == ["192.0.2.3"]
+    assert infos["192.0.2.1"]["city_name"] == "City 192.0.2.1"
+
+    lookups.asked = []
+    Locate(geo, config, tmp_path, ["192.0.2.1"], force=True)
+    assert lookups.asked == ["192.0.2.1"]
+
+
+def test_failed_lookups_are_left_out_and_retried(geo, config, tmp_path, monkeypatch):
+    lookups = Lookups(failing={"192.0.2.2"})
+    monkeypatch.setattr(geo, "GeolocateIP", lookups)
+
+    assert sorted(Locate(geo, config, tmp_path, ["192.0.2.1", "192.0.2.2"])) == ["192.0.2.1"]
+
+    lookups.asked = []
+    Locate(geo, config, tmp_path, ["192.0.2.1", "192.0.2.2"])
+    assert lookups.asked == ["192.0.2.2"]
+
+
+def test_missing_config_raises(geo, tmp_path):
+    with pytest.raises(geo.ConfigError):
+        Locate(geo, str(tmp_path / "missing.json"), tmp_path, ["192.0.2.1"])
@@ -0,0 +1,61 @@
+import sqlite3
+
+COLUMNS = {"ip_address": "TEXT", "user": "TEXT", "attempts": "INTEGER"}
+
+
+def Table(db_file, query):
+    conn = sqlite3.connect(db_file)
+    rows = conn.execute(query).fetchall()
+    conn.close()
+    return rows
+
+
+def test_csv_rows_are_streamed(viz, tmp_path):
+    path = tmp_path / "data.csv"
+    path.write_text("IP Address,User,Attempts\n192.0.2.1,alice,1\n192.0.2.2,bob,2\n")
+
+    rows = viz.ReadCSV(str(path))
+    assert next(rows) == {"IP Address": "192.0.2.1", "User": "alice", "Attempts": "1"}
+    assert list(rows) == [{"IP Address": "192.0.2.2", "User": "bob", "Attempts": "2"}]
+    assert list(viz.ReadCSV(str(tmp_path / "missing.csv"))) == []
+
+
+def test_rows_are_saved_in_chunks(viz, database):
+    db_file = database(COLUMNS)
+    rows = ({"ip_address": f"192.0.2.{index % 5}", "user": f"user{index}", "attempts": index} for index in range(23))
+
+    assert viz.SaveCsvToDB(rows, db_file, chunk_size=10) == 23
+
+    assert Table(db_file, "SELECT COUNT(*), SUM(attempts) FROM data") == [(23, sum(range(23)))]
+    with open(viz.LOG_PATH) as f:
+        assert [line.split("] ")[1].strip() for line in f] == [f"Saved 10 rows to {db_file}.", f"Saved 20 rows to {db_file}."]
+
+
+def test_short_rows_are_padded_and_extra_fields_cut(viz, database, tmp_path):
+    db_file = database(COLUMNS)
+    path = tmp_path / "data.csv"
+    path.write_text("IP Address,User,Attempts\n192.0.2.1,alice\n192.0.2.2,bob,2,extra,fields\n")
+
+    assert viz.SaveCsvToDB(viz.ReadCSV(str(path)), db_file) == 2
+    assert Table(db_file, "SELECT * FROM data") == [("192.0.2.1", "alice", None), ("192.0.2.2", "bob", 2)]
+
+
+def test_distinct_addresses_are_collected_in_the_same_pass(viz, database):
+    db_file = database(COLUMNS)
+    rows = [{"ip_address": ip, "user": "alice", "attempts": 1} for ip in ("192.0.2.1", "192.0.2.2", "192.0.2.1", "", None)]
+    ips = set()
+
+    assert viz.SaveCsvToDB(iter(rows), db_file, ips=ips) == 5
+    assert ips == {"192.0.2.1", "192.0.2.2"}
+
+
+def test_indexes_are_built_after_the_load(viz, database):
+    db_file = database(COLUMNS)
+    viz.SaveCsvToDB([{"ip_address": "192.0.2.1", "user": "alice", "attempts": 1}], db_file)
+
+    indexes = {name for (name,) in Table(db_file, "SELECT name FROM sqlite_master WHERE type = 'index' AND name NOT LIKE 'sqlite_%'")}
+    assert {"data_ip_address", "ip_info_country", "ip_info_country_code"} <= indexes
+
+
+def test_failed_load_returns_none(viz, tmp_path):
+    assert viz.SaveCsvToDB([{"ip_address": "192.0.2.1"}], str(tmp_path / "empty.db")) is None
@@ -0,0 +1,73 @@
+import sqlite3
+
+import pytest
+
+np = pytest.importorskip("numpy")
+plt = pytest.importorskip("matplotlib.pyplot")
+ccrs = pytest.importorskip("cartopy.crs")
+
+
+# A database whose ip_info holds (ip_address, country_code, latitude, longitude, count) rows
+def IPInfo(database, rows):
+    db_file = database({"ip_address": "TEXT"})
+    conn = sqlite3.connect(db_file)
+    conn.executemany("INSERT INTO ip_info (ip_address, country_code, latitude, longitude, count) VALUES (?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+    return db_file
+
+
+def Points(latitudes, longitudes, weights):
+    return sorted(zip(latitudes.tolist(), longitudes.tolist(), weights.tolist()))
+
+
+@pytest.fixture
+def ax():
+    fig = plt.figure()
+    yield fig.add_subplot(1, 1, 1, projection=ccrs.PlateCarree())
+    plt.close(fig)
+
+
+def test_addresses_at_one_location_are_folded_and_weighted(viz, database):
+    db_file = IPInfo(database, [
+        ("192.0.2.1", "US", 39.7, -105.0, 5),
+        ("192.0.2.2", "US", 39.7, -105.0, 3),
+        ("192.0.2.3", "US", 30.3, -97.7, None),
+        ("192.0.2.4", "FR", 48.9, 2.4, 2),
+        ("192.0.2.5", "FR", None, None, 7),
+    ])
+
+    latitudes, longitudes, weights = viz.GetLatLong(db_file)
+    assert latitudes.dtype == np.float64
+    assert Points(latitudes, longitudes, weights) == [(30.3, -97.7, 1.0), (39.7, -105.0, 8.0), (48.9, 2.4, 2.0)]
+    assert Points(*viz.GetLatLongByCountry("FR", db_file)) == [(48.9, 2.4, 2.0)]
+
+
+def test_unreadable_database_gives_empty_arrays(viz, tmp_path):
+    latitudes, longitudes, weights = viz.GetLatLong(str(tmp_path / "missing.db"))
+    assert latitudes.shape == longitudes.shape == weights.shape == (0,)
+
+
+def test_few_locations_are_scattered_by_weight(viz, ax):
+    weights = np.array([1.0, 4.0, 9.0])
+    mode = viz.PlotLocations(ax, np.array([10.0, 20.0, 30.0]), np.array([40.0, 50.0, 60.0]), weights,
+                             viz.WORLD_EXTENT, viz.WORLD_CELL, "red", "viridis", threshold=3)
+
+    assert mode == "points"
+    assert ax.collections[-1].get_sizes().tolist() == [10.0, 20.0, 30.0]
+
+
+def test_many_locations_are_binned_into_one_mesh(viz, ax):
+    rng = np.random.default_rng(1)
+    latitudes = rng.uniform(25, 49, 20000)
+    longitudes = rng.uniform(-124, -67, 20000)
+    weights = rng.integers(1, 10, 20000).astype(float)
+
+    mode = viz.PlotLocations(ax, latitudes, longitudes, weights, viz.US_EXTENT, viz.US_CELL, "red", "viridis", threshold=5000)
+
+    assert mode == "density"
+    meshes = [collection for collection in ax.collections if collection.get_array() is not None]
+    assert len(meshes) == 1
+    grid = meshes[0].get_array()
+    assert grid.sum() == pytest.approx(weights.sum())
+    assert grid.count() <= (viz.US_EXTENT[1] - viz.US_EXTENT[0]) * (viz.US_EXTENT[3] - viz.US_EXTENT[2]) / viz.US_CELL ** 2
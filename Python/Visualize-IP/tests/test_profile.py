@@ -0,0 +1,41 @@
+from ColumnSketch import ColumnProfile
+
+COLUMNS = {"ip_address": "TEXT", "result": "TEXT", "user": "TEXT"}
+
+
+# 60 rows over three addresses, every value of a column with its own count so the order is fixed
+def Rows():
+    rows = []
+    for ip, result, user, count in (("192.0.2.1", "Success", "alice", 30), ("192.0.2.2", "Failure", "bob", 20),
+                                    ("192.0.2.3", "Locked", "carol", 10)):
+        rows += [{"IP Address": ip, "Result": result, "User": user}] * count
+    return rows
+
+
+def test_sketch_profile_is_stored_and_read_back(viz, database):
+    db_file = database(COLUMNS)
+    profile = ColumnProfile(COLUMNS, 2)
+    assert viz.SaveCsvToDB(Rows(), db_file, profile=profile) == 60
+
+    summary = profile.Summary()
+    assert profile.rows == 60
+    assert summary["user"] == (3, [("alice", 30, 0), ("bob", 20, 0)])
+    assert viz.SaveProfileToDB(summary, False, db_file) is False
+
+    assert viz.GetColumnProfile(db_file) == {column: (distinct, False, tops) for column, (distinct, tops) in summary.items()}
+    assert viz.GetUniqueValues(db_file)["result"] == [("Success", 30), ("Failure", 20)]
+
+
+def test_exact_profile_matches_the_sketches_and_replaces_them(viz, database):
+    db_file = database(COLUMNS)
+    profile = ColumnProfile(COLUMNS, 2)
+    viz.SaveCsvToDB(Rows(), db_file, profile=profile)
+    viz.SaveProfileToDB(profile.Summary(), False, db_file)
+
+    exact = viz.ExactProfile(2, db_file)
+    assert exact == profile.Summary()
+    assert viz.SaveProfileToDB(exact, True, db_file) is False
+
+    stored = viz.GetColumnProfile(db_file)
+    assert stored["ip_address"] == (3, True, [("192.0.2.1", 30, 0), ("192.0.2.2", 20, 0)])
+    assert sorted(viz.GetUniqueValues(db_file, exact=True)["user"]) == [("alice", 30), ("bob", 20), ("carol", 10)]